@@ -33,6 +33,15 @@ if sys.platform.startswith('darwin'):
 else:
     LOG_PATH = os.path.join(USER_PATH, 'log')
 STYLES_PATH = os.path.join(USER_PATH, 'styles')
+SCRATCH_PATH = os.path.join(USER_PATH, 'scratch')
+SCORES_CACHE_PATH = os.path.join(USER_PATH, 'cache')
+SPECTRA_CACHE_PATH = os.path.join(SCORES_CACHE_PATH, 'spectra')
+
+# Maximum size of scores cache on disk, in bytes
+SCORES_CACHE_MAX_SIZE = 4 * 1024 ** 3
+
+# Maximum size of parsed spectra cache on disk, in bytes
+SPECTRA_CACHE_MAX_SIZE = 2 * 1024 ** 3
 
 if not os.path.exists(DATABASES_PATH):
     os.makedirs(DATABASES_PATH)
@@ -43,6 +52,15 @@ if not os.path.exists(LOG_PATH):
 if not os.path.exists(STYLES_PATH):
     os.makedirs(STYLES_PATH)
 
+if not os.path.exists(SCRATCH_PATH):
+    os.makedirs(SCRATCH_PATH)
+
+if not os.path.exists(SCORES_CACHE_PATH):
+    os.makedirs(SCORES_CACHE_PATH)
+
+if not os.path.exists(SPECTRA_CACHE_PATH):
+    os.makedirs(SPECTRA_CACHE_PATH)
+
 
 def get_debug_flag() -> bool:
     return DEBUG
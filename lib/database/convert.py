@@ -3,10 +3,11 @@ import os
 import numpy as np
 from sqlalchemy.exc import OperationalError
 
-from libmetgem.mgf import read as read_mgf
 from libmetgem import INTENSITY
 
 from ..utils import grouper
+from ..utils.mgf import read_mgf, is_mgf_file
+from ..utils.filtering import filter_spectra
 from .session import create_session
 from .models import Spectrum, Organism, Submitter, DataCollector, Instrument, Bank, Investigator
 
@@ -34,8 +35,30 @@ def convert_polarity(string):
         return None
 
 
-def chunk_read_mgf(filename, chunk_size=1000):
-    yield from grouper(read_mgf(filename, ignore_unknown=False), n=chunk_size)
+def chunk_read_mgf(filename, chunk_size=1000, processes=1):
+    yield from grouper(read_mgf(filename, ignore_unknown=False, processes=processes), n=chunk_size)
+
+
+def filter_batch(batch, options):
+    """Remove peaks from a batch of spectra read by `chunk_read_mgf` using `filter_spectra`, without normalizing
+    intensities.
+
+    Removed peaks would also be removed when filtering spectra with the same options at query time, so storing
+    filtered spectra only makes databases smaller and queries faster.
+
+    Args:
+        options: Mapping with `min_intensity`, `parent_filter_tolerance`, `matched_peaks_window`,
+            `min_matched_peaks_search` and `filter_engine` keys, eg. `CosineComputationOptions`.
+    """
+
+    entries = [entry for entry in batch if entry is not None]
+    mzs = [params.get('pepmass', -1) for params, _ in entries]
+    spectra = filter_spectra(mzs, [data if data is not None else np.empty((0, 2), dtype=np.float32)
+                                   for _, data in entries],
+                             options['min_intensity'], options['parent_filter_tolerance'],
+                             options['matched_peaks_window'], options['min_matched_peaks_search'],
+                             engine=options['filter_engine'], normalize=False)
+    return [(params, data) for (params, _), data in zip(entries, spectra)]
 
 
 class DataBaseBuilder:
@@ -112,8 +135,20 @@ class DataBaseBuilder:
         except OperationalError:
             pass
 
-    def add_bank(self, mgf_path, name=None):
-        bank = os.path.splitext(os.path.basename(mgf_path))[0] if name is None else name
+    def add_bank(self, mgf_path, name=None, processes=1, filter_options=None):
+        """Add spectra from a MGF file to the database, replacing spectra of the bank with the same name.
+
+        Args:
+            processes (int): Number of processes used to parse the file, see `lib.utils.mgf.read_mgf`.
+            filter_options: If given, spectra are filtered with `filter_batch` before being stored, using the engine
+                given by its `filter_engine` key.
+        """
+
+        if name is None:
+            bank = os.path.basename(mgf_path)
+            bank = bank[:bank.lower().rindex('.mgf')] if is_mgf_file(bank) else os.path.splitext(bank)[0]
+        else:
+            bank = name
 
         if bank in self._uniques['bank']:
             q = self.session.query(Spectrum).filter(Spectrum.bank_id == self._uniques['bank'][bank])
@@ -124,8 +159,10 @@ class DataBaseBuilder:
         else:
             self._uniques['bank'][bank] = self._indexes['bank']
 
-        for batch in chunk_read_mgf(mgf_path, 1000):  # Read mgf file by batch of 1000 spectra
+        for batch in chunk_read_mgf(mgf_path, 1000, processes=processes):  # Read mgf file by batch of 1000 spectra
             spectra = []
+            if filter_options is not None:
+                batch = filter_batch(batch, filter_options)
 
             for entry in batch:
                 # If entry is None, we are in a non-complete batch (end of file), just break
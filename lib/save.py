@@ -1,8 +1,11 @@
 import zipfile
 import json
 import io
+import struct
+import time
 
 import numpy as np
+import scipy.sparse as sp
 from numpy.compat import is_pathlib_path, basestring
 from numpy.lib import format
 from numpy.lib.npyio import NpzFile
@@ -10,6 +13,7 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 
 from .config import FILE_EXTENSION
+from .utils.scores import CondensedScores
 
 # Copy of numpy's _savez function to allow different file extension
 # https://github.com/numpy/numpy/blob/master/numpy/lib/npyio.py#L669
@@ -38,12 +42,19 @@ class MnzFile(NpzFile):
 
         super().__init__(fid, own_fid, *args, **kwargs)
         self.parquet_files = [x[:-8] for x in self._files if x.endswith('.parquet')]
+        self.sparse_files = [x[:-4] for x in self._files if x.endswith('.npz')]
+        self.condensed_files = [x[:-14] for x in self._files if x.endswith('.condensed.npy')]
 
     def __getitem__(self, key):
         if key in self.parquet_files:
             with self.zip.open(key + '.parquet') as f:
                 table = pq.read_table(io.BytesIO(f.read()))
             return table.to_pandas()
+        elif key in self.sparse_files:
+            with self.zip.open(key + '.npz') as f:
+                return sp.load_npz(io.BytesIO(f.read()))
+        elif key in self.condensed_files:
+            return CondensedScores(super().__getitem__(key + '.condensed'))
 
         val = super().__getitem__(key)
 
@@ -54,7 +65,39 @@ class MnzFile(NpzFile):
                 return val
         else:
             return val
-                
+
+    def memmap(self, key, mode='r'):
+        """Map an array stored without compression directly from the archive file, instead of reading it in memory.
+
+        Raises:
+            KeyError: if `key` is not an array of the archive.
+            ValueError: if the array was stored with compression.
+        """
+
+        if key in self.condensed_files:
+            return CondensedScores(self.memmap(key + '.condensed', mode=mode))
+
+        info = self.zip.getinfo(key + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"'{key}' is compressed and can't be memory-mapped.")
+
+        filename = self.fid.name
+        with open(filename, 'rb') as f:
+            # Skip zip local file header, then read npy header
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        return np.memmap(filename, dtype=dtype, mode=mode, shape=shape,
+                         order='F' if fortran_order else 'C', offset=offset)
+
 
 def zipfile_factory(file, *args, **kwargs):
     """
@@ -110,8 +153,24 @@ def savez(file, version, *args, compress=True, **kwargs):
                         force_zip64 = val.values.nbytes >= 2 ** 30
                         with zipf.open(fname, 'w', force_zip64=force_zip64) as fid:
                             pq.write_table(pa.Table.from_pandas(val), fid)
+                    elif sp.issparse(val):
+                        fname = key + '.npz'
+                        val = val.tocsr()
+                        force_zip64 = val.data.nbytes + val.indices.nbytes + val.indptr.nbytes >= 2**30
+                        with zipf.open(fname, 'w', force_zip64=force_zip64) as fid:
+                            sp.save_npz(fid, val, compressed=False)
                     else:
                         fname = key + '.npy'
+                        if isinstance(val, CondensedScores):
+                            # Only the upper triangle of condensed scores matrices is stored
+                            fname = key + '.condensed.npy'
+                            val = val.data
+                        if isinstance(val, np.memmap):
+                            # Store memory-mapped arrays without compression, so that they can be mapped again
+                            # from the archive with `MnzFile.memmap`
+                            fname = zipfile.ZipInfo(fname, date_time=time.localtime(time.time())[:6])
+                            fname.compress_type = zipfile.ZIP_STORED
+                            fname.external_attr = 0o600 << 16
                         val = np.asanyarray(val)
                         force_zip64 = val.nbytes >= 2**30
                         with zipf.open(fname, 'w', force_zip64=force_zip64) as fid:
@@ -1,5 +1,5 @@
 from PyQt5.QtWidgets import QDialog, QGridLayout, QDialogButtonBox, QSpinBox, QAbstractSpinBox, QAbstractButton, \
-    QGroupBox, QWidget, QLayout
+    QGroupBox, QWidget, QLayout, QComboBox
 from PyQt5.QtCore import Qt
 
 from .widgets import TSNEOptionsWidget, NetworkOptionsWidget, CosineOptionsWidget
@@ -22,8 +22,8 @@ class CurrentParametersDialog(QDialog):
                 child.setReadOnly(True)
                 child.setButtonSymbols(QSpinBox.NoButtons)
 
-            # Set buttons and checkboxes readonly
-            for child in w.findChildren(QAbstractButton) + w.findChildren(QGroupBox):
+            # Set buttons, checkboxes and comboboxes readonly
+            for child in w.findChildren(QAbstractButton) + w.findChildren(QGroupBox) + w.findChildren(QComboBox):
                 child.setAttribute(Qt.WA_TransparentForMouseEvents)
                 child.setFocusPolicy(Qt.NoFocus)
 
@@ -247,7 +247,7 @@ class DownloadDatabasesDialog(DownloadDatabasesDialogUI, DownloadDatabasesDialog
             else:
                 QMessageBox.warning(self, None, "No library downloaded.")
 
-        worker = ConvertDatabasesWorker(ids, output_path=self.base_path)
+        worker = ConvertDatabasesWorker(ids, output_path=self.base_path, use_multiprocessing=True)
         worker.error.connect(clean_up)
         worker.error.connect(self.on_error)
         worker.canceled.connect(clean_up)
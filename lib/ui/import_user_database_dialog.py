@@ -9,6 +9,7 @@ from PyQt5.QtWidgets import QCompleter, QFileSystemModel, QDialog, QFileDialog,
 from ..workers import ConvertDatabasesWorker
 from ..workers import WorkerSet
 from .progress_dialog import ProgressDialog
+from ..utils.mgf import MGF_EXTENSIONS, is_mgf_file
 
 UI_FILE = os.path.join(os.path.dirname(__file__), 'import_user_database_dialog.ui')
 ImportUserDatabaseDialogUI, ImportUserDatabaseDialogBase = uic.loadUiType(UI_FILE, from_imports='lib.ui',
@@ -47,7 +48,7 @@ class ImportUserDatabaseDialog(ImportUserDatabaseDialogBase, ImportUserDatabaseD
         model = QFileSystemModel(completer)
         model.setFilter(QDir.AllDirs | QDir.Files | QDir.NoDotAndDotDot)
         model.setNameFilterDisables(False)
-        model.setNameFilters(['*.mgf'])
+        model.setNameFilters(['*' + ext for ext in MGF_EXTENSIONS])
         model.setRootPath(QDir.currentPath())
         completer.setModel(model)
         self.editInputFile.setText(QDir.currentPath())
@@ -67,7 +68,7 @@ class ImportUserDatabaseDialog(ImportUserDatabaseDialogBase, ImportUserDatabaseD
 
         dialog = QFileDialog(self)
         dialog.setFileMode(QFileDialog.ExistingFile)
-        dialog.setNameFilters(["MGF Files (*.mgf)", "All files (*.*)"])
+        dialog.setNameFilters([f"MGF Files ({' '.join('*' + ext for ext in MGF_EXTENSIONS)})", "All files (*.*)"])
 
         if dialog.exec_() == QDialog.Accepted:
             filename = dialog.selectedFiles()[0]
@@ -76,7 +77,7 @@ class ImportUserDatabaseDialog(ImportUserDatabaseDialogBase, ImportUserDatabaseD
 
     def import_database(self):
         input_file = self.editInputFile.text()
-        if len(input_file) == 0 or not os.path.exists(input_file) or os.path.splitext(input_file)[1] != '.mgf':
+        if len(input_file) == 0 or not os.path.exists(input_file) or not is_mgf_file(input_file):
             self.editInputFile.setPalette(self._error_palette)
 
         name = self.editDatabaseName.text()
@@ -88,5 +89,6 @@ class ImportUserDatabaseDialog(ImportUserDatabaseDialogBase, ImportUserDatabaseD
             self._workers.add(worker)
 
     def prepare_convert_database_worker(self, id_, name):
-        worker = ConvertDatabasesWorker([id_], names=[name], output_path=self.base_path)
+        worker = ConvertDatabasesWorker([id_], names=[name], output_path=self.base_path,
+                                        use_multiprocessing=True)
         return worker
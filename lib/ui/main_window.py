@@ -1,16 +1,26 @@
 from .. import config, ui, utils, workers, errors
 from ..utils.network import Network
+from ..utils.scores import ScoresCache
+from ..utils.spectra import SpectraStore, SpectraCache
+from ..utils.mgf import MGF_EXTENSIONS
+from ..utils.mzml import MZML_EXTENSIONS
+from ..utils.consensus import MEMBERS_COLUMN, members_infos, members_column, append_members
+from ..utils.sources import sources_infos, append_sources
+from ..utils.raw_spectra import RawSpectraIndex
+from ..utils.memory import plan_memory, format_size
 from ..utils import colors
 from ..logger import get_logger, debug
 
 import sys
 import os
 import json
+import logging
 import zipfile
 
 import requests
 
 import numpy as np
+import pandas as pd
 import igraph as ig
 import sqlalchemy
 
@@ -159,6 +169,7 @@ class MainWindow(MainWindowBase, MainWindowUI):
         self.actionAbout.triggered.connect(lambda: ui.AboutDialog().exec_())
         self.actionAboutQt.triggered.connect(lambda: QMessageBox.aboutQt(self))
         self.actionProcessFile.triggered.connect(self.on_process_file_triggered)
+        self.actionAppendFile.triggered.connect(self.on_append_file_triggered)
         self.actionImportMetadata.triggered.connect(self.on_import_metadata_triggered)
         self.actionImportGroupMapping.triggered.connect(self.on_import_group_mapping_triggered)
         self.actionCurrentParameters.triggered.connect(self.on_current_parameters_triggered)
@@ -595,13 +606,22 @@ class MainWindow(MainWindowBase, MainWindowUI):
                         node = self.current_view.scene().selectedNodes()[0]
                     node_idx = node.index()
 
-                data = human_readable_data(self.network.spectra[node_idx])
+                if type_ == 'raw':
+                    data = human_readable_data(self.read_raw_spectrum(node_idx))
+                else:
+                    data = human_readable_data(self.network.spectra[node_idx])
 
                 mz_parent = self.network.mzs[node_idx]
             except IndexError:
                 pass
             except KeyError:
-                QMessageBox.warning(self, None, 'Selected spectrum does not exists.')
+                if type_ == 'raw':
+                    QMessageBox.warning(self, None, 'Raw spectrum is not available for the selected spectrum. '
+                                                    'Only spectra read from uncompressed MGF files are indexed.')
+                else:
+                    QMessageBox.warning(self, None, 'Selected spectrum does not exists.')
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, None, f'Raw spectrum could not be read: {e}')
             else:
                 # Set data as first or second spectrum
                 if type_ == 'compare':
@@ -620,6 +640,20 @@ class MainWindow(MainWindowBase, MainWindowUI):
                 self.dockSpectra.show()
                 self.dockSpectra.raise_()
 
+    def read_raw_spectrum(self, node_idx):
+        """Read the unfiltered spectrum of a node from the file it was read from, using the project's
+        `RawSpectraIndex`. The raw spectrum of a consensus spectrum is the one of its first member.
+
+        Raises:
+            KeyError: if the raw spectrum is not indexed.
+        """
+
+        if self.network.raw_index is None or self.network.source_files is None:
+            raise KeyError(node_idx)
+        scan = self.network.members[node_idx][0] if self.network.members is not None else node_idx
+        _, peaks = self.network.raw_index.read(int(scan), self.network.source_files)
+        return peaks
+
     @debug
     def on_select_first_neighbors_triggered(self, nodes, *args):
         view = self.current_view
@@ -677,6 +711,10 @@ class MainWindow(MainWindowBase, MainWindowUI):
             action = QAction(self.actionViewSpectrum.icon(), "View Spectrum", self)
             action.triggered.connect(lambda: self.on_show_spectrum_triggered('show', node_idx=node_idx))
             menu.addAction(action)
+            action = QAction(self.actionViewSpectrum.icon(), "View Raw Spectrum", self)
+            action.triggered.connect(lambda: self.on_show_spectrum_triggered('raw', node_idx=node_idx))
+            action.setEnabled(self.network.raw_index is not None)
+            menu.addAction(action)
             action = QAction(self.actionViewCompareSpectrum.icon(), "Compare Spectrum", self)
             action.triggered.connect(lambda: self.on_show_spectrum_triggered('compare', node_idx=node_idx))
             menu.addAction(action)
@@ -715,6 +753,8 @@ class MainWindow(MainWindowBase, MainWindowUI):
     @debug
     def on_preferences_triggered(self, *args):
         dialog = ui.SettingsDialog(self)
+        dialog.neutralToleranceChanged.connect(
+            lambda: self.tvEdges.model().sourceModel().invalidateInterpretations())
         if dialog.exec_() == QDialog.Accepted:
             style = dialog.getValues()
             self.gvNetwork.scene().setNetworkStyle(style)
@@ -742,13 +782,29 @@ class MainWindow(MainWindowBase, MainWindowUI):
             self.gvNetwork.scene().clear()
             self.gvTSNE.scene().clear()
 
-            process_file, use_metadata, metadata_file, metadata_options, \
+            process_files, use_metadata, metadata_file, metadata_options, \
                 compute_options, tsne_options, network_options = dialog.getValues()
             self.network.options.cosine = compute_options
             self.network.options.tsne = tsne_options
             self.network.options.network = network_options
 
-            worker = self.prepare_read_mgf_worker(process_file, metadata_file, metadata_options)
+            worker = self.prepare_read_mgf_worker(process_files, metadata_file, metadata_options)
+            if worker is not None:
+                self._workers.add(worker)
+
+    @debug
+    def on_append_file_triggered(self, *args):
+        if not hasattr(self.network, 'scores'):
+            QMessageBox.information(self, None, "No network found, please open a file first.")
+            return
+
+        dialog = QFileDialog(self)
+        dialog.setFileMode(QFileDialog.ExistingFiles)
+        dialog.setNameFilters([f"MGF Files ({' '.join('*' + ext for ext in MGF_EXTENSIONS)})",
+                               f"mzML/mzXML Files ({' '.join('*' + ext for ext in MZML_EXTENSIONS)})",
+                               "All files (*.*)"])
+        if dialog.exec_() == QDialog.Accepted:
+            worker = self.prepare_append_mgf_worker(dialog.selectedFiles())
             if worker is not None:
                 self._workers.add(worker)
 
@@ -1025,15 +1081,26 @@ class MainWindow(MainWindowBase, MainWindowUI):
             return worker
 
     @debug
-    def prepare_generate_network_worker(self, keep_vertices=False):
+    def prepare_generate_network_worker(self, keep_vertices=False, first_appended=None):
         def interactions_generated():
             nonlocal worker
             interactions, graph = worker.result()
             self.network.interactions = interactions
             self.network.graph = graph
+            self.network.candidates = worker.candidates
+
+        cosine_options, network_options = self.network.options.cosine, self.network.options.network
+        if cosine_options.scores_storage == 'top_k' \
+                and (network_options.top_k > cosine_options.neighbours_top_k
+                     or network_options.pairs_min_cosine < cosine_options.sparse_min_cosine):
+            self.statusbar.showMessage(f'Only the {cosine_options.neighbours_top_k} best scores above '
+                                       f'{cosine_options.sparse_min_cosine} were kept for each spectrum, '
+                                       'some edges may be missing from the network.')
 
         worker = workers.GenerateNetworkWorker(self.network.scores, self.network.mzs, self.network.graph,
-                                               self.network.options.network, keep_vertices=keep_vertices)
+                                               self.network.options.network, keep_vertices=keep_vertices,
+                                               candidates=self.network.candidates,
+                                               first_appended=first_appended, use_multiprocessing=True)
         worker.finished.connect(interactions_generated)
 
         return worker
@@ -1088,35 +1155,138 @@ class MainWindow(MainWindowBase, MainWindowUI):
         return worker
 
     @debug
-    def prepare_compute_scores_worker(self, spectra, use_multiprocessing):
+    def prepare_compute_scores_worker(self, mzs, spectra, use_multiprocessing=True, previous_scores=None,
+                                      use_cache=False, sources=None):
         def error(e):
             if e.__class__ == OSError:
                 QMessageBox.warning(self, None, str(e))
             else:
                 raise e
 
-        worker = workers.ComputeScoresWorker(spectra, use_multiprocessing, self.network.options.cosine)
+        def finished():
+            if worker.approximated_pairs > 0:
+                self.statusbar.showMessage(f'Scores are approximate: {worker.approximated_pairs} of {worker.max} '
+                                           'pairs of spectra were not found similar by approximate search and '
+                                           'were set to zero without being computed.')
+            elif worker.pruned_pairs > 0:
+                self.statusbar.showMessage(f'{worker.pruned_pairs} of {worker.max} pairs of spectra '
+                                           'could not have a non-zero score and were not computed.')
+
+        worker = workers.ComputeScoresWorker(mzs, spectra, self.network.options.cosine,
+                                             use_multiprocessing=use_multiprocessing,
+                                             previous_scores=previous_scores,
+                                             cache=ScoresCache() if use_cache else None,
+                                             sources=sources)
+        worker.finished.connect(finished)
         worker.error.connect(error)
 
         return worker
 
+    def check_memory(self, num_spectra):
+        """Estimate the memory needed to process `num_spectra` spectra before scores are computed, offer to switch to
+        a scores storage needing less memory if needed and warn user if scores or t-SNE still do not fit in memory.
+
+        Returns:
+            bool: False if user chose not to continue.
+        """
+
+        options = self.network.options
+        plan = plan_memory(num_spectra, options.cosine, options.tsne)
+
+        if plan.storage != options.cosine.scores_storage:
+            current = plan_memory(num_spectra, options.cosine, options.tsne, available=plan.available, switch=False)
+            reply = QMessageBox.question(self, None,
+                                         f"Storing scores for {num_spectra} spectra using "
+                                         f"'{options.cosine.scores_storage}' storage may need up to "
+                                         f"{format_size(current.estimates['scores'])} of memory but only "
+                                         f"{format_size(plan.available)} are available.\n\n"
+                                         f"Do you want to use '{plan.storage}' storage instead? Scores will be the "
+                                         "same.",
+                                         QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.Yes)
+            if reply == QMessageBox.Cancel:
+                return False
+            elif reply == QMessageBox.Yes:
+                self.statusbar.showMessage(f"Scores storage switched from '{options.cosine.scores_storage}' to "
+                                           f"'{plan.storage}'.")
+                options.cosine.scores_storage = plan.storage
+            else:
+                plan = current
+
+        details = ', '.join(f'{stage}: {format_size(value)}' for stage, value in plan.estimates.items())
+        logging.getLogger().info(f'Estimated memory needed for {num_spectra} spectra using {plan.storage} storage: '
+                                 f'{details}, {format_size(plan.available)} available')
+
+        if plan.fits is False:
+            message = (f"Storing scores for {num_spectra} spectra may need up to "
+                       f"{format_size(plan.estimates['scores'])} of memory but only {format_size(plan.available)} "
+                       "are available.\nYour computer may become unresponsive. Using sparse or top-K scores storage "
+                       "may help.")
+        elif plan.tsne_fits is False:
+            message = (f"t-SNE on {num_spectra} spectra may need up to {format_size(plan.estimates['t-SNE'])} of "
+                       f"memory in addition to scores ({details}) but only {format_size(plan.available)} are "
+                       "available.\nYour computer may become unresponsive while computing t-SNE. Using Barnes-Hut "
+                       "t-SNE or a higher t-SNE minimum score may help.")
+        else:
+            return True
+
+        reply = QMessageBox.warning(self, None, message + "\n\nDo you want to continue anyway?",
+                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        return reply == QMessageBox.Yes
+
     @debug
     def prepare_read_mgf_worker(self, mgf_filename, metadata_filename=None,
-                                metadata_options=workers.ReadMetadataOptions()):
-        worker = workers.ReadMGFWorker(mgf_filename, self.network.options.cosine)
+                                metadata_options=workers.ReadMetadataOptions(), allow_pipeline=True):
+        """Read spectra from a file, or from a list of files, and compute their scores"""
+
+        options = self.network.options.cosine
+        filenames = [mgf_filename] if isinstance(mgf_filename, str) else list(mgf_filename)
+        pipelined = (allow_pipeline and options.pipelined and len(filenames) == 1
+                     and workers.ReadMGFComputeScoresWorker.supports(options))
+        if pipelined:
+            worker = workers.ReadMGFComputeScoresWorker(filenames[0], options, use_multiprocessing=True,
+                                                        cache=SpectraCache(), scores_cache=ScoresCache())
+        else:
+            worker = workers.ReadMGFWorker(filenames, options, use_multiprocessing=True, cache=SpectraCache())
 
         def file_read():
             nonlocal worker
             self.tvNodes.model().sourceModel().beginResetModel()
-            self.network.mzs, self.network.spectra = worker.result()
+            if pipelined:
+                self.network.mzs, self.network.spectra, scores = worker.result()
+            else:
+                self.network.mzs, self.network.spectra = worker.result()
+            self.network.members = worker.members
+            self.network.sources, self.network.source_files = worker.sources, worker.filenames
+            self.network.raw_index = worker.raw_index
             self.tvNodes.model().sourceModel().endResetModel()
-            worker = self.prepare_compute_scores_worker(self.network.mzs, self.network.spectra)
+            infos = members_infos(worker.members) if worker.members is not None else None
+            infos = sources_infos(worker.sources, worker.filenames, infos)
+            if infos is not None:
+                self.network.infos = infos
+
+            if pipelined:
+                set_scores(scores)
+                return
+
+            if not self.check_memory(len(self.network.mzs)):
+                return
+
+            worker = self.prepare_compute_scores_worker(self.network.mzs, self.network.spectra, use_cache=True,
+                                                        sources=self.network.sources)
             if worker is not None:
                 worker.finished.connect(scores_computed)
                 self._workers.add(worker)
 
         def error(e):
-            if e.__class__ == KeyError and e.args[0] == "pepmass":
+            if pipelined and isinstance(e, MemoryError):
+                # Read spectra first, so that memory needed to score them is checked before scoring starts
+                logging.getLogger().info(str(e))
+                self.statusbar.showMessage(f'{e} Spectra will be scored once they are all read.')
+                fallback = self.prepare_read_mgf_worker(mgf_filename, metadata_filename, metadata_options,
+                                                        allow_pipeline=False)
+                if fallback is not None:
+                    self._workers.add(fallback)
+            elif e.__class__ == KeyError and e.args[0] == "pepmass":
                 QMessageBox.warning(self, None, f"File format is incorrect. At least one scan has no pepmass defined.")
             elif hasattr(e, 'message'):
                 QMessageBox.warning(self, None, e.message)
@@ -1124,9 +1294,13 @@ class MainWindow(MainWindowBase, MainWindowUI):
                 QMessageBox.warning(self, None, str(e))
 
         def scores_computed():
+            set_scores(worker.result())
+
+        def set_scores(scores):
             nonlocal worker
             self.tvEdges.model().sourceModel().beginResetModel()
-            self.network.scores = worker.result()
+            self.network.scores = scores
+            self.network.candidates = None
             self.network.interactions = None
             self.tvEdges.model().sourceModel().endResetModel()
             self.draw()
@@ -1139,12 +1313,89 @@ class MainWindow(MainWindowBase, MainWindowUI):
         worker.error.connect(error)
         return worker
 
+    @debug
+    def prepare_append_mgf_worker(self, mgf_filename):
+        """Append spectra from a MGF file, or from a list of files, to current project, computing only scores
+        involving new spectra"""
+
+        worker = workers.ReadMGFWorker(mgf_filename, self.network.options.cosine, use_multiprocessing=True,
+                                       cache=SpectraCache())
+        num_nodes = len(self.network.mzs)
+        mzs, spectra, members, sources, source_files, raw_index = [], [], None, None, None, None
+
+        def file_read():
+            nonlocal worker, mzs, spectra, members, sources, source_files, raw_index
+            new_mzs, new_spectra = worker.result()
+            if len(new_mzs) == 0:
+                return
+            members = append_members(self.network.members, num_nodes, worker.members, len(new_mzs))
+            sources, source_files = append_sources(self.network.sources, self.network.source_files,
+                                                   worker.sources, worker.filenames)
+            if self.network.raw_index is not None and source_files is not None:
+                raw_index = RawSpectraIndex.concatenate(self.network.raw_index, len(self.network.source_files),
+                                                        worker.raw_index)
+
+            spectra = SpectraStore.concatenate([self.network.spectra, new_spectra])
+            mzs = spectra.mzs
+            worker = self.prepare_compute_scores_worker(mzs, spectra, previous_scores=self.network.scores)
+            if worker is not None:
+                worker.finished.connect(scores_computed)
+                self._workers.add(worker)
+
+        def error(e):
+            if e.__class__ == KeyError and e.args[0] == "pepmass":
+                QMessageBox.warning(self, None, f"File format is incorrect. At least one scan has no pepmass defined.")
+            else:
+                QMessageBox.warning(self, None, str(e))
+
+        def scores_computed():
+            nonlocal worker
+            self.tvNodes.model().sourceModel().beginResetModel()
+            self.network.mzs, self.network.spectra = mzs, spectra
+            self.network.scores = worker.result()
+            self.network.members = members
+            self.network.sources, self.network.source_files = sources, source_files
+            self.network.raw_index = raw_index
+            self.tvNodes.model().sourceModel().endResetModel()
+            if self.network.infos is not None:
+                empty = pd.DataFrame(index=pd.RangeIndex(num_nodes, len(mzs)), columns=self.network.infos.columns)
+                infos = pd.concat([self.network.infos, empty])
+                if members is not None:
+                    infos[MEMBERS_COLUMN] = members_column(members)
+                self.network.infos = sources_infos(sources, source_files, infos)
+            else:
+                infos = members_infos(members) if members is not None else None
+                infos = sources_infos(sources, source_files, infos)
+                if infos is not None:
+                    self.network.infos = infos
+            self.has_unsaved_changes = True
+
+            # Nodes are added to the graph, so layouts have to be computed again
+            self.gvNetwork.scene().clear()
+            self.gvTSNE.scene().clear()
+            worker = self.prepare_generate_network_worker(keep_vertices=True, first_appended=num_nodes)
+            worker.finished.connect(network_generated)
+            self._workers.add(worker)
+
+        def network_generated():
+            graph = self.network.graph
+            if '__color' in graph.vs.attributes():
+                graph.vs['__color'] = [c if c is not None else QColor() for c in graph.vs['__color']]
+            self.draw()
+
+        worker.finished.connect(file_read)
+        worker.error.connect(error)
+        return worker
+
     @debug
     def prepare_read_metadata_worker(self, filename, options):
         def file_read():
             nonlocal worker
             self.tvNodes.model().sourceModel().beginResetModel()
-            self.network.infos = worker.result()  # TODO: Append metadata instead of overriding
+            infos = worker.result()  # TODO: Append metadata instead of overriding
+            if self.network.members is not None:
+                infos = members_infos(self.network.members, infos)
+            self.network.infos = sources_infos(self.network.sources, self.network.source_files, infos)
             self.network.mappings = {}
             self.has_unsaved_changes = True
             self.tvNodes.model().sourceModel().endResetModel()
@@ -1166,6 +1417,11 @@ class MainWindow(MainWindowBase, MainWindowUI):
         """Save current project to a file for future access"""
 
         def process_finished():
+            try:
+                worker.install()
+            except OSError as e:
+                QMessageBox.warning(self, None, str(e))
+                return
             self.fname = fname
             self.has_unsaved_changes = False
 
@@ -1175,8 +1431,7 @@ class MainWindow(MainWindowBase, MainWindowUI):
             else:
                 raise e
 
-        worker = workers.SaveProjectWorker(fname, self.network.graph, self.network, self.network.options,
-                                           original_fname=self.fname)
+        worker = workers.SaveProjectWorker(fname, self.network.graph, self.network, self.network.options)
         worker.finished.connect(process_finished)
         worker.error.connect(error)
 
@@ -1227,9 +1482,8 @@ class MainWindow(MainWindowBase, MainWindowUI):
         if (getattr(self.network, 'mzs', None) is None or getattr(self.network, 'spectra', None) is None
                 or not os.path.exists(config.SQL_PATH)):
             return
-        mzs = [self.network.mzs[index] for index in indices]
-        spectra = [self.network.spectra[index] for index in indices]
-        worker = workers.QueryDatabasesWorker(indices, mzs, spectra, options)
+        spectra = self.network.spectra[list(indices)]
+        worker = workers.QueryDatabasesWorker(indices, spectra.mzs, spectra, options)
 
         def query_finished():
             nonlocal worker
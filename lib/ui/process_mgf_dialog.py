@@ -13,13 +13,18 @@ ProcessMgfDialogUI, ProcessMgfDialogBase = uic.loadUiType(UI_FILE, from_imports=
 from .widgets import TSNEOptionsWidget, NetworkOptionsWidget, CosineOptionsWidget
 from ..ui.import_metadata_dialog import ImportMetadataDialog
 from ..workers.read_metadata import ReadMetadataOptions
+from ..utils.mgf import MGF_EXTENSIONS, is_mgf_file
+from ..utils.mzml import MZML_EXTENSIONS, is_mzml_file
+
+# Separator between files when several files are processed together
+FILES_SEPARATOR = ';'
 
 
 class ProcessMgfDialog(ProcessMgfDialogBase, ProcessMgfDialogUI):
     """Create and open a dialog to process a new .mgf file.
 
     Creates a dialog containing 4 widgets:
-        -file opening widget: to select a .mgf file to process and a .txt meta data file
+        -file opening widget: to select .mgf files to process and a .txt meta data file
         -CosineComputationOptions containing widget: to modify the cosine computation parameters
         -NetworkVisualizationOptions containing widget: to modify the Network visualization parameters
         -TSNEVisualizationOptions containing widget: to modify the TSNE visualization parameters
@@ -52,7 +57,7 @@ class ProcessMgfDialog(ProcessMgfDialogBase, ProcessMgfDialogUI):
             model.setFilter(QDir.AllDirs | QDir.Files | QDir.NoDotAndDotDot)
             if edit == self.editProcessFile:
                 model.setNameFilterDisables(False)
-                model.setNameFilters(['*.mgf'])
+                model.setNameFilters(['*' + ext for ext in MGF_EXTENSIONS + MZML_EXTENSIONS])
             model.setRootPath(QDir.currentPath())
             completer.setModel(model)
             edit.setText(QDir.currentPath())
@@ -113,9 +118,11 @@ class ProcessMgfDialog(ProcessMgfDialogBase, ProcessMgfDialogUI):
 
     def done(self, r):
         if r == QDialog.Accepted:
-            process_file = self.editProcessFile.text()
+            process_files = self.processFiles()
             metadata_file = self.editMetadataFile.text()
-            if len(process_file) > 0 and os.path.exists(process_file) and os.path.splitext(process_file)[1] == '.mgf':
+            if len(process_files) > 0 and all(os.path.exists(process_file)
+                                              and (is_mgf_file(process_file) or is_mzml_file(process_file))
+                                              for process_file in process_files):
                 if not self.gbMetadata.isChecked() or (os.path.exists(metadata_file) and os.path.isfile(metadata_file)):
                     super().done(r)
                 else:
@@ -143,30 +150,38 @@ class ProcessMgfDialog(ProcessMgfDialogBase, ProcessMgfDialogUI):
         self.adjustSize()
 
     def browse(self, type_='process'):
-        """Open a dialog to choose either .mgf or metadata.txt file"""
+        """Open a dialog to choose either .mgf files or metadata.txt file"""
 
         dialog = QFileDialog(self)
-        dialog.setFileMode(QFileDialog.ExistingFile)
+        dialog.setFileMode(QFileDialog.ExistingFiles if type_ == 'process' else QFileDialog.ExistingFile)
 
         if type_ == 'process':
-            dialog.setNameFilters(["MGF Files (*.mgf)", "All files (*.*)"])
+            dialog.setNameFilters([f"MGF Files ({' '.join('*' + ext for ext in MGF_EXTENSIONS)})",
+                                   f"mzML/mzXML Files ({' '.join('*' + ext for ext in MZML_EXTENSIONS)})",
+                                   "All files (*.*)"])
         elif type_ == 'metadata':
             dialog.setNameFilters(["Metadata File (*.csv; *.tsv; *.txt)", "All files (*.*)"])
 
         if dialog.exec_() == QDialog.Accepted:
             filename = dialog.selectedFiles()[0]
             if type_ == 'process':
-                self.editProcessFile.setText(filename)
+                self.editProcessFile.setText(FILES_SEPARATOR.join(dialog.selectedFiles()))
                 self.editProcessFile.setPalette(self.style().standardPalette())
             else:
                 self.editMetadataFile.setText(filename)
                 self.editMetadataFile.setPalette(self.style().standardPalette())
 
+    def processFiles(self):
+        """Returns the list of files to process, separated by `FILES_SEPARATOR` in the edit"""
+
+        return [filename.strip() for filename in self.editProcessFile.text().split(FILES_SEPARATOR)
+                if filename.strip()]
+
     def getValues(self):
         """Returns files to process and options"""
 
         metadata_file = self.editMetadataFile.text() if os.path.isfile(self.editMetadataFile.text()) else None
-        return (self.editProcessFile.text(),
+        return (self.processFiles(),
                 self.gbMetadata.isChecked(),  metadata_file,
                 self._metadata_options, self.cosine_widget.getValues(),
                 self.tsne_widget.getValues(), self.network_widget.getValues())
@@ -5,7 +5,7 @@ import random
 import glob
 
 from PyQt5 import uic
-from PyQt5.QtCore import Qt, QSettings, QPointF
+from PyQt5.QtCore import Qt, QSettings, QPointF, pyqtSignal
 from PyQt5.QtGui import QShowEvent
 from PyQt5.QtWidgets import QDialog, QListWidgetItem
 
@@ -29,6 +29,8 @@ class SettingsDialog(SettingsDialogUI, SettingsDialogBase):
     StyleRole = Qt.UserRole + 1
     CssRole = Qt.UserRole + 2
 
+    neutralToleranceChanged = pyqtSignal(float)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -88,7 +90,11 @@ class SettingsDialog(SettingsDialogUI, SettingsDialogBase):
     def done(self, r):
         if r == QDialog.Accepted:
             settings = QSettings()
-            settings.setValue('Metadata/neutral_tolerance', self.spinNeutralTolerance.value())
+            tolerance = self.spinNeutralTolerance.value()
+            changed = float(settings.value('Metadata/neutral_tolerance', 50)) != tolerance
+            settings.setValue('Metadata/neutral_tolerance', tolerance)
+            if changed:
+                self.neutralToleranceChanged.emit(tolerance)
             settings.setValue('NetworkView/style', self.lstStyles.currentItem().data(SettingsDialog.CssRole))
         super().done(r)
 
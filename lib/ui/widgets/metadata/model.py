@@ -10,6 +10,9 @@ try:
 except (ImportError, FileNotFoundError, IOError, pd.errors.ParserError, pd.errors.EmptyDataError):
     NEUTRAL_LOSSES = None
 
+# Separator between interpretations of a mass difference matching several neutral losses
+INTERPRETATIONS_SEPARATOR = ' ; '
+
 FilterRole = Qt.UserRole + 1
 LabelRole = Qt.UserRole + 2
 StandardsRole = Qt.UserRole + 3
@@ -17,6 +20,48 @@ AnalogsRole = Qt.UserRole + 4
 DbResultsRole = Qt.UserRole + 5
 
 
+def neutral_losses_interpretations(delta_mzs, tolerance):
+    """Find the neutral losses matching the mass difference of each edge.
+
+    A neutral loss matches if the absolute mass difference is within `tolerance` ppm of its mass. Masses of neutral
+    losses are sorted once, and the range of candidate losses of all mass differences is found at once with
+    `numpy.searchsorted` before candidates are checked.
+
+    Returns:
+        numpy.ndarray: origins of matching neutral losses, in the order of `NEUTRAL_LOSSES`, joined with
+            `INTERPRETATIONS_SEPARATOR` for each mass difference.
+    """
+
+    delta_mzs = np.abs(np.asarray(delta_mzs, dtype=np.float64))
+    interpretations = np.full(delta_mzs.size, '', dtype=object)
+    if NEUTRAL_LOSSES is None or delta_mzs.size == 0:
+        return interpretations
+
+    masses = NEUTRAL_LOSSES['Mass difference'].values.astype(np.float64)
+    origins = NEUTRAL_LOSSES['Origin'].values
+    order = np.argsort(masses, kind='mergesort')
+    sorted_masses = masses[order]
+
+    # |d - m| < t.m for m > 0 means d / (1 + t) < m < d / (1 - t), bounds are widened for rounding errors
+    t = tolerance / 10**6
+    lo = np.searchsorted(sorted_masses, delta_mzs / (1 + t) * (1 - 1e-9), side='left')
+    hi = np.searchsorted(sorted_masses, delta_mzs / (1 - t) * (1 + 1e-9), side='right') if t < 1 \
+        else np.full(delta_mzs.size, masses.size)
+    counts = np.maximum(hi - lo, 0)
+    edges = np.repeat(np.arange(delta_mzs.size), counts)
+    losses = order[np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+    d_exp, d_th = delta_mzs[edges], masses[losses]
+    match = np.abs((d_exp - d_th) / d_th) * 10**6 < tolerance
+    edges, losses = edges[match], losses[match]
+
+    order = np.lexsort((losses, edges))
+    edges, losses = edges[order], losses[order]
+    starts = np.flatnonzero(np.r_[True, edges[1:] != edges[:-1]]) if edges.size > 0 else edges
+    for start, stop in zip(starts, np.r_[starts[1:], edges.size]):
+        interpretations[edges[start]] = INTERPRETATIONS_SEPARATOR.join(origins[losses[start:stop]])
+    return interpretations
+
+
 class ProxyModel(QSortFilterProxyModel):
 
     def __init__(self, parent=None):
@@ -221,6 +266,7 @@ class EdgesModel(QAbstractTableModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.interactions = None
+        self._interpretations = None
 
         self.settings = QSettings()
 
@@ -240,8 +286,26 @@ class EdgesModel(QAbstractTableModel):
 
     def endResetModel(self):
         self.interactions = getattr(self.parent().network, 'interactions', None)
+        self._interpretations = None
         super().endResetModel()
 
+    def interpretations(self):
+        """Possible interpretations of the mass difference of each edge, computed for all edges at once on first
+        use."""
+
+        if self._interpretations is None and self.interactions is not None:
+            tolerance = float(self.settings.value('Metadata/neutral_tolerance', 50))
+            self._interpretations = neutral_losses_interpretations(self.interactions['Delta MZ'], tolerance)
+        return self._interpretations
+
+    def invalidateInterpretations(self):
+        """Compute interpretations again on next use, eg. after the neutral losses tolerance changed."""
+
+        self._interpretations = None
+        if self.rowCount() > 0 and NEUTRAL_LOSSES is not None:
+            column = self.columnCount() - 1
+            self.dataChanged.emit(self.index(0, column), self.index(self.rowCount() - 1, column))
+
     def data(self, index, role=Qt.DisplayRole):
         if not index.isValid():
             return
@@ -252,14 +316,8 @@ class EdgesModel(QAbstractTableModel):
             if column == self.columnCount()-1:
                 if role in (FilterRole, LabelRole):
                     return
-                d_exp = abs(self.interactions[row]['Delta MZ'])
-                interpretations = []
                 if NEUTRAL_LOSSES is not None:
-                    for _, r in NEUTRAL_LOSSES.iterrows():
-                        d_th = r['Mass difference']
-                        if abs((d_exp - d_th) / d_th) * 10**6 < self.settings.value('Metadata/neutral_tolerance', 50):
-                            interpretations.append(r['Origin'])
-                    return ' ; '.join(interpretations)
+                    return self.interpretations()[row]
                 else:
                     return
             else:
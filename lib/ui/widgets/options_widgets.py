@@ -16,11 +16,20 @@ class NetworkOptionsWidget(QGroupBox):
         super().__init__()
         uic.loadUi(os.path.join(os.path.dirname(__file__), 'network_options_widget.ui'), self)
 
+        # Populate split method combobox
+        self.cbNetworkSplitMethod.addItem('Weakest edges', 'weakest_edges')
+        self.cbNetworkSplitMethod.addItem('Communities', 'communities')
+        self.cbNetworkSplitMethod.setCurrentIndex(0)
+
+        self.spinNetworkMaxConnectedComponentSize.valueChanged.connect(
+            lambda value: self.cbNetworkSplitMethod.setEnabled(value > 0))
+
     def getValues(self):
         options = NetworkVisualizationOptions()
         options.top_k = self.spinNetworkMaxNeighbor.value()
         options.pairs_min_cosine = self.spinNetworkMinScore.value()
         options.max_connected_nodes = self.spinNetworkMaxConnectedComponentSize.value()
+        options.split_method = self.cbNetworkSplitMethod.currentData()
         return options
 
     def setValues(self, options):
@@ -34,6 +43,8 @@ class NetworkOptionsWidget(QGroupBox):
         self.spinNetworkMaxNeighbor.setValue(options.top_k)
         self.spinNetworkMinScore.setValue(options.pairs_min_cosine)
         self.spinNetworkMaxConnectedComponentSize.setValue(options.max_connected_nodes)
+        index = self.cbNetworkSplitMethod.findData(options.split_method)
+        self.cbNetworkSplitMethod.setCurrentIndex(index if index >= 0 else 0)
 
 
 class TSNEOptionsWidget(QGroupBox):
@@ -85,6 +96,28 @@ class CosineOptionsWidget(QGroupBox):
         super().__init__()
         uic.loadUi(os.path.join(os.path.dirname(__file__), 'cosine_options_widget.ui'), self)
 
+        # Populate scores storage combobox
+        self.cbScoresStorage.addItem('Dense', 'dense')
+        self.cbScoresStorage.addItem('Dense (on disk)', 'memmap')
+        self.cbScoresStorage.addItem('Condensed', 'condensed')
+        self.cbScoresStorage.addItem('Sparse', 'sparse')
+        self.cbScoresStorage.addItem('Top-K neighbours', 'top_k')
+        self.cbScoresStorage.setCurrentIndex(0)
+
+        # Populate filter engine combobox
+        self.cbFilterEngine.addItem('Per spectrum (libmetgem)', 'libmetgem')
+        self.cbFilterEngine.addItem('Vectorized', 'vectorized')
+        self.cbFilterEngine.setCurrentIndex(0)
+
+        self.cbScoresStorage.currentIndexChanged.connect(self.on_scores_storage_changed)
+        self.chkMergeSpectra.toggled.connect(self.spinMergeMinCosine.setEnabled)
+        self.spinApproximateTables.valueChanged.connect(lambda value: self.chkPrunePairs.setEnabled(value <= 0))
+
+    def on_scores_storage_changed(self, index):
+        storage = self.cbScoresStorage.itemData(index)
+        self.spinSparseMinScore.setEnabled(storage in ('sparse', 'top_k'))
+        self.spinNeighboursTopK.setEnabled(storage == 'top_k')
+
     def getValues(self):
         options = CosineComputationOptions()
         options.mz_tolerance = self.spinMZTolerance.value()
@@ -93,6 +126,15 @@ class CosineOptionsWidget(QGroupBox):
         options.min_intensity = self.spinMinIntensity.value()
         options.min_matched_peaks_search = self.spinMinMatchedPeaksSearch.value()
         options.matched_peaks_window = self.spinMatchedPeaksWindow.value()
+        options.scores_storage = self.cbScoresStorage.currentData()
+        options.sparse_min_cosine = self.spinSparseMinScore.value()
+        options.neighbours_top_k = self.spinNeighboursTopK.value()
+        options.approximate_tables = self.spinApproximateTables.value()
+        options.prune_pairs = self.chkPrunePairs.isChecked()
+        options.merge_spectra = self.chkMergeSpectra.isChecked()
+        options.merge_min_cosine = self.spinMergeMinCosine.value()
+        options.filter_engine = self.cbFilterEngine.currentData()
+        options.pipelined = self.chkPipelined.isChecked()
         
         return options
 
@@ -103,6 +145,17 @@ class CosineOptionsWidget(QGroupBox):
         self.spinMinIntensity.setValue(options.min_intensity)
         self.spinMinMatchedPeaksSearch.setValue(options.min_matched_peaks_search)
         self.spinMatchedPeaksWindow.setValue(options.matched_peaks_window)
+        index = self.cbScoresStorage.findData(options.scores_storage)
+        self.cbScoresStorage.setCurrentIndex(index if index >= 0 else 0)
+        self.spinSparseMinScore.setValue(options.sparse_min_cosine)
+        self.spinNeighboursTopK.setValue(options.neighbours_top_k)
+        self.spinApproximateTables.setValue(options.approximate_tables)
+        self.chkPrunePairs.setChecked(options.prune_pairs)
+        self.chkMergeSpectra.setChecked(options.merge_spectra)
+        self.spinMergeMinCosine.setValue(options.merge_min_cosine)
+        index = self.cbFilterEngine.findData(options.filter_engine)
+        self.cbFilterEngine.setCurrentIndex(index if index >= 0 else 0)
+        self.chkPipelined.setChecked(options.pipelined)
 
 
 class QueryDatabasesOptionsWidget(QGroupBox):
@@ -0,0 +1,28 @@
+import os
+import glob
+
+
+def evict_least_recently_used(pattern, max_size):
+    """Remove least recently used files matching `pattern` until their total size is lower than `max_size` bytes.
+
+    Files are considered used when they are modified, so caches should update modification times of files they read.
+    Files that can not be removed, for example because they are still in use, are skipped.
+    """
+
+    files = []
+    for filename in glob.glob(pattern):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, filename))
+
+    size = sum(f[1] for f in files)
+    for _, file_size, filename in sorted(files):
+        if size <= max_size:
+            break
+        try:
+            os.remove(filename)
+        except OSError:  # File may be in use
+            continue
+        size -= file_size
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from libmetgem.cosine import cosine_score
+
+# Name of the metadata column listing the scans merged in each consensus spectrum
+MEMBERS_COLUMN = 'Merged scans'
+
+
+def cluster_spectra(mzs, spectra, mz_tolerance, min_matched_peaks, min_cosine, callback=None):
+    """Group spectra sharing the same parent mass and a very high cosine score.
+
+    Spectra are processed by increasing parent mass. Each spectrum joins the first cluster whose parent mass is within
+    `mz_tolerance` and whose first spectrum has a cosine score of at least `min_cosine` with it, or starts a new
+    cluster.
+
+    Returns:
+        list: for each cluster, an array of the ids of its spectra, ordered by first spectrum id.
+    """
+
+    mzs = np.asarray(mzs, dtype=np.float64)
+    order = np.argsort(mzs, kind='mergesort')
+
+    clusters = []
+    window = []  # Clusters which first spectrum's parent mass is within tolerance of current spectrum's parent mass
+    for count, i in enumerate(order):
+        window = [c for c in window if mzs[i] - mzs[c[0]] <= mz_tolerance]
+        for cluster in window:
+            first = cluster[0]
+            if cosine_score(mzs[first], spectra[first], mzs[i], spectra[i],
+                            mz_tolerance, min_matched_peaks) >= min_cosine:
+                cluster.append(i)
+                break
+        else:
+            cluster = [i]
+            window.append(cluster)
+            clusters.append(cluster)
+
+        if callback is not None and count % 1024 == 0 and not callback(count):
+            return
+
+    clusters = [np.sort(c) for c in clusters]
+    clusters.sort(key=lambda c: c[0])
+    return clusters
+
+
+def consensus_spectrum(spectra, mz_tolerance):
+    """Merge spectra into a single spectrum.
+
+    Peaks of all spectra are grouped when their m/z are within `mz_tolerance` of each other. Groups found in at least
+    half of the spectra are kept, using their intensity-weighted mean m/z and their mean intensity. Intensities are
+    normalized like those of filtered spectra.
+    """
+
+    if len(spectra) == 1:
+        return spectra[0]
+
+    owners = np.repeat(np.arange(len(spectra)), [len(data) for data in spectra])
+    peaks = np.concatenate(spectra).astype(np.float64)
+    if peaks.size == 0:
+        return spectra[0]
+    order = np.argsort(peaks[:, 0], kind='mergesort')
+    peaks, owners = peaks[order], owners[order]
+
+    groups = np.r_[0, np.cumsum(np.diff(peaks[:, 0]) > mz_tolerance)]
+    weights = np.bincount(groups, weights=peaks[:, 1])
+    mzs = np.bincount(groups, weights=peaks[:, 0] * peaks[:, 1]) / np.where(weights > 0, weights, 1)
+    intensities = weights / len(spectra)
+    support = np.bincount(np.unique(groups * len(spectra) + owners) // len(spectra), minlength=weights.size)
+
+    keep = support * 2 >= len(spectra)
+    data = np.stack((mzs[keep], intensities[keep]), axis=1).astype(np.float32)
+    norm = np.sqrt(data[:, 1] @ data[:, 1])
+    if norm > 0:
+        data[:, 1] /= norm
+    return data
+
+
+def merge_spectra(mzs, spectra, mz_tolerance, min_matched_peaks, min_cosine, callback=None):
+    """Replace groups of near-identical spectra by consensus spectra, see `cluster_spectra` and `consensus_spectrum`.
+
+    Returns:
+        tuple: parent masses and spectra of consensus spectra, and for each of them the array of ids of original
+            spectra merged into it.
+    """
+
+    members = cluster_spectra(mzs, spectra, mz_tolerance, min_matched_peaks, min_cosine, callback=callback)
+    if members is None:
+        return
+
+    mzs = np.asarray(mzs, dtype=np.float64)
+    consensus_mzs = [float(mzs[ids].mean()) for ids in members]
+    consensus_spectra = [consensus_spectrum([spectra[i] for i in ids], mz_tolerance) for ids in members]
+    return consensus_mzs, consensus_spectra, members
+
+
+def members_infos(members, infos=None):
+    """Collapse metadata of original spectra to one row for each consensus spectrum.
+
+    Each consensus spectrum gets the metadata of its first member, with a column listing the (1-based) numbers of
+    scans merged into it.
+    """
+
+    first = [ids[0] for ids in members]
+    if infos is None:
+        infos = pd.DataFrame(index=pd.RangeIndex(len(members)))
+    else:
+        infos = infos.reset_index(drop=True).reindex(first).reset_index(drop=True)
+    infos[MEMBERS_COLUMN] = members_column(members)
+    return infos
+
+
+def members_column(members):
+    """Format the (1-based) numbers of scans merged into each consensus spectrum."""
+
+    return [', '.join(str(i + 1) for i in ids) for ids in members]
+
+
+def append_members(members, num_nodes, new_members, num_new_nodes):
+    """Concatenate the members of appended spectra to the members of the spectra already in a project.
+
+    Either of `members` and `new_members` may be None if spectra were not merged, in which case each spectrum is its
+    own member.
+
+    Returns:
+        list: The members of all spectra or None if neither of them were merged.
+    """
+
+    if members is None and new_members is None:
+        return
+    if members is None:
+        members = [np.array([i]) for i in range(num_nodes)]
+    if new_members is None:
+        new_members = [np.array([i]) for i in range(num_new_nodes)]
+    num_scans = sum(len(ids) for ids in members)
+    return list(members) + [ids + num_scans for ids in new_members]
@@ -0,0 +1,849 @@
+import math
+import collections
+import multiprocessing
+
+import numpy as np
+import scipy.sparse as sp
+
+from .scores import create_memmap, iter_row_blocks, CondensedScores
+from .spectra import SpectraStore, concatenate_spectra
+
+from libmetgem.cosine import compute_distance_matrix, cosine_score
+
+# Number of spectra on each side of a tile of the scores matrix
+TILE_SIZE = 1024
+
+# Number of spectra processed at once when searching candidate pairs
+CANDIDATES_BLOCK_SIZE = 1024
+
+# Number of candidate pairs scored in a single task when using worker processes
+PAIRS_CHUNK_SIZE = 65536
+
+# Number of spectra in each block when spectra are scored while being read, see `BlockScores`
+PIPELINE_BLOCK_SIZE = 2048
+
+# Minimum ratio between the number of candidate pairs of a tile and the number of pairs scored by
+# `libmetgem.cosine.compute_distance_matrix` for the same tile for the native kernel to be used instead of scoring
+# pairs one by one, as a native call costs much less per pair than a call to `libmetgem.cosine.cosine_score`
+NATIVE_MIN_DENSITY = 0.1
+
+# Margin added to the m/z tolerance when binning peaks, so that rounding errors can not hide a match
+BIN_WIDTH_MARGIN = 1e-3
+
+# Spectra shared with worker processes, set by `_init_shared_spectra`
+_shared_spectra = None
+
+
+def iter_tiles(num_spectra, tile_size=TILE_SIZE, start=0):
+    """Iterate over the tiles covering the upper triangle of a `num_spectra`×`num_spectra` scores matrix.
+
+    Args:
+        start (int): Only tiles of columns from `start` are generated, ie. scores between the first `start` spectra
+            are skipped.
+
+    Yields:
+        tuple of slices: rows and columns of the tile. Diagonal tiles have the same rows and columns.
+    """
+
+    # Rows are split at `start` so that tiles never overlap the diagonal without being diagonal tiles
+    row_starts = list(range(0, start, tile_size)) + list(range(start, num_spectra, tile_size))
+    for row_start in row_starts:
+        rows = slice(row_start, min(row_start + tile_size, start if row_start < start else num_spectra))
+        for col_start in range(max(row_start, start), num_spectra, tile_size):
+            yield rows, slice(col_start, min(col_start + tile_size, num_spectra))
+
+
+def tile_pairs_count(rows, cols):
+    """Number of pairs of spectra scored in a tile."""
+
+    num_rows = rows.stop - rows.start
+    if rows == cols:
+        return num_rows * (num_rows - 1) // 2
+    return num_rows * (cols.stop - cols.start)
+
+
+def compute_block(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks, num_pairs=None,
+                  callback=None):
+    """Compute cosine scores between spectra of `rows_ids` and spectra of `cols_ids` with a single native call.
+
+    `libmetgem.cosine.compute_distance_matrix` only computes symmetric matrices, so it is run on the spectra of both
+    the rows and the columns (each spectrum only once), and the requested block is taken from the result.
+
+    Args:
+        rows_ids, cols_ids (numpy.ndarray): sorted ids of spectra.
+        num_pairs (int): Number of pairs reported to `callback` for the whole block, the number of pairs computed by
+            the native call if None.
+        callback: see `compute_tile`.
+
+    Returns:
+        A `len(rows_ids)`×`len(cols_ids)` float32 array, or None if computation was stopped.
+    """
+
+    ids = np.union1d(rows_ids, cols_ids)
+    total = ids.size * (ids.size - 1) // 2
+    num_pairs = total if num_pairs is None else num_pairs
+    stopped = False
+    done = reported = 0
+
+    def block_callback(value):
+        nonlocal stopped, done, reported
+        done += value
+        count = num_pairs * done // max(1, total)
+        stopped = not callback(count - reported)
+        reported = count
+        return not stopped
+
+    matrix = compute_distance_matrix([mzs[i] for i in ids], [spectra[i] for i in ids], mz_tolerance,
+                                     min_matched_peaks, callback=block_callback if callback is not None else None)
+    if stopped or (callback is not None and reported < num_pairs and not callback(num_pairs - reported)):
+        return
+
+    return matrix[np.ix_(np.searchsorted(ids, rows_ids), np.searchsorted(ids, cols_ids))]
+
+
+def compute_tile(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks, callback=None):
+    """Compute cosine scores between spectra selected by `rows` and spectra selected by `cols`.
+
+    `callback` follows the same protocol as in `libmetgem.cosine.compute_distance_matrix`: it receives the number of
+    pairs computed since last call and should return False to stop computation.
+
+    Returns:
+        A `len(rows)`×`len(cols)` float32 array, or None if computation was stopped.
+    """
+
+    stopped = False
+
+    def tile_callback(value):
+        nonlocal stopped
+        stopped = not callback(value)
+        return not stopped
+
+    if rows == cols:
+        # Diagonal tile: let libmetgem compute the whole symmetric block
+        tile = compute_distance_matrix(mzs[rows], list(spectra[rows]), mz_tolerance, min_matched_peaks,
+                                       callback=tile_callback if callback is not None else None)
+        return tile if not stopped else None
+
+    return compute_block(mzs, spectra, np.arange(rows.start, rows.stop), np.arange(cols.start, cols.stop),
+                         mz_tolerance, min_matched_peaks, num_pairs=tile_pairs_count(rows, cols), callback=callback)
+
+
+def sparsify_tile(tile, rows, cols, min_cosine):
+    """Get coordinates in the full matrix and values of scores of a tile that are above or equal to `min_cosine`."""
+
+    r, c = np.nonzero((tile >= min_cosine) & (tile > 0))
+    return r + rows.start, c + cols.start, tile[r, c]
+
+
+def _bins_incidence(values, owners, num_spectra, bin_width):
+    """Count values of each spectrum falling in each bin of width `bin_width`.
+
+    Returns:
+        tuple: spectra×bins count matrix, and the same matrix with each count also added to both neighbouring bins.
+            Two values closer than `bin_width` always fall in the same or in neighbouring bins.
+    """
+
+    bins = np.floor(values / bin_width).astype(np.int64)
+    bins -= bins.min() - 1  # Leave room for the left neighbour of the first bin
+    shape = (num_spectra, int(bins.max()) + 2)
+    ones = np.ones(bins.size, dtype=np.int32)
+
+    incidence = sp.csr_matrix((ones, (owners, bins)), shape=shape)
+    spread = sp.csr_matrix((np.tile(ones, 3), (np.tile(owners, 3), np.concatenate((bins - 1, bins, bins + 1)))),
+                           shape=shape)
+    return incidence, spread
+
+
+def find_candidate_pairs(mzs, spectra, mz_tolerance, min_matched_peaks, start=0):
+    """Find pairs of spectra that may have a non-zero cosine score.
+
+    Fragments m/z and neutral losses (parent mass minus fragment m/z) are binned with a width of `mz_tolerance`,
+    which gives an inverted index from bins to spectra. Counting peaks of two spectra that fall in the same or in
+    neighbouring bins gives an upper bound of the number of peaks that can be matched by the modified cosine, either
+    directly or after a shift by the parent masses difference. Pairs for which this bound is lower than
+    `min_matched_peaks` always have a score of zero.
+
+    Args:
+        start (int): Only pairs involving at least one spectrum from `start` are searched, see `iter_tiles`.
+
+    Returns:
+        tuple: two arrays of spectra ids, sorted by row, describing candidate pairs in the upper triangle of the
+            scores matrix (diagonal excluded).
+    """
+
+    num_spectra = len(spectra)
+    min_matched_peaks = max(1, min_matched_peaks)  # Pairs without any matched peak are always zero
+    peaks, offsets = concatenate_spectra(spectra)
+    sizes = np.diff(offsets)
+    if sizes.sum() == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    owners = np.repeat(np.arange(num_spectra), sizes)
+    fragments = np.asarray(peaks[offsets[0]:offsets[-1], 0], dtype=np.float64)
+    losses = np.repeat(np.asarray(mzs, dtype=np.float64), sizes) - fragments
+    bin_width = mz_tolerance + BIN_WIDTH_MARGIN
+    eligible = sizes >= min_matched_peaks  # A peak can only be matched once
+
+    indexes = []
+    for values in (fragments, losses):
+        incidence, spread = _bins_incidence(values, owners, num_spectra, bin_width)
+        indexes.append((incidence, spread[start:].T.tocsr()))
+
+    rows_ids, cols_ids = [], []
+    for block_start in range(0, num_spectra, CANDIDATES_BLOCK_SIZE):
+        block_stop = min(block_start + CANDIDATES_BLOCK_SIZE, num_spectra)
+        counts = sum(incidence[block_start:block_stop] @ spread for incidence, spread in indexes)
+        counts = sp.triu(counts, k=block_start-start+1, format='coo')
+        rows, cols = counts.row.astype(np.int64) + block_start, counts.col.astype(np.int64) + start
+        mask = (counts.data >= min_matched_peaks) & eligible[rows] & eligible[cols]
+        order = np.lexsort((cols[mask], rows[mask]))
+        rows_ids.append(rows[mask][order])
+        cols_ids.append(cols[mask][order])
+
+    if not rows_ids:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(rows_ids), np.concatenate(cols_ids)
+
+
+def compute_pairs(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks, callback=None):
+    """Compute cosine scores of pairs of spectra given by `rows_ids` and `cols_ids`.
+
+    Pairs are grouped by tiles of `TILE_SIZE`×`TILE_SIZE` spectra. Tiles dense enough in pairs, compared to the pairs
+    between the spectra they involve (see `NATIVE_MIN_DENSITY`), are scored with `compute_block`, other pairs are
+    scored one by one.
+
+    Returns:
+        A float32 array of scores, or None if computation was stopped. See `compute_tile` for `callback`.
+    """
+
+    rows_ids, cols_ids = np.asarray(rows_ids), np.asarray(cols_ids)
+    scores = np.zeros(len(rows_ids), dtype=np.float32)
+    if len(rows_ids) == 0:
+        return scores
+
+    tiles = (rows_ids // TILE_SIZE) * (len(spectra) // TILE_SIZE + 1) + cols_ids // TILE_SIZE
+    order = np.argsort(tiles, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(tiles[order])) + 1
+    for pairs in np.split(order, bounds):
+        rows_block, cols_block = np.unique(rows_ids[pairs]), np.unique(cols_ids[pairs])
+        num_ids = np.union1d(rows_block, cols_block).size
+        if pairs.size >= NATIVE_MIN_DENSITY * num_ids * (num_ids - 1) // 2:
+            block = compute_block(mzs, spectra, rows_block, cols_block, mz_tolerance, min_matched_peaks,
+                                  num_pairs=pairs.size, callback=callback)
+            if block is None:
+                return
+            scores[pairs] = block[np.searchsorted(rows_block, rows_ids[pairs]),
+                                  np.searchsorted(cols_block, cols_ids[pairs])]
+            continue
+
+        for start in range(0, pairs.size, TILE_SIZE):
+            chunk = pairs[start:start+TILE_SIZE]
+            for k in chunk:
+                i, j = rows_ids[k], cols_ids[k]
+                scores[k] = cosine_score(mzs[i], spectra[i], mzs[j], spectra[j], mz_tolerance, min_matched_peaks)
+
+            if callback is not None and not callback(chunk.size):
+                return
+
+    return scores
+
+
+class TopKNeighbours:
+    """Keep the `k` best scores of each row of the upper triangle (diagonal excluded) of a scores matrix while scores
+    are streamed in, so that memory usage is proportional to the number of rows instead of the size of the matrix.
+    Scores of the diagonal are kept apart, so that they do not take the place of a neighbour.
+
+    As with `sparsify_tile`, only scores above or equal to `min_cosine` and greater than zero are kept. As in network
+    generation, ties are broken in favour of the highest column index.
+    """
+
+    def __init__(self, num_rows, k, min_cosine=0.):
+        self.k = k
+        self.min_cosine = min_cosine
+        self.scores = np.full((num_rows, k), -np.inf, dtype=np.float32)
+        self.cols = np.full((num_rows, k), -1, dtype=np.int64)
+        self.diagonal = np.zeros(num_rows, dtype=np.float32)
+
+    def resize(self, num_rows):
+        """Add empty rows so that the matrix has `num_rows` rows."""
+
+        missing = num_rows - self.scores.shape[0]
+        if missing > 0:
+            self.scores = np.concatenate((self.scores, np.full((missing, self.k), -np.inf, dtype=np.float32)))
+            self.cols = np.concatenate((self.cols, np.full((missing, self.k), -1, dtype=np.int64)))
+            self.diagonal = np.concatenate((self.diagonal, np.zeros(missing, dtype=np.float32)))
+
+    def add(self, rows_ids, cols_ids, values):
+        """Add scores of pairs given by `rows_ids` and `cols_ids`. Pairs outside of the upper triangle are ignored."""
+
+        mask = (values >= self.min_cosine) & (values > 0)
+        diagonal = mask & (cols_ids == rows_ids)
+        self.diagonal[rows_ids[diagonal]] = values[diagonal]
+        mask &= cols_ids > rows_ids
+        rows_ids, cols_ids, values = rows_ids[mask], cols_ids[mask], values[mask]
+        if rows_ids.size == 0:
+            return
+
+        # Keep at most `k` scores for each row before merging with scores already kept
+        order = np.lexsort((-cols_ids, -values, rows_ids))
+        rows_ids, cols_ids, values = rows_ids[order], cols_ids[order], values[order]
+        starts = np.flatnonzero(np.r_[True, rows_ids[1:] != rows_ids[:-1]])
+        counts = np.diff(np.r_[starts, rows_ids.size])
+        groups = np.repeat(np.arange(starts.size), counts)
+        ranks = np.arange(rows_ids.size) - starts[groups]
+        keep = ranks < self.k
+
+        rows = rows_ids[starts]
+        new_scores = np.full((rows.size, self.k), -np.inf, dtype=np.float32)
+        new_scores[groups[keep], ranks[keep]] = values[keep]
+        new_cols = np.full((rows.size, self.k), -1, dtype=np.int64)
+        new_cols[groups[keep], ranks[keep]] = cols_ids[keep]
+
+        scores = np.concatenate((self.scores[rows], new_scores), axis=1)
+        cols = np.concatenate((self.cols[rows], new_cols), axis=1)
+        order = np.lexsort((-cols, -scores), axis=1)[:, :self.k]
+        self.scores[rows] = np.take_along_axis(scores, order, axis=1)
+        self.cols[rows] = np.take_along_axis(cols, order, axis=1)
+
+    def tocsr(self):
+        """Get kept scores as a symmetric `scipy.sparse.csr_matrix`."""
+
+        num_rows = self.scores.shape[0]
+        valid = np.isfinite(self.scores)
+        rows_ids = np.repeat(np.arange(num_rows), self.k).reshape(num_rows, self.k)[valid]
+        cols_ids = self.cols[valid]
+        values = self.scores[valid]
+        diagonal = np.flatnonzero(self.diagonal)
+        return sp.csr_matrix((np.concatenate((values, values, self.diagonal[diagonal])),
+                              (np.concatenate((rows_ids, cols_ids, diagonal)),
+                               np.concatenate((cols_ids, rows_ids, diagonal)))),
+                             shape=(num_rows, num_rows), dtype=np.float32)
+
+
+def score_blocks(first, second, mz_tolerance, min_matched_peaks, prune_pairs=False, min_cosine=0.):
+    """Compute cosine scores between two blocks of spectra, or between spectra of a single block if `second` is None.
+
+    Args:
+        first (SpectraStore): spectra of the rows.
+        second (SpectraStore): spectra of the columns.
+        prune_pairs (bool): If True, only pairs returned by `find_candidate_pairs` are scored.
+        min_cosine (float): Only scores above or equal to `min_cosine` and greater than zero are returned.
+
+    Returns:
+        tuple: rows, columns (relative to the start of each block) and values of scores, as `sparsify_tile`. Scores
+            of a single block cover the whole symmetric tile.
+    """
+
+    num_rows = len(first)
+    spectra = first if second is None else SpectraStore.concatenate([first, second])
+    rows = slice(0, num_rows)
+    cols = rows if second is None else slice(num_rows, len(spectra))
+    mzs = spectra.mzs.tolist()
+
+    if prune_pairs:
+        rows_ids, cols_ids = find_candidate_pairs(mzs, spectra, mz_tolerance, min_matched_peaks, start=cols.start)
+        mask = rows_ids < rows.stop
+        rows_ids, cols_ids = rows_ids[mask], cols_ids[mask]
+        tile = np.zeros((rows.stop, cols.stop - cols.start), dtype=np.float32)
+        values = compute_pairs(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks)
+        tile[rows_ids, cols_ids - cols.start] = values
+        if second is None:
+            tile[cols_ids, rows_ids] = values
+            np.fill_diagonal(tile, 1)
+    else:
+        tile = compute_tile(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks)
+
+    r, c, v = sparsify_tile(tile, rows, cols, min_cosine)
+    return r, c - cols.start, v
+
+
+def _score_shared_blocks_task(task):
+    """Compute scores between two blocks of the spectra shared with the worker process, see `BlockScores`."""
+
+    rows, cols, mz_tolerance, min_matched_peaks, prune_pairs, min_cosine = task
+    _, spectra = _shared_spectra
+    return score_blocks(spectra[rows], spectra[cols] if cols != rows else None, mz_tolerance, min_matched_peaks,
+                        prune_pairs, min_cosine)
+
+
+class BlockScores:
+    """Compute cosine scores between spectra added block by block, so that scoring can start while the following
+    spectra are still being read.
+
+    Each added block is scored against itself and against all the blocks added before it. If `processes` is greater than
+    1, these tiles are scored in the background by a pool of worker processes and `collect` gathers finished tiles,
+    otherwise they are scored as soon as the block is added. Blocks are sent to worker processes only once, by copying
+    them to shared memory buffers. When buffers are full, all blocks are copied to buffers twice as large, which are
+    given to a new pool of worker processes while the previous pool finishes its tiles.
+
+    If `num_spectra` is given and `storage` is dense, memmap or condensed, the scores matrix is created at once and the
+    scores of each tile are written to it as soon as the tile is gathered. Otherwise, since the number of spectra is
+    not known before the last block is added, only non-zero scores (or scores above `min_cosine` for sparse and top-K
+    storages) are kept until `result` builds the scores matrix, which for exact storages needs several times the
+    memory of the matrix itself.
+
+    If a `ScoresCache` is given as `cache`, scores of each tile are taken from it when both blocks were already scored
+    against each other with the same `options`, and are added to it otherwise. Adding a block to blocks that were all
+    scored before thus only scores the tiles of the new block.
+
+    Args:
+        storage (str): see `compute_scores`.
+        prune_pairs (bool): see `score_blocks`.
+        options (dict): options used to compute the keys of tiles in `cache`.
+        num_spectra (int): total number of spectra that will be added, if known.
+    """
+
+    def __init__(self, mz_tolerance, min_matched_peaks, storage='dense', min_cosine=0., top_k=10, prune_pairs=False,
+                 processes=1, cache=None, options=None, num_spectra=None):
+        self.mz_tolerance = mz_tolerance
+        self.min_matched_peaks = min_matched_peaks
+        self.storage = storage
+        self.min_cosine = min_cosine if storage in ('sparse', 'top_k') else 0.
+        self.prune_pairs = prune_pairs
+        self.processes = processes
+
+        self.blocks = []
+        self.offsets = [0]
+        self.cached_pairs = 0  # Number of pairs of spectra in tiles taken from the cache
+        self.submitted_pairs = 0  # Number of pairs of spectra in tiles of all added blocks, including pruned pairs
+        self.scored_pairs = 0  # Number of pairs of spectra in tiles already scored, including pruned pairs
+
+        self._pool = None
+        self._closed_pools = []
+        self._shared = None
+        self._num_peaks = 0
+        self._pending = collections.deque()
+        self._cache = cache
+        self._options = options
+        self._keys = []
+        self._neighbours = TopKNeighbours(0, top_k, min_cosine) if storage == 'top_k' else None
+        self._scores = None
+        if num_spectra is not None and storage in ('dense', 'memmap', 'condensed'):
+            self._scores = _zeros_scores(num_spectra, storage)
+        self._rows_ids, self._cols_ids, self._values = [], [], []
+
+    @property
+    def num_spectra(self):
+        return self.offsets[-1]
+
+    @property
+    def pending(self):
+        """Number of tiles not scored yet."""
+
+        return len(self._pending)
+
+    def add(self, block):
+        """Add a `SpectraStore` and submit the scoring of its tiles."""
+
+        if self._scores is not None and self.num_spectra + len(block) > self._scores.shape[0]:
+            raise ValueError('More spectra added than the number of spectra given')
+
+        index = len(self.blocks)
+        self.blocks.append(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+        self._keys.append(self._cache.key(block.mzs, block, self._options) if self._cache is not None else None)
+        if self.processes > 1:
+            self._share(block)
+        if self._neighbours is not None:
+            self._neighbours.resize(self.num_spectra)
+
+        cols = slice(self.offsets[index], self.offsets[index+1])
+        for i, first in enumerate(self.blocks):
+            rows = slice(self.offsets[i], self.offsets[i+1])
+            self.submitted_pairs += tile_pairs_count(rows, cols)
+
+            key = None
+            if self._cache is not None:
+                key = self._cache.pair_key(self._keys[i], self._keys[index])
+                tile = self._cache.get(key)
+                if tile is not None:
+                    tile = tile.tocoo()
+                    self.cached_pairs += tile_pairs_count(rows, cols)
+                    self._add_result(rows, cols, (tile.row, tile.col, tile.data))
+                    continue
+
+            if self._pool is not None:
+                task = (rows, cols, self.mz_tolerance, self.min_matched_peaks, self.prune_pairs, self.min_cosine)
+                self._pending.append((rows, cols, key, self._pool.apply_async(_score_shared_blocks_task, (task,))))
+            else:
+                self._add_result(rows, cols, score_blocks(first, block if i != index else None, self.mz_tolerance,
+                                                          self.min_matched_peaks, self.prune_pairs, self.min_cosine),
+                                 key)
+
+    def _share(self, block):
+        """Copy the last added block to the spectra shared with worker processes, starting a new pool of worker
+        processes with larger buffers if it does not fit."""
+
+        start = self.offsets[-2]
+        self._num_peaks += int(block.offsets[-1] - block.offsets[0])
+        if self._shared is not None and len(self._shared[0]) >= self.num_spectra \
+                and len(self._shared[1]) >= 2 * self._num_peaks:
+            _append_shared_spectra(self._shared, start, block.mzs, block)
+            return
+
+        if self._pool is not None:
+            self._pool.close()
+            self._closed_pools.append(self._pool)
+        spectra = SpectraStore.concatenate(self.blocks)
+        self._shared = _share_spectra(spectra.mzs, spectra, 2 * self.num_spectra, 2 * self._num_peaks)
+        self._pool = multiprocessing.Pool(self.processes, initializer=_init_shared_spectra, initargs=self._shared)
+
+    def collect(self, max_pending=0, wait=True):
+        """Gather scores of finished tiles.
+
+        Args:
+            max_pending (int): Wait for tiles to be scored until there are at most `max_pending` tiles left.
+            wait (bool): If False, only tiles that are already scored are gathered, whatever `max_pending`.
+        """
+
+        while self._pending:
+            rows, cols, key, result = self._pending[0]
+            if not result.ready() and (not wait or len(self._pending) <= max_pending):
+                break
+            self._pending.popleft()
+            self._add_result(rows, cols, result.get(), key)
+
+    def _add_result(self, rows, cols, result, key=None):
+        r, c, v = result
+        if key is not None:
+            self._cache.put(key, sp.csr_matrix((v, (r, c)), shape=(rows.stop - rows.start, cols.stop - cols.start),
+                                               dtype=np.float32))
+        r, c = r.astype(np.int64) + rows.start, c.astype(np.int64) + cols.start
+        self.scored_pairs += tile_pairs_count(rows, cols)
+        if self._neighbours is not None:
+            self._neighbours.add(r, c, v)
+        elif self._scores is not None:
+            if self.storage == 'condensed':
+                mask = r <= c
+                self._scores[r[mask], c[mask]] = v[mask]
+            else:
+                self._scores[r, c] = v
+                self._scores[c, r] = v
+        else:
+            # Only keep the upper triangle, the matrix is made symmetric in `result`
+            mask = r <= c
+            self._rows_ids.append(r[mask])
+            self._cols_ids.append(c[mask])
+            self._values.append(v[mask])
+
+    def close(self):
+        """Stop worker processes."""
+
+        for pool in self._closed_pools + [self._pool]:
+            if pool is not None:
+                pool.terminate()
+        self._pool = None
+        self._closed_pools = []
+        self._shared = None
+
+    def result(self):
+        """Wait for all tiles to be scored and build the scores matrix, see `compute_scores`."""
+
+        self.collect()
+        self.close()
+
+        num_spectra = self.num_spectra
+        if self._neighbours is not None:
+            return self._neighbours.tocsr()
+
+        if self._scores is not None:
+            scores, self._scores = self._scores, None
+            if num_spectra != scores.shape[0]:
+                raise ValueError('Less spectra added than the number of spectra given')
+            if self.storage == 'memmap':
+                scores.flush()
+            return scores
+
+        if self._values:
+            rows_ids, cols_ids = np.concatenate(self._rows_ids), np.concatenate(self._cols_ids)
+            values = np.concatenate(self._values)
+        else:
+            rows_ids = cols_ids = np.array([], dtype=np.int64)
+            values = np.array([], dtype=np.float32)
+        self._rows_ids, self._cols_ids, self._values = [], [], []
+
+        if self.storage == 'sparse':
+            mirror = rows_ids != cols_ids
+            return sp.csr_matrix((np.concatenate((values, values[mirror])),
+                                  (np.concatenate((rows_ids, cols_ids[mirror])),
+                                   np.concatenate((cols_ids, rows_ids[mirror])))),
+                                 shape=(num_spectra, num_spectra), dtype=np.float32)
+        elif self.storage == 'condensed':
+            scores = CondensedScores.zeros(num_spectra)
+            scores[rows_ids, cols_ids] = values
+            return scores
+
+        scores = _zeros_scores(num_spectra, self.storage)
+        scores[rows_ids, cols_ids] = values
+        scores[cols_ids, rows_ids] = values
+        if self.storage == 'memmap':
+            scores.flush()
+        return scores
+
+
+def _share_spectra(mzs, spectra, capacity=0, peaks_capacity=0):
+    """Copy parent masses and spectra to shared memory buffers that can be passed to worker processes.
+
+    Args:
+        capacity (int): Minimum number of spectra buffers can hold, so that spectra can be appended with
+            `_append_shared_spectra`.
+        peaks_capacity (int): Minimum number of peaks buffers can hold.
+    """
+
+    data, offsets = concatenate_spectra(spectra)
+    dtype = np.dtype(np.float64) if data.dtype == np.float64 else np.dtype(np.float32)
+    capacity = max(len(mzs), capacity)
+    peaks_capacity = max(int(offsets[-1] - offsets[0]), peaks_capacity)
+
+    shared = (multiprocessing.RawArray('d', capacity),
+              multiprocessing.RawArray('f' if dtype == np.float32 else 'd', peaks_capacity * 2),
+              multiprocessing.RawArray('q', capacity + 1),
+              dtype.str)
+    _append_shared_spectra(shared, 0, mzs, spectra)
+    return shared
+
+
+def _append_shared_spectra(shared, start, mzs, spectra):
+    """Copy parent masses and spectra to shared memory buffers created by `_share_spectra`, after the first `start`
+    spectra."""
+
+    shared_mzs, shared_peaks, shared_offsets, dtype = shared
+    data, offsets = concatenate_spectra(spectra)
+    shared_offsets = np.frombuffer(shared_offsets, dtype=np.int64)
+    first, stop = shared_offsets[start], start + len(mzs)
+
+    np.frombuffer(shared_mzs, dtype=np.float64)[start:stop] = mzs
+    shared_offsets[start+1:stop+1] = offsets[1:] - offsets[0] + first
+    np.frombuffer(shared_peaks, dtype=dtype).reshape(-1, 2)[first:shared_offsets[stop]] = data[offsets[0]:offsets[-1]]
+
+
+def _init_shared_spectra(mzs, peaks, offsets, dtype):
+    """Initialize a worker process with spectra stored in shared memory."""
+
+    global _shared_spectra
+
+    mzs = np.frombuffer(mzs, dtype=np.float64)
+    _shared_spectra = (mzs.tolist(), SpectraStore(mzs, np.frombuffer(peaks, dtype=dtype).reshape(-1, 2),
+                                                  np.frombuffer(offsets, dtype=np.int64)))
+
+
+def _compute_shared_tile(task):
+    """Compute a tile from spectra shared with the worker process."""
+
+    rows, cols, mz_tolerance, min_matched_peaks, min_cosine = task
+    mzs, spectra = _shared_spectra
+    tile = compute_tile(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks)
+    if min_cosine is not None:
+        tile = sparsify_tile(tile, rows, cols, min_cosine)
+    return rows, cols, tile
+
+
+def _compute_shared_pairs(task):
+    """Compute scores of candidate pairs from spectra shared with the worker process."""
+
+    rows_ids, cols_ids, mz_tolerance, min_matched_peaks = task
+    mzs, spectra = _shared_spectra
+    return rows_ids, cols_ids, compute_pairs(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks)
+
+
+def iter_computed_pairs(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks, processes=1,
+                        callback=None):
+    """Compute scores of candidate pairs by chunks, see `iter_computed_tiles`.
+
+    Yields:
+        tuple: rows, columns and scores of computed pairs. Iteration stops early if computation was stopped.
+    """
+
+    if processes <= 1:
+        scores = compute_pairs(mzs, spectra, rows_ids, cols_ids, mz_tolerance, min_matched_peaks, callback=callback)
+        if scores is not None:
+            yield rows_ids, cols_ids, scores
+        return
+
+    chunk_size = max(1, min(PAIRS_CHUNK_SIZE, math.ceil(len(rows_ids) / (4 * processes))))
+    tasks = [(rows_ids[start:start+chunk_size], cols_ids[start:start+chunk_size], mz_tolerance, min_matched_peaks)
+             for start in range(0, len(rows_ids), chunk_size)]
+
+    with multiprocessing.Pool(processes, initializer=_init_shared_spectra,
+                              initargs=_share_spectra(mzs, spectra)) as pool:
+        for r, c, scores in pool.imap_unordered(_compute_shared_pairs, tasks):
+            if callback is not None and not callback(len(r)):
+                return
+            yield r, c, scores
+
+
+def iter_computed_tiles(mzs, spectra, mz_tolerance, min_matched_peaks, min_cosine=None, processes=1, start=0,
+                        callback=None):
+    """Compute all the tiles of the upper triangle of the scores matrix.
+
+    If `processes` is greater than 1, tiles are distributed to a pool of worker processes. Tiles are then made
+    smaller so that work is balanced between processes, and are submitted from the most to the least expensive.
+    Spectra are sent to worker processes only once, through shared memory.
+
+    Args:
+        min_cosine (float): If not None, tiles are reduced with `sparsify_tile` before being yielded.
+        processes (int): Number of worker processes.
+        start (int): see `iter_tiles`.
+        callback: see `compute_tile`. When using worker processes, it is called each time a tile is completed.
+
+    Yields:
+        tuple: rows, columns and content of computed tiles. Iteration stops early if computation was stopped.
+    """
+
+    num_spectra = len(spectra)
+
+    if processes <= 1:
+        for rows, cols in iter_tiles(num_spectra, start=start):
+            tile = compute_tile(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks, callback=callback)
+            if tile is None:
+                return
+            yield rows, cols, sparsify_tile(tile, rows, cols, min_cosine) if min_cosine is not None else tile
+        return
+
+    tile_size = max(16, min(TILE_SIZE, math.ceil((num_spectra - start) / (4 * processes))))
+    tasks = [(rows, cols, mz_tolerance, min_matched_peaks, min_cosine)
+             for rows, cols in iter_tiles(num_spectra, tile_size, start=start)]
+    tasks.sort(key=lambda t: tile_pairs_count(t[0], t[1]), reverse=True)
+
+    with multiprocessing.Pool(processes, initializer=_init_shared_spectra,
+                              initargs=_share_spectra(mzs, spectra)) as pool:
+        for rows, cols, tile in pool.imap_unordered(_compute_shared_tile, tasks):
+            if callback is not None and not callback(tile_pairs_count(rows, cols)):
+                return
+            yield rows, cols, tile
+
+
+def _zeros_scores(num_spectra, storage):
+    """Create a scores matrix filled with zeros for 'dense', 'memmap' or 'condensed' storage."""
+
+    if storage == 'condensed':
+        return CondensedScores.zeros(num_spectra)
+    elif storage == 'memmap':
+        return create_memmap((num_spectra, num_spectra))  # New files are filled with zeros
+    return np.zeros((num_spectra, num_spectra), dtype=np.float32)
+
+
+def compute_scores(mzs, spectra, mz_tolerance, min_matched_peaks, storage='dense', min_cosine=0., top_k=10,
+                   processes=1, candidates=None, previous=None, callback=None):
+    """Compute cosine scores between all pairs of spectra.
+
+    Args:
+        storage (str): 'dense', 'memmap', 'sparse', 'condensed' or 'top_k'. See
+            `CosineComputationOptions.scores_storage`.
+        min_cosine (float): Minimum score of pairs kept when using sparse or top-K storage.
+        top_k (int): Number of scores kept for each spectrum when using top-K storage, see `TopKNeighbours`.
+        processes (int): Number of worker processes, see `iter_computed_tiles`.
+        candidates (tuple): If not None, only pairs returned by `find_candidate_pairs` are scored and all other
+            pairs are set to zero.
+        previous: If not None, scores matrix of the first spectra, stored as described by `storage`. Scores between
+            these spectra are copied instead of being computed again.
+        callback: see `compute_tile`.
+
+    Returns:
+        A numpy array, a `numpy.memmap`, a symmetric `scipy.sparse.csr_matrix` (for sparse and top-K storages) or a
+        `CondensedScores` depending on `storage`, or None if computation was stopped.
+    """
+
+    num_spectra = len(spectra)
+    start = previous.shape[0] if previous is not None else 0
+
+    if storage == 'dense' and processes <= 1 and candidates is None and previous is None:
+        return compute_tile(mzs, spectra, slice(0, num_spectra), slice(0, num_spectra),
+                            mz_tolerance, min_matched_peaks, callback=callback)
+
+    stopped = False
+
+    def scores_callback(value):
+        nonlocal stopped
+        stopped = not callback(value)
+        return not stopped
+
+    top_k_storage = storage == 'top_k'
+    sparse = storage in ('sparse', 'top_k')  # Scores are gathered as triplets
+    condensed = storage == 'condensed'  # Only the upper triangle has to be filled
+    if top_k_storage:
+        neighbours = TopKNeighbours(num_spectra, top_k, min_cosine)
+        if previous is not None:
+            previous = sp.triu(previous, format='coo')
+            neighbours.add(previous.row.astype(np.int64), previous.col.astype(np.int64), previous.data)
+    elif sparse:
+        rows_ids, cols_ids, values = [], [], []
+        if previous is not None:
+            previous = previous.tocoo()
+            rows_ids.append(previous.row)
+            cols_ids.append(previous.col)
+            values.append(previous.data)
+    elif condensed:
+        scores = _zeros_scores(num_spectra, storage)
+        if previous is not None:
+            for i in range(start):
+                offset = scores.offsets[i]
+                scores.data[offset:offset+start-i] = previous.data[previous.offsets[i]:previous.offsets[i+1]]
+    else:
+        scores = _zeros_scores(num_spectra, storage)
+        if previous is not None:
+            for row_start, block in iter_row_blocks(previous):
+                scores[row_start:row_start+block.shape[0], :start] = block
+
+    def add_triplets(r, c, v, mirror=True):
+        if top_k_storage:
+            neighbours.add(r, c, v)  # Only the upper triangle is used
+            return
+
+        rows_ids.append(r)
+        cols_ids.append(c)
+        values.append(v)
+        if mirror:
+            rows_ids.append(c)
+            cols_ids.append(r)
+            values.append(v)
+
+    if candidates is not None:
+        results = iter_computed_pairs(mzs, spectra, candidates[0], candidates[1], mz_tolerance, min_matched_peaks,
+                                      processes=processes,
+                                      callback=scores_callback if callback is not None else None)
+    else:
+        results = iter_computed_tiles(mzs, spectra, mz_tolerance, min_matched_peaks,
+                                      min_cosine=min_cosine if sparse else None, processes=processes, start=start,
+                                      callback=scores_callback if callback is not None else None)
+
+    for rows, cols, result in results:
+        if candidates is not None:
+            # Scores of scattered pairs from the upper triangle
+            if sparse:
+                mask = (result >= min_cosine) & (result > 0)
+                add_triplets(rows[mask], cols[mask], result[mask])
+            else:
+                scores[rows, cols] = result
+                if not condensed:
+                    scores[cols, rows] = result
+        elif sparse:
+            add_triplets(*result, mirror=rows != cols)  # Diagonal tiles are already symmetric
+        else:
+            scores[rows, cols] = result
+            if rows != cols and not condensed:
+                scores[cols, rows] = result.T
+
+    if stopped:
+        return
+
+    if candidates is not None:
+        # Diagonal is not part of candidate pairs
+        diagonal = np.arange(start, num_spectra)
+        if sparse:
+            add_triplets(diagonal, diagonal, np.ones(diagonal.size, dtype=np.float32), mirror=False)
+        else:
+            scores[diagonal, diagonal] = 1
+
+    if top_k_storage:
+        return neighbours.tocsr()
+    elif sparse:
+        if values:
+            rows_ids = np.concatenate(rows_ids)
+            cols_ids = np.concatenate(cols_ids)
+            values = np.concatenate(values)
+        return sp.csr_matrix((values, (rows_ids, cols_ids)), shape=(num_spectra, num_spectra), dtype=np.float32)
+    elif storage == 'memmap':
+        scores.flush()
+
+    return scores
@@ -0,0 +1,144 @@
+import numpy as np
+
+from libmetgem import MZ, INTENSITY
+from libmetgem.filter import filter_data_multi
+
+from .spectra import SpectraStore, concatenate_spectra
+
+# Engines that can be used by `filter_spectra`
+FILTER_ENGINES = ('libmetgem', 'vectorized')
+
+# Peaks with a lower m/z are always removed
+MIN_MZ = 50
+
+# Maximum number of pairs of peaks compared at once by the window rank filter
+WINDOW_PAIRS_CHUNK_SIZE = 4 * 1024 ** 2
+
+
+def _sortable_bits(values):
+    """Reinterpret non-negative float32 values as integers that sort in the same order."""
+
+    return np.maximum(values, 0).astype(np.float32).view(np.int32).astype(np.int64)
+
+
+def window_rank_mask(owners, mzs, intensities, matched_peaks_window, min_matched_peaks_search):
+    """Window rank filter, applied to the peaks of all spectra at once.
+
+    A peak is kept if less than `min_matched_peaks_search` peaks of the same spectrum with a higher intensity (or the
+    same intensity but an earlier position) are within +/-`matched_peaks_window` of its m/z.
+
+    Args:
+        owners (numpy.ndarray): Spectrum of each peak.
+
+    Returns:
+        A boolean mask of peaks to keep.
+    """
+
+    num_peaks = owners.size
+    if num_peaks == 0 or min_matched_peaks_search <= 0:
+        return np.ones(num_peaks, dtype=bool)
+
+    # Peaks sorted by spectrum, then by m/z. m/z are compared as float32, as in libmetgem
+    mzs = mzs.astype(np.float32)
+    keys = (owners << 32) | _sortable_bits(mzs)
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    window = np.float32(matched_peaks_window)
+    lo = np.searchsorted(keys, (owners << 32) | _sortable_bits(mzs - window), side='left')
+    hi = np.searchsorted(keys, (owners << 32) | _sortable_bits(mzs + window), side='right')
+
+    # Count peaks ranked before each peak in its window, by chunks of peaks to bound memory usage
+    widths = hi - lo
+    counts = np.zeros(num_peaks, dtype=np.int64)
+    bounds = np.searchsorted(np.cumsum(widths), np.arange(WINDOW_PAIRS_CHUNK_SIZE, widths.sum(),
+                                                          WINDOW_PAIRS_CHUNK_SIZE), side='right')
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, num_peaks]):
+        if start >= stop:
+            continue
+        w = widths[start:stop]
+        i = np.repeat(np.arange(start, stop), w)
+        j = order[np.repeat(lo[start:stop] - np.cumsum(w) + w, w) + np.arange(w.sum())]
+        ranked_before = (intensities[j] > intensities[i]) | ((intensities[j] == intensities[i]) & (j < i))
+        counts[start:stop] = np.bincount(i[ranked_before] - start, minlength=stop - start)
+
+    return counts < min_matched_peaks_search
+
+
+def filter_peaks(mzs, peaks, offsets, min_intensity, parent_filter_tolerance, matched_peaks_window,
+                 min_matched_peaks_search, normalize=True):
+    """Filter the peaks of many spectra at once, stored in a single buffer as in `SpectraStore`.
+
+    The same steps as `libmetgem.filter.filter_data` are applied to each spectrum, as vectorized operations over the
+    whole buffer, with the same floating point precision:
+     - peaks with a m/z lower than `MIN_MZ` or within `parent_filter_tolerance` of the parent mass are removed,
+     - peaks with an intensity lower than `min_intensity` percents of the highest remaining peak are removed,
+     - `window_rank_mask` is applied,
+     - intensities are square-rooted and spectra are normalized to unit norm, if `normalize` is True.
+    Remaining peaks keep their order.
+
+    Returns:
+        tuple: peaks array and offsets array of filtered spectra.
+    """
+
+    num_spectra = len(offsets) - 1
+    offsets = np.asarray(offsets, dtype=np.int64)
+    peaks = np.asarray(peaks[offsets[0]:offsets[-1]], dtype=np.float32).reshape(-1, 2)
+    owners = np.repeat(np.arange(num_spectra, dtype=np.int64), np.diff(offsets))
+    parents = np.asarray(mzs, dtype=np.float64)[owners]
+
+    # Remove low mass peaks and peaks close to the parent mass
+    mz = peaks[:, MZ]
+    keep = (mz >= MIN_MZ) & ((mz <= parents - parent_filter_tolerance) | (mz >= parents + parent_filter_tolerance))
+    peaks, owners = peaks[keep], owners[keep]
+
+    # Remove peaks below the relative intensity threshold
+    counts = np.bincount(owners, minlength=num_spectra)
+    if peaks.size > 0:
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+        max_intensities = np.zeros(num_spectra, dtype=np.float32)
+        max_intensities[counts > 0] = np.maximum.reduceat(peaks[:, INTENSITY], starts[counts > 0])
+        keep = peaks[:, INTENSITY] >= np.float32(min_intensity) * max_intensities[owners] / np.float32(100)
+        peaks, owners = peaks[keep], owners[keep]
+
+    keep = window_rank_mask(owners, peaks[:, MZ], peaks[:, INTENSITY], matched_peaks_window,
+                            min_matched_peaks_search)
+    peaks, owners = peaks[keep], owners[keep]
+
+    if normalize and peaks.size > 0:
+        peaks[:, INTENSITY] = np.sqrt(peaks[:, INTENSITY])
+        norms = np.sqrt(np.bincount(owners, weights=peaks[:, INTENSITY].astype(np.float64) ** 2,
+                                    minlength=num_spectra))
+        norms[norms == 0] = 1
+        peaks[:, INTENSITY] /= norms[owners].astype(np.float32)
+
+    offsets = np.zeros(num_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=num_spectra), out=offsets[1:])
+    return peaks, offsets
+
+
+def filter_spectra(mzs, spectra, min_intensity, parent_filter_tolerance, matched_peaks_window,
+                   min_matched_peaks_search, engine='libmetgem', normalize=True):
+    """Filter spectra using either `libmetgem.filter.filter_data_multi` or `filter_peaks`.
+
+    Args:
+        engine (str): 'libmetgem' filters spectra one by one, 'vectorized' filters all spectra at once.
+        normalize (bool): If False, intensities of kept peaks are left unchanged. As `filter_data_multi` always
+            normalizes spectra, peaks kept by the 'libmetgem' engine are then found by their m/z in the original
+            spectra.
+
+    Returns:
+        A `SpectraStore`.
+    """
+
+    if engine == 'vectorized':
+        peaks, offsets = concatenate_spectra(spectra)
+        peaks, offsets = filter_peaks(mzs, peaks, offsets, min_intensity, parent_filter_tolerance,
+                                      matched_peaks_window, min_matched_peaks_search, normalize=normalize)
+        return SpectraStore(mzs, peaks, offsets)
+    elif engine == 'libmetgem':
+        filtered = filter_data_multi(list(mzs), list(spectra), min_intensity, parent_filter_tolerance,
+                                     matched_peaks_window, min_matched_peaks_search)
+        if not normalize:
+            filtered = [data[np.isin(data[:, MZ], kept[:, MZ])] for data, kept in zip(spectra, filtered)]
+        return SpectraStore.from_spectra(mzs, filtered)
+    raise ValueError(f'Unknown filter engine: {engine}')
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+import scipy.sparse as sp
+
+from .spectra import concatenate_spectra
+
+# Expected number of spectra in each bucket of a hash table
+BUCKET_SIZE = 32
+
+# Seed used to draw random projections, so that candidates are reproducible
+RANDOM_SEED = 0
+
+
+def spectra_vectors(mzs, spectra, bin_width):
+    """Vectorize spectra as L2-normalized sparse vectors.
+
+    Intensities are binned by fragment m/z on one side and by neutral loss (parent mass minus fragment m/z) on the
+    other side, so that the dot product of two vectors approximates the cosine score of two spectra without or with a
+    parent mass shift. Only bins used by at least one spectrum are kept as columns.
+
+    Returns:
+        tuple: two `scipy.sparse.csr_matrix` (fragments and neutral losses) with one row for each spectrum.
+    """
+
+    num_spectra = len(spectra)
+    peaks, offsets = concatenate_spectra(spectra)
+    sizes = np.diff(offsets)
+    if sizes.sum() == 0:
+        empty = sp.csr_matrix((num_spectra, 0), dtype=np.float32)
+        return empty, empty
+
+    owners = np.repeat(np.arange(num_spectra), sizes)
+    peaks = np.asarray(peaks[offsets[0]:offsets[-1]], dtype=np.float64)
+    losses = np.repeat(np.asarray(mzs, dtype=np.float64), sizes) - peaks[:, 0]
+
+    vectors = []
+    for values in (peaks[:, 0], losses):
+        _, cols = np.unique(np.floor(values / bin_width), return_inverse=True)
+        matrix = sp.csr_matrix((peaks[:, 1], (owners, cols)), shape=(num_spectra, cols.max() + 1), dtype=np.float32)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        vectors.append(sp.diags(1 / norms).dot(matrix).tocsr())
+    return tuple(vectors)
+
+
+def bucket_pairs(keys):
+    """Get all pairs of items sharing the same key.
+
+    Returns:
+        tuple: two arrays of items ids, the first one always lower than the second one.
+    """
+
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    ends = np.repeat(np.r_[starts[1:], keys.size], np.diff(np.r_[starts, keys.size]))
+
+    # Pair each item with all the following items of its bucket
+    counts = ends - np.arange(keys.size) - 1
+    left = np.repeat(np.arange(keys.size), counts)
+    right = left + 1 + np.arange(left.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    left, right = order[left], order[right]
+    return np.minimum(left, right), np.maximum(left, right)
+
+
+def find_approximate_pairs(mzs, spectra, mz_tolerance, num_tables, start=0, bucket_size=BUCKET_SIZE):
+    """Find pairs of spectra likely to have a high cosine score using random-projection locality-sensitive hashing.
+
+    Spectra are vectorized with `spectra_vectors`, then hashed `num_tables` times, each time using the signs of the
+    projections of their fragments (even tables) or neutral losses (odd tables) vectors on random hyperplanes. Spectra
+    with a small angle between them are likely to get the same hash in at least one table, so increasing `num_tables`
+    finds more high-scoring pairs at the cost of more candidates. The number of hyperplanes is chosen so that buckets
+    hold about `bucket_size` spectra.
+
+    Args:
+        start (int): Only pairs involving at least one spectrum from `start` are returned, see `iter_tiles`.
+
+    Returns:
+        tuple: two arrays of spectra ids, sorted by row, describing candidate pairs in the upper triangle of the
+            scores matrix (diagonal excluded). See `find_candidate_pairs`.
+    """
+
+    num_spectra = len(spectra)
+    fragments, losses = spectra_vectors(mzs, spectra, 2 * mz_tolerance + 1e-3)
+    valid = np.flatnonzero(fragments.getnnz(axis=1) > 0)  # Empty spectra never score
+    if num_tables <= 0 or valid.size < 2:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    fragments, losses = fragments[valid], losses[valid]
+
+    num_bits = max(1, min(62, math.ceil(math.log2(valid.size / bucket_size)))) if valid.size > bucket_size else 1
+    weights = 1 << np.arange(num_bits, dtype=np.int64)
+    rng = np.random.RandomState(RANDOM_SEED)
+
+    codes = []
+    for table in range(num_tables):
+        vectors = losses if table % 2 else fragments
+        projections = rng.standard_normal((vectors.shape[1], num_bits)).astype(np.float32)
+        keys = (np.asarray(vectors.dot(projections)) > 0).astype(np.int64) @ weights
+        rows_ids, cols_ids = bucket_pairs(keys)
+        rows_ids, cols_ids = valid[rows_ids], valid[cols_ids]
+        mask = cols_ids >= start
+        codes.append(rows_ids[mask] * num_spectra + cols_ids[mask])
+
+    codes = np.unique(np.concatenate(codes))
+    return codes // num_spectra, codes % num_spectra
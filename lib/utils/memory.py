@@ -0,0 +1,173 @@
+import os
+import sys
+import shutil
+import ctypes
+from collections import namedtuple
+
+from ..config import SCRATCH_PATH
+
+# Part of the available memory that processing is allowed to use
+MEMORY_HEADROOM = 0.8
+
+# Storages that can replace each other without changing any score, ordered by decreasing memory usage
+EXACT_STORAGES = ('dense', 'condensed', 'memmap')
+
+# Size of the row, column and value of a score gathered as a triplet by `BlockScores`
+TRIPLET_SIZE = 8 + 8 + 4
+
+MemoryPlan = namedtuple('MemoryPlan', ['storage', 'estimates', 'available', 'fits', 'tsne_fits'])
+MemoryPlan.__doc__ = """Result of `plan_memory`.
+
+Attributes:
+    storage (str): scores storage to use.
+    estimates (dict): estimated memory needed by each stage with this storage, in bytes, None if unknown.
+    available (int): available memory in bytes, None if unknown.
+    fits (bool): True if scores should fit in memory, False if not, None if available memory is unknown.
+    tsne_fits (bool): True if t-SNE should fit in memory along with scores, False if not, None if available memory is
+        unknown.
+"""
+
+
+def available_memory():
+    """Get the amount of physical memory that can be used without swapping, in bytes, or None if unknown."""
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if sys.platform.startswith('win'):
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return
+
+
+def available_disk_space(path=SCRATCH_PATH):
+    """Get the free space of the disk holding `path`, in bytes, or None if unknown."""
+
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return
+
+
+def format_size(num_bytes):
+    """Format a number of bytes with a binary prefix, eg. '1.5 GB'."""
+
+    if num_bytes is None:
+        return 'unknown'
+    size = float(num_bytes)
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    return f'{size:.1f} {unit}'
+
+
+def scores_memory(num_spectra, storage, top_k=10, pipelined=False):
+    """Estimate the size of a scores matrix.
+
+    Args:
+        pipelined (bool): If True, scores are computed while spectra are read, by a `BlockScores` that does not know
+            the number of spectra. Scores of the upper triangle are then gathered as triplets and concatenated before
+            a dense matrix is built, which is counted as if all scores were non-zero.
+
+    Returns:
+        tuple: bytes needed in memory and on disk, memory being None for sparse storage as it depends on the number
+            of scores above the threshold.
+    """
+
+    if pipelined and storage == 'dense':
+        return 2 * TRIPLET_SIZE * num_spectra * (num_spectra + 1) // 2, 0
+    elif storage == 'memmap':
+        return 0, 4 * num_spectra ** 2
+    elif storage == 'condensed':
+        return 2 * num_spectra * (num_spectra + 1), 0
+    elif storage == 'top_k':
+        # Row, column and score of each kept pair, for both ends of the pair
+        return 2 * 16 * num_spectra * top_k, 0
+    elif storage == 'sparse':
+        return None, 0
+    return 4 * num_spectra ** 2, 0
+
+
+def estimate_memory(num_spectra, storage, cosine_options, tsne_options):
+    """Estimate the memory needed by the stages following the reading of spectra.
+
+    t-SNE runs on a dense matrix of distances between nodes having enough high scores, which is copied once to get
+    distances from scores, and exact t-SNE needs several more matrices of the same size in double precision. As the
+    number of such nodes is not known before scores are computed, all nodes are counted, giving an upper bound.
+
+    Returns:
+        dict: bytes needed for 'scores', 't-SNE' and 'layouts'.
+    """
+
+    tsne = 2 * 4 * num_spectra ** 2
+    if not tsne_options.barnes_hut:
+        tsne += 3 * 8 * num_spectra ** 2
+    return {'scores': scores_memory(num_spectra, storage, cosine_options.neighbours_top_k)[0],
+            't-SNE': tsne,
+            'layouts': 2 * 2 * 8 * num_spectra}
+
+
+def plan_memory(num_spectra, cosine_options, tsne_options, available=None, disk_available=None, switch=True):
+    """Check that processing `num_spectra` spectra fits in memory and choose the scores storage accordingly.
+
+    If `switch` is True and the scores matrix needs too much memory with the storage selected in `cosine_options`,
+    which is one of `EXACT_STORAGES`, the first of the following storages that fits is proposed instead,
+    memory-mapped storage being only proposed if there is enough disk space. If none fits, the one needing the least
+    memory is proposed. Only scores are considered to choose the storage, as t-SNE memory does not depend on it.
+
+    Args:
+        available (int): available memory in bytes, found with `available_memory` if None.
+        disk_available (int): free disk space for memory-mapped storage, found with `available_disk_space` if None.
+        switch (bool): if False, only the storage selected in `cosine_options` is checked.
+
+    Returns:
+        A `MemoryPlan`.
+    """
+
+    storage = cosine_options.scores_storage
+    available = available if available is not None else available_memory()
+    if available is None:
+        return MemoryPlan(storage, estimate_memory(num_spectra, storage, cosine_options, tsne_options), None, None,
+                          None)
+
+    candidates = [storage]
+    if switch and storage in EXACT_STORAGES:
+        candidates = list(EXACT_STORAGES[EXACT_STORAGES.index(storage):])
+        if candidates[-1] == 'memmap' and len(candidates) > 1:
+            disk_available = disk_available if disk_available is not None else available_disk_space()
+            if disk_available is not None and scores_memory(num_spectra, 'memmap')[1] > disk_available:
+                candidates.pop()
+
+    plans = []
+    for candidate in candidates:
+        estimates = estimate_memory(num_spectra, candidate, cosine_options, tsne_options)
+        scores = estimates['scores'] or 0
+        total = sum(value for value in estimates.values() if value is not None)
+        plan = MemoryPlan(candidate, estimates, available, scores <= MEMORY_HEADROOM * available,
+                          total <= MEMORY_HEADROOM * available)
+        if plan.fits:
+            return plan
+        plans.append((scores, plan))
+    return min(plans, key=lambda p: p[0])[1]
@@ -0,0 +1,313 @@
+import os
+import re
+import bz2
+import gzip
+import lzma
+import mmap
+import collections
+import multiprocessing
+
+import numpy as np
+
+from libmetgem.mgf import read as libmetgem_read_mgf
+
+# Files smaller than this are parsed in the current process, even if worker processes are allowed
+PARALLEL_MIN_SIZE = 16 * 1024 ** 2
+
+# Approximate size of the byte ranges parsed at once
+CHUNK_SIZE = 4 * 1024 ** 2
+
+# Parameters kept when unknown parameters are ignored
+KNOWN_PARAMS = ('pepmass', 'charge')
+
+# Extensions of files that can be read by `read_mgf`
+MGF_EXTENSIONS = ('.mgf', '.mgf.gz', '.mgf.bz2', '.mgf.xz')
+
+# Functions used to open compressed files, by magic number
+DECOMPRESSORS = ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open))
+
+# Lines starting and ending spectra, with their line break
+BOUNDARY_RE = re.compile(rb'^[ \t]*(BEGIN|END) IONS[ \t\r]*(?:\n|\Z)', re.MULTILINE)
+
+
+def is_mgf_file(filename):
+    """Check if `filename` has the extension of a MGF file, compressed or not."""
+
+    return filename.lower().endswith(MGF_EXTENSIONS)
+
+
+def get_decompressor(filename):
+    """Get the function that should be used to open `filename` for decompression, or None if it is not compressed."""
+
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, decompressor in DECOMPRESSORS:
+        if magic.startswith(prefix):
+            return decompressor
+
+
+def _parse_charge(value):
+    value = value.split(maxsplit=1)[0] if value.strip() else value
+    try:
+        if value.endswith('-'):
+            return -int(value[:-1])
+        return int(value.rstrip('+'))
+    except ValueError:
+        return value
+
+
+def parse_mgf(buffer, ignore_unknown=False, positions=False):
+    """Parse spectra from a bytes-like object holding MGF formatted data.
+
+    Args:
+        positions (bool): If True, also return the position of each spectrum in `buffer`.
+
+    Returns:
+        tuple: For each spectrum, a dictionary of parameters with lower-case keys, then an array with the peaks of all
+            spectra (m/z and intensity) and an array with the number of peaks of each spectrum. If `positions` is
+            True, an array with the offset and length in bytes of each spectrum, from its `BEGIN IONS` line to the
+            end of its `END IONS` line, is added.
+    """
+
+    params_list = []
+    peaks = []
+    counts = []
+    spans = []
+
+    data = bytes(buffer)
+    params = None
+    num_peaks = 0
+    start = pos = 0  # Positions are only searched for at the start and end of spectra, to keep parsing fast
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line[0] in b'#;!/':
+            continue
+
+        if params is None:
+            if line == b'BEGIN IONS':
+                params = {}
+                num_peaks = 0
+                if positions:
+                    pos = data.find(b'BEGIN IONS', pos)
+                    start = data.rfind(b'\n', 0, pos) + 1
+        elif line == b'END IONS':
+            params_list.append(params)
+            counts.append(num_peaks)
+            if positions:
+                pos = data.find(b'END IONS', pos)
+                pos = data.find(b'\n', pos) + 1 or len(data)
+                spans.append((start, pos - start))
+            params = None
+        elif line[0] in b'0123456789.-+':
+            values = line.split(maxsplit=2)
+            peaks.append(values[0])
+            peaks.append(values[1] if len(values) > 1 else b'0')
+            num_peaks += 1
+        elif b'=' in line:
+            key, value = line.decode('utf-8', errors='replace').split('=', 1)
+            key = key.strip().lower()
+            if ignore_unknown and key not in KNOWN_PARAMS:
+                continue
+            value = value.strip()
+            if key == 'pepmass':
+                value = float(value.split(maxsplit=1)[0])
+            elif key == 'charge':
+                value = _parse_charge(value)
+            params[key] = value
+
+    # Converting all values at once is much faster than converting them one by one
+    peaks = np.array(peaks, dtype=bytes).astype(np.float32) if peaks else np.empty((0,), dtype=np.float32)
+    result = params_list, peaks.reshape(-1, 2), np.array(counts, dtype=np.int64)
+    if positions:
+        result += (np.array(spans, dtype=np.int64).reshape(-1, 2),)
+    return result
+
+
+def index_mgf(buffer):
+    """Find the position of each spectrum in a bytes-like object holding MGF formatted data, as given by `parse_mgf`,
+    without parsing spectra.
+
+    Returns:
+        An array with the offset and length in bytes of each spectrum.
+    """
+
+    spans = []
+    start = None
+    for match in BOUNDARY_RE.finditer(buffer):
+        if match.group(1) == b'BEGIN':
+            if start is None:
+                start = match.start()
+        elif start is not None:
+            spans.append((start, match.end() - start))
+            start = None
+    return np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+
+def split_mgf(buffer, chunk_size=CHUNK_SIZE):
+    """Split MGF formatted data in byte ranges of about `chunk_size` bytes, each one starting at a `BEGIN IONS` line.
+
+    Returns:
+        list: (start, stop) offsets of ranges, covering the whole buffer.
+    """
+
+    size = len(buffer)
+    offsets = [0]
+    while offsets[-1] + chunk_size < size:
+        pos = buffer.find(b'\nBEGIN IONS', offsets[-1] + chunk_size)
+        if pos < 0:
+            break
+        offsets.append(pos + 1)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def iter_compressed_chunks(filename, decompressor, chunk_size=CHUNK_SIZE):
+    """Decompress a MGF file by chunks of about `chunk_size` bytes, each one starting at a `BEGIN IONS` line.
+
+    Yields:
+        tuple: number of bytes of the compressed file read so far and a chunk of decompressed data.
+    """
+
+    with open(filename, 'rb') as raw:
+        with decompressor(raw) as f:
+            pending = b''
+            for data in iter(lambda: f.read(chunk_size), b''):
+                pending += data
+                pos = pending.rfind(b'\nBEGIN IONS')
+                if pos > 0:
+                    yield raw.tell(), pending[:pos+1]
+                    pending = pending[pos+1:]
+            if pending:
+                yield raw.tell(), pending
+
+
+def _parse_range(task):
+    filename, start, stop, ignore_unknown = task
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            params_list, peaks, counts, positions = parse_mgf(buffer[start:stop], ignore_unknown=ignore_unknown,
+                                                              positions=True)
+    positions[:, 0] += start
+    return stop, (params_list, peaks, counts, positions)
+
+
+def _parse_chunk(task):
+    position, chunk, ignore_unknown = task
+    return position, parse_mgf(chunk, ignore_unknown=ignore_unknown) + (None,)
+
+
+def read_mgf_spectrum(filename, offset, length):
+    """Read a single spectrum at a known position of an uncompressed MGF file, see `read_mgf`'s `index`.
+
+    Returns:
+        tuple: parameters of the spectrum and an array with its peaks, see `parse_mgf`.
+
+    Raises:
+        ValueError: if there is no spectrum at this position, eg. because the file was modified.
+    """
+
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if not data.lstrip().startswith(b'BEGIN IONS'):
+        raise ValueError(f'No spectrum found at offset {offset} of {filename}, file may have been modified.')
+    params_list, peaks, _ = parse_mgf(data)
+    if len(params_list) != 1:
+        raise ValueError(f'No spectrum found at offset {offset} of {filename}, file may have been modified.')
+    return params_list[0], peaks
+
+
+def _imap_bounded(pool, func, tasks, max_pending):
+    """Like `multiprocessing.Pool.imap`, but never consume more than `max_pending` tasks ahead of results, so that
+    tasks can be generated lazily from a stream without holding all of them in memory."""
+
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_mgf(filename, ignore_unknown=False, processes=1, callback=None, index=None):
+    """Read spectra from a MGF file.
+
+    Uncompressed files are read with `libmetgem.mgf.read` unless `processes` is greater than 1 and the file is large
+    enough. Spectra are then indexed with `index_mgf` and progress is only reported once the whole file is read.
+    Otherwise, the file is memory-mapped, split in byte ranges using `split_mgf`, and ranges are parsed with
+    `parse_mgf` by a pool of worker processes. Spectra are yielded in the same order as in the file in any case.
+
+    Files compressed with gzip, bzip2 or xz are decompressed on the fly using `iter_compressed_chunks` and chunks are
+    parsed with `parse_mgf`, by a pool of worker processes if `processes` is greater than 1 and the file is large
+    enough. Progress is then reported on the compressed file.
+
+    Args:
+        ignore_unknown (bool): If True, only parameters listed in `KNOWN_PARAMS` are kept.
+        processes (int): Number of worker processes.
+        callback: Called with the number of bytes of the file parsed so far each time a byte range has been parsed.
+        index (list): If not None, the offset and length in bytes of each spectrum in the file are appended to it, as
+            arrays of shape (N, 2), one for each byte range parsed. Spectra of compressed files can't be found with a
+            single seek and are not indexed.
+
+    Yields:
+        tuple: parameters of the spectrum and an array with its peaks, see `parse_mgf`.
+    """
+
+    size = os.path.getsize(filename)
+    if size == 0:
+        return
+
+    decompressor = get_decompressor(filename)
+    if decompressor is None and (processes <= 1 or size < PARALLEL_MIN_SIZE):
+        yield from _read_mgf_sequential(filename, size, ignore_unknown, callback, index)
+        return
+
+    if decompressor is not None:
+        func = _parse_chunk
+        tasks = ((position, chunk, ignore_unknown)
+                 for position, chunk in iter_compressed_chunks(filename, decompressor))
+    else:
+        func = _parse_range
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                tasks = [(filename, start, stop, ignore_unknown) for start, stop in split_mgf(buffer)]
+
+    if processes <= 1 or size < PARALLEL_MIN_SIZE or (decompressor is None and len(tasks) < 2):
+        results = map(func, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes if decompressor is not None else min(processes, len(tasks)))
+        results = _imap_bounded(pool, func, tasks, 2 * processes)
+
+    try:
+        for stop, (params_list, peaks, counts, positions) in results:
+            if index is not None and positions is not None:
+                index.append(positions)
+            if callback is not None:
+                callback(stop)
+            offsets = np.r_[0, np.cumsum(counts)]
+            for params, start, end in zip(params_list, offsets[:-1], offsets[1:]):
+                yield params, peaks[start:end]
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _read_mgf_sequential(filename, size, ignore_unknown, callback, index):
+    """Read an uncompressed MGF file with the compiled reader of libmetgem, see `read_mgf`."""
+
+    count = 0
+    for params, data in libmetgem_read_mgf(filename, ignore_unknown=ignore_unknown):
+        count += 1
+        yield params, data
+
+    if index is not None:
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                positions = index_mgf(buffer)
+        # Spectra that libmetgem can not read would shift all positions
+        if len(positions) == count:
+            index.append(positions)
+    if callback is not None:
+        callback(size)
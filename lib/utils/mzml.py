@@ -0,0 +1,217 @@
+import zlib
+import base64
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from .mgf import get_decompressor
+
+# Extensions of files that can be read by `read_mzml`
+MZML_EXTENSIONS = ('.mzML', '.mzXML', '.mzML.gz', '.mzXML.gz', '.mzML.bz2', '.mzXML.bz2', '.mzML.xz', '.mzXML.xz')
+
+# Number of spectra which peaks are decoded at once
+BATCH_SIZE = 1024
+
+# Controlled vocabulary accessions used in mzML files
+MS_LEVEL = 'MS:1000511'
+SELECTED_ION_MZ = 'MS:1000744'
+ISOLATION_WINDOW_TARGET_MZ = 'MS:1000827'
+CHARGE_STATE = 'MS:1000041'
+FLOAT_32 = 'MS:1000521'
+FLOAT_64 = 'MS:1000523'
+ZLIB_COMPRESSION = 'MS:1000574'
+MZ_ARRAY = 'MS:1000514'
+INTENSITY_ARRAY = 'MS:1000515'
+
+
+def is_mzml_file(filename):
+    """Check if `filename` has the extension of a mzML or mzXML file, compressed or not."""
+
+    return filename.lower().endswith(tuple(ext.lower() for ext in MZML_EXTENSIONS))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _cv_params(element, groups):
+    """Get controlled vocabulary parameters of an element and its children, including referenced groups."""
+
+    params = {}
+    for child in element.iter():
+        name = _local_name(child.tag)
+        if name == 'cvParam':
+            params[child.get('accession')] = child.get('value')
+        elif name == 'referenceableParamGroupRef':
+            params.update(groups.get(child.get('ref'), {}))
+    return params
+
+
+def decode_arrays(encoded, dtypes, compressed):
+    """Decode base64 encoded binary arrays.
+
+    Each array is decoded (and decompressed if needed) separately, but arrays sharing the same data type are converted
+    to numbers at once.
+
+    Args:
+        encoded (list of str): base64 encoded data.
+        dtypes (list of numpy.dtype): data type of each array.
+        compressed (list of bool): True for arrays compressed with zlib.
+
+    Returns:
+        list: decoded arrays.
+    """
+
+    try:
+        buffers = [base64.b64decode(data) if data else b'' for data in encoded]
+        buffers = [zlib.decompress(data) if compress and data else data
+                   for data, compress in zip(buffers, compressed)]
+    except zlib.error as e:
+        raise ValueError(f'Invalid compressed peaks: {e}') from e
+
+    arrays = [None] * len(buffers)
+    for dtype in set(dtypes):
+        ids = [i for i, d in enumerate(dtypes) if d == dtype]
+        values = np.frombuffer(b''.join(buffers[i] for i in ids), dtype=dtype)
+        offsets = np.cumsum([0] + [len(buffers[i]) // dtype.itemsize for i in ids])
+        for i, start, stop in zip(ids, offsets[:-1], offsets[1:]):
+            arrays[i] = values[start:stop]
+    return arrays
+
+
+def _mzml_spectrum(element, groups):
+    """Extract parameters and encoded peaks of a MS/MS `spectrum` element of a mzML file."""
+
+    params = _cv_params(element, groups)
+    if params.get(MS_LEVEL) != '2':
+        return
+
+    ion = {}
+    for child in element.iter():
+        if _local_name(child.tag) in ('selectedIon', 'isolationWindow'):
+            ion.update((k, v) for k, v in _cv_params(child, groups).items() if k not in ion)
+    mz = ion.get(SELECTED_ION_MZ, ion.get(ISOLATION_WINDOW_TARGET_MZ))
+    if mz is None:
+        return
+
+    spectrum = {'pepmass': float(mz), 'mslevel': 2, 'scans': element.get('id')}
+    if ion.get(CHARGE_STATE):
+        spectrum['charge'] = int(ion[CHARGE_STATE])
+
+    arrays = {}
+    for array in element.iter():
+        if _local_name(array.tag) != 'binaryDataArray':
+            continue
+        array_params = _cv_params(array, groups)
+        kind = MZ_ARRAY if MZ_ARRAY in array_params else INTENSITY_ARRAY if INTENSITY_ARRAY in array_params else None
+        binary = next((c for c in array if _local_name(c.tag) == 'binary'), None)
+        if kind is not None and binary is not None:
+            arrays[kind] = (binary.text or '', np.dtype('<f8') if FLOAT_64 in array_params else np.dtype('<f4'),
+                            ZLIB_COMPRESSION in array_params)
+    if MZ_ARRAY not in arrays or INTENSITY_ARRAY not in arrays:
+        return
+
+    return spectrum, [arrays[MZ_ARRAY], arrays[INTENSITY_ARRAY]]
+
+
+def _mzxml_scan(element):
+    """Extract parameters and encoded peaks of a MS/MS `scan` element of a mzXML file."""
+
+    if element.get('msLevel') != '2':
+        return
+
+    precursor = next((c for c in element if _local_name(c.tag) == 'precursorMz'), None)
+    peaks = next((c for c in element if _local_name(c.tag) == 'peaks'), None)
+    if precursor is None or peaks is None or not (precursor.text or '').strip():
+        return
+
+    spectrum = {'pepmass': float(precursor.text), 'mslevel': 2, 'scans': element.get('num')}
+    if precursor.get('precursorCharge'):
+        spectrum['charge'] = int(precursor.get('precursorCharge'))
+
+    # Peaks are stored as interleaved m/z and intensity values
+    dtype = np.dtype('>f8') if peaks.get('precision') == '64' else np.dtype('>f4')
+    if peaks.get('byteOrder', 'network') == 'little':
+        dtype = dtype.newbyteorder('<')
+    return spectrum, [(peaks.text or '', dtype, peaks.get('compressionType') == 'zlib')]
+
+
+def _decode_batch(batch):
+    """Decode peaks of a batch of spectra extracted by `_mzml_spectrum` or `_mzxml_scan`."""
+
+    if not batch:
+        return
+
+    encoded = [array for _, arrays in batch for array in arrays]
+    decoded = iter(decode_arrays(*zip(*encoded)))
+    for params, arrays in batch:
+        if len(arrays) == 2:
+            mzs, intensities = next(decoded), next(decoded)
+            size = min(mzs.size, intensities.size)
+            data = np.stack((mzs[:size], intensities[:size]), axis=1)
+        else:
+            data = next(decoded).reshape(-1, 2)
+        yield params, data.astype(np.float32)
+
+
+def read_mzml(filename, callback=None):
+    """Read MS/MS spectra from a mzML or mzXML file, compressed or not.
+
+    The file is parsed as a stream, only keeping the current spectrum in memory, and peaks of spectra are decoded by
+    batches of `BATCH_SIZE` spectra.
+
+    Args:
+        callback: Called with the number of bytes of the file read so far each time a batch of spectra is decoded.
+
+    Yields:
+        tuple: parameters of the spectrum (parent mass as `pepmass`, `charge` if known, `mslevel` and scan id as
+            `scans`) and an array with its peaks, as in `lib.utils.mgf.read_mgf`.
+    """
+
+    decompressor = get_decompressor(filename)
+    with open(filename, 'rb') as raw:
+        source = decompressor(raw) if decompressor is not None else raw
+        try:
+            batch = []
+            parents = []
+            groups = {}  # Parameters of mzML's referenceable groups, by id
+            for event, element in ET.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    continue
+
+                parents.pop()
+                name = _local_name(element.tag)
+                if name == 'referenceableParamGroup':
+                    groups[element.get('id')] = _cv_params(element, groups)
+                    continue
+                elif name == 'spectrum':
+                    spectrum = _mzml_spectrum(element, groups)
+                elif name == 'scan' and 'num' in element.attrib:
+                    spectrum = _mzxml_scan(element)
+                else:
+                    continue
+
+                if spectrum is not None:
+                    batch.append(spectrum)
+
+                # Free memory used by spectra already read
+                if parents:
+                    parents[-1].remove(element)
+                else:
+                    element.clear()
+
+                if len(batch) >= BATCH_SIZE:
+                    yield from _decode_batch(batch)
+                    batch = []
+                    if callback is not None:
+                        callback(raw.tell())
+
+            yield from _decode_batch(batch)
+            if callback is not None:
+                callback(raw.tell())
+        except ET.ParseError as e:
+            raise ValueError(f'Invalid file: {e}') from e
+        finally:
+            if source is not raw:
+                source.close()
@@ -3,7 +3,8 @@ from PyQt5.QtCore import QObject, pyqtSignal
 
 class Network(QObject):
     __slots__ = 'mzs', 'spectra', 'scores', 'graph', 'options', '_infos', '_interactions', \
-                'db_results', 'mappings', 'lazyloaded'
+                'db_results', 'mappings', 'candidates', 'members', \
+                'sources', 'source_files', 'raw_index'
 
     infosAboutToChange = pyqtSignal()
     infosChanged = pyqtSignal()
@@ -15,7 +16,11 @@ class Network(QObject):
         self._interactions = None
         self._infos = None
         self.db_results = {}
-        self.lazyloaded = False
+        self.candidates = None  # `CandidateEdges` gathered by last network generation, if available
+        self.members = None  # Ids of original scans merged in each node, if spectra were merged
+        self.sources = None  # Index in `source_files` of the file each node was read from, if known
+        self.source_files = None  # Files spectra were read from
+        self.raw_index = None  # Position of each scan in `source_files`, if known
 
     @property
     def infos(self):
@@ -0,0 +1,71 @@
+import numpy as np
+
+from .mgf import read_mgf_spectrum
+
+
+class RawSpectraIndex:
+    """Position of each scan in the files spectra were read from, so that the raw spectrum of a scan can be read
+    again with a single seek, without keeping raw spectra in memory.
+
+    Scan `i` is stored in file `sources[i]`, an index in the list of files of the network, at byte `offsets[i]` and
+    spans `lengths[i]` bytes. Scans whose position is unknown, eg. because they were read from a compressed or a mzML
+    file, have a negative offset.
+    """
+
+    def __init__(self, sources, offsets, lengths):
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+
+    @classmethod
+    def from_positions(cls, positions, sizes):
+        """Create an index from the positions found when reading each file.
+
+        Args:
+            positions (list): For each file, an array of offsets and lengths of its scans as filled by `read_mgf`, or
+                None if the file was not indexed.
+            sizes (list of int): Number of scans of each file.
+        """
+
+        offsets, lengths = [], []
+        for pos, size in zip(positions, sizes):
+            if pos is None or len(pos) != size:
+                pos = np.full((size, 2), -1, dtype=np.int64)
+            offsets.append(pos[:, 0])
+            lengths.append(pos[:, 1])
+        return cls(np.repeat(np.arange(len(sizes)), sizes), np.concatenate(offsets), np.concatenate(lengths))
+
+    @classmethod
+    def concatenate(cls, index, num_files, new_index):
+        """Append the index of spectra read from new files to an index of spectra read from `num_files` files."""
+
+        return cls(np.concatenate((index.sources, new_index.sources + num_files)),
+                   np.concatenate((index.offsets, new_index.offsets)),
+                   np.concatenate((index.lengths, new_index.lengths)))
+
+    def __len__(self):
+        return self.offsets.size
+
+    def has_spectrum(self, scan):
+        """Check if the position of a scan is known."""
+
+        return 0 <= scan < len(self) and self.offsets[scan] >= 0
+
+    def read(self, scan, files):
+        """Read the raw spectrum of a scan.
+
+        Args:
+            files (list of str): Files spectra were read from.
+
+        Returns:
+            tuple: parameters of the spectrum and an array with its peaks, see `lib.utils.mgf.parse_mgf`.
+
+        Raises:
+            KeyError: if the position of this scan is not known.
+            OSError: if the file can't be read.
+            ValueError: if the file was modified since it was indexed.
+        """
+
+        if not self.has_spectrum(scan):
+            raise KeyError(scan)
+        return read_mgf_spectrum(files[self.sources[scan]], int(self.offsets[scan]), int(self.lengths[scan]))
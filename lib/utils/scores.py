@@ -0,0 +1,496 @@
+import os
+import math
+import glob
+import time
+import atexit
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+from .cache import evict_least_recently_used
+from .spectra import concatenate_spectra
+from ..config import SCRATCH_PATH, SCORES_CACHE_PATH, SCORES_CACHE_MAX_SIZE
+
+# Number of rows read at once from scores matrices that are not held in memory
+ROW_BLOCK_SIZE = 256
+
+# Age in seconds after which files left in the scratch directory by other sessions are removed
+SCRATCH_MAX_AGE = 24 * 3600
+
+# Files created by `create_memmap` in this process that could not be unlinked while they were mapped
+_scratch_files = set()
+
+
+def create_memmap(shape, dtype=np.float32):
+    """Create a memory-mapped array backed by a new file in the scratch directory.
+
+    The backing file is unlinked as soon as it is mapped, so that it is removed by the system when the array is
+    released. On platforms where this is not possible, the file is removed by `remove_scratch_files` once it is not
+    mapped anymore.
+    """
+
+    remove_scratch_files()
+
+    fd, filename = tempfile.mkstemp(suffix='.dat', dir=SCRATCH_PATH)
+    os.close(fd)
+    array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    try:
+        os.remove(filename)
+    except OSError:
+        _scratch_files.add(filename)
+
+    return array
+
+
+@atexit.register
+def remove_scratch_files():
+    """Remove files created by `create_memmap` that are not mapped anymore, and files left in the scratch directory by
+    other sessions for more than `SCRATCH_MAX_AGE` seconds.
+
+    Files of other sessions are only identified by their age, as they may still be mapped by another running
+    instance.
+    """
+
+    for filename in list(_scratch_files):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            continue
+        _scratch_files.discard(filename)
+
+    now = time.time()
+    for filename in glob.glob(os.path.join(SCRATCH_PATH, '*.dat')):
+        if filename in _scratch_files:
+            continue
+        try:
+            if now - os.path.getmtime(filename) > SCRATCH_MAX_AGE:
+                os.remove(filename)
+        except OSError:
+            pass
+
+
+class CondensedScores:
+    """Symmetric scores matrix of which only the upper triangle, diagonal included, is stored row after row in a
+    one-dimensional array.
+
+    Supports the indexing patterns of numpy arrays used on scores matrices: `scores[i, j]`, selection of rows with an
+    integer, a slice, an array of indices or a boolean mask, optionally followed by a selection of columns
+    (eg. `scores[mask][:, mask]` or `scores[start:stop, cols]`) and element-wise selection with two arrays of indices.
+    Selected rows are returned as dense numpy arrays.
+
+    Args:
+        data: one-dimensional numpy array or `numpy.memmap` of length N×(N+1)/2.
+    """
+
+    ndim = 2
+
+    def __init__(self, data):
+        self.data = data
+        num_rows = int(round((math.sqrt(8 * len(data) + 1) - 1) / 2))
+        if num_rows * (num_rows + 1) // 2 != len(data):
+            raise ValueError(f"Can't build a condensed scores matrix from an array of length {len(data)}.")
+
+        # Position of the diagonal element of each row in `data`
+        rows = np.arange(num_rows + 1, dtype=np.int64)
+        self.offsets = rows * num_rows - rows * (rows - 1) // 2
+
+    @classmethod
+    def zeros(cls, num_rows, dtype=np.float32):
+        return cls(np.zeros(num_rows * (num_rows + 1) // 2, dtype=dtype))
+
+    @classmethod
+    def from_dense(cls, matrix):
+        """Build a condensed matrix from the upper triangle of a dense matrix."""
+
+        scores = cls.zeros(matrix.shape[0], dtype=matrix.dtype)
+        for i in range(matrix.shape[0]):
+            scores.data[scores.offsets[i]:scores.offsets[i+1]] = matrix[i, i:]
+        return scores
+
+    @property
+    def shape(self):
+        return self.offsets.size - 1, self.offsets.size - 1
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        array = self[:]
+        return array.astype(dtype) if dtype is not None else array
+
+    def toarray(self):
+        return self.__array__()
+
+    def _index(self, rows, cols):
+        """Position in `data` of the elements at `rows` and `cols`, which are broadcast together."""
+
+        rows, cols = np.broadcast_arrays(self._indices(rows), self._indices(cols))
+        i, j = np.minimum(rows, cols), np.maximum(rows, cols)
+        return self.offsets[i] + j - i
+
+    def _indices(self, key):
+        """Convert an integer, an array of indices or a boolean mask to an array of non-negative indices."""
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return np.flatnonzero(key)
+        return np.where(key < 0, key + self.shape[0], key).astype(np.int64)
+
+    def _rows(self, ids):
+        """Get a dense array of the rows given by `ids`."""
+
+        num_rows = self.shape[0]
+        block = np.empty((ids.size, num_rows), dtype=self.dtype)
+        for k, i in enumerate(ids):
+            block[k, i:] = self.data[self.offsets[i]:self.offsets[i+1]]
+            block[k, :i] = self.data[self.offsets[:i] + i - np.arange(i)]  # Column `i` of previous rows
+        return block
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            if isinstance(rows, slice) or isinstance(cols, slice):
+                block = self[rows]
+                return block[cols] if block.ndim == 1 else block[:, cols]
+            index = self._index(rows, cols)
+            return self.data[index] if index.ndim > 0 else self.data[int(index)]
+
+        if isinstance(key, slice):
+            return self._rows(np.arange(*key.indices(self.shape[0])))
+        ids = self._indices(key)
+        return self._rows(ids) if ids.ndim > 0 else self._rows(ids.reshape(1))[0]
+
+    def __setitem__(self, key, value):
+        """Set elements of the matrix.
+
+        `key` is either a pair of arrays of indices, or a pair of slices. In the latter case, only elements of the
+        block that are in the upper triangle are set.
+        """
+
+        rows, cols = key
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            value = np.asarray(value)
+            rows = range(*rows.indices(self.shape[0]))
+            cols = range(*cols.indices(self.shape[0]))
+            for k, i in enumerate(rows):
+                start = max(i, cols.start)
+                if start < cols.stop:
+                    offset = self.offsets[i] - i
+                    self.data[offset+start:offset+cols.stop] = value[k, start-cols.start:]
+        else:
+            self.data[self._index(rows, cols)] = value
+
+
+def iter_row_blocks(scores, block_size=ROW_BLOCK_SIZE):
+    """Iterate over blocks of consecutive rows of a scores matrix.
+
+    Yields:
+        tuple: index of the first row of the block and the block itself as a dense numpy array.
+    """
+
+    for start in range(0, scores.shape[0], block_size):
+        block = scores[start:start+block_size]
+        yield start, block.toarray() if sp.issparse(block) else np.asarray(block)
+
+
+def scores_storage(scores):
+    """Get the kind of storage of a scores matrix, as in `CosineComputationOptions.scores_storage`."""
+
+    if sp.issparse(scores):
+        return 'sparse'
+    elif isinstance(scores, CondensedScores):
+        return 'condensed'
+    elif isinstance(scores, np.memmap):
+        return 'memmap'
+    return 'dense'
+
+
+def is_mapped(scores):
+    """Check if a scores matrix is mapped from a file instead of being held in memory."""
+
+    if isinstance(scores, CondensedScores):
+        return isinstance(scores.data, np.memmap)
+    return isinstance(scores, np.memmap)
+
+
+def mapped_filename(scores):
+    """Get the file a scores matrix is mapped from, or None if it is held in memory."""
+
+    if isinstance(scores, CondensedScores):
+        scores = scores.data
+    return getattr(scores, 'filename', None) if isinstance(scores, np.memmap) else None
+
+
+def upper_triangle(scores, threshold, rows=None):
+    """Extract the upper triangle (diagonal included) of a scores matrix, keeping only scores strictly greater than
+    `threshold`.
+
+    Args:
+        rows: If not None, indices of the rows to extract. Other rows are not read.
+
+    Returns:
+        A `scipy.sparse.csr_matrix`, with one row for each row extracted.
+    """
+
+    if rows is not None:
+        rows = np.asarray(rows, dtype=int)
+        rows_ids, cols_ids, values = [], [], []
+        for start in range(0, rows.size, ROW_BLOCK_SIZE):
+            ids = rows[start:start+ROW_BLOCK_SIZE]
+            block = scores[ids]
+            block = block.toarray() if sp.issparse(block) else np.asarray(block)
+            r, c = np.nonzero((block > threshold) & (np.arange(block.shape[1]) >= ids[:, None]))
+            values.append(block[r, c])
+            rows_ids.append(r + start)
+            cols_ids.append(c)
+
+        if values:
+            rows_ids = np.concatenate(rows_ids)
+            cols_ids = np.concatenate(cols_ids)
+            values = np.concatenate(values)
+
+        return sp.csr_matrix((values, (rows_ids, cols_ids)), shape=(rows.size, scores.shape[1]), dtype=np.float32)
+
+    if isinstance(scores, CondensedScores):
+        # Rows of the upper triangle are stored contiguously
+        rows_ids, cols_ids, values = [], [], []
+        for start in range(0, scores.shape[0], ROW_BLOCK_SIZE):
+            stop = min(start + ROW_BLOCK_SIZE, scores.shape[0])
+            block = scores.data[scores.offsets[start]:scores.offsets[stop]]
+            index = np.flatnonzero(block > threshold) + scores.offsets[start]
+            r = np.searchsorted(scores.offsets, index, side='right') - 1
+            values.append(scores.data[index])
+            rows_ids.append(r)
+            cols_ids.append(index - scores.offsets[r] + r)
+        values = np.concatenate(values) if values else values
+        rows_ids = np.concatenate(rows_ids) if rows_ids else rows_ids
+        cols_ids = np.concatenate(cols_ids) if cols_ids else cols_ids
+        return sp.csr_matrix((values, (rows_ids, cols_ids)), shape=scores.shape, dtype=np.float32)
+
+    if sp.issparse(scores):
+        triu = sp.triu(scores, format='csr')
+        triu.data[triu.data <= threshold] = 0
+        triu.eliminate_zeros()
+        return triu
+
+    rows_ids, cols_ids, values = [], [], []
+    for start, block in iter_row_blocks(scores):
+        block = np.triu(block, k=start)
+        r, c = np.nonzero(block > threshold)
+        values.append(block[r, c])
+        rows_ids.append(r + start)
+        cols_ids.append(c)
+
+    if values:
+        rows_ids = np.concatenate(rows_ids)
+        cols_ids = np.concatenate(cols_ids)
+        values = np.concatenate(values)
+
+    return sp.csr_matrix((values, (rows_ids, cols_ids)), shape=scores.shape, dtype=np.float32)
+
+
+def rows_with_scores_above(scores, threshold, cols):
+    """Find rows of a scores matrix having at least one score strictly greater than `threshold` in columns `cols`.
+
+    Args:
+        cols (slice): columns to look at.
+    """
+
+    if sp.issparse(scores):
+        block = scores[:, cols].tocoo()
+        return np.unique(block.row[block.data > threshold])
+
+    rows = [np.array([], dtype=int)]
+    for start in range(0, scores.shape[0], ROW_BLOCK_SIZE):
+        block = np.asarray(scores[start:start+ROW_BLOCK_SIZE, cols])
+        rows.append(np.flatnonzero((block > threshold).any(axis=1)) + start)
+    return np.concatenate(rows)
+
+
+def count_scores_above(scores, threshold):
+    """Count, for each column of a scores matrix, the number of scores greater or equal than `threshold`.
+
+    Args:
+        scores: scores matrix, either a numpy array, a `numpy.memmap`, a `CondensedScores` or a `scipy.sparse`
+            matrix.
+        threshold (float): minimum score.
+    """
+
+    if sp.issparse(scores):
+        return np.asarray((scores >= threshold).sum(axis=0)).ravel()
+    elif isinstance(scores, (np.memmap, CondensedScores)):
+        counts = np.zeros(scores.shape[1], dtype=int)
+        for _, block in iter_row_blocks(scores):
+            counts += (block >= threshold).sum(axis=0)
+        return counts
+    return (scores >= threshold).sum(axis=0)
+
+
+def dense_submatrix(scores, mask):
+    """Extract the square sub-matrix of scores between nodes selected by `mask` as a dense numpy array.
+
+    Args:
+        scores: scores matrix, either a numpy array, a `numpy.memmap`, a `CondensedScores` or a `scipy.sparse`
+            matrix.
+        mask: boolean array or list of indices of the nodes to keep.
+    """
+
+    if sp.issparse(scores):
+        return scores[mask][:, mask].toarray()
+    elif isinstance(scores, (np.memmap, CondensedScores)):
+        ids = np.flatnonzero(mask) if np.asarray(mask).dtype == bool else np.asarray(mask)
+        submatrix = np.empty((ids.size, ids.size), dtype=scores.dtype)
+        for start in range(0, ids.size, ROW_BLOCK_SIZE):
+            submatrix[start:start+ROW_BLOCK_SIZE] = scores[ids[start:start+ROW_BLOCK_SIZE]][:, ids]
+        return submatrix
+    return scores[mask][:, mask]
+
+
+def scores_nbytes(scores):
+    """Number of bytes needed to store a scores matrix, as it is stored by `ScoresCache`."""
+
+    if sp.issparse(scores):
+        scores = scores.tocsr()
+        return scores.data.nbytes + scores.indices.nbytes + scores.indptr.nbytes
+    elif isinstance(scores, CondensedScores):
+        return scores.data.nbytes
+    return int(np.prod(scores.shape)) * np.dtype(scores.dtype).itemsize
+
+
+def scores_options(options):
+    """Get the options of a `CosineComputationOptions` that change the scores computed from filtered spectra.
+
+    Options used to read, filter or merge spectra are not included as they change the spectra themselves. Dense
+    matrices are stored the same way in memory and on disk, so both storages share the same options.
+    """
+
+    storage = options.get('scores_storage', 'dense')
+    names = ['mz_tolerance', 'min_matched_peaks', 'approximate_tables']
+    if storage in ('sparse', 'top_k'):
+        names.append('sparse_min_cosine')
+    if storage == 'top_k':
+        names.append('neighbours_top_k')
+    result = {name: options[name] for name in names if name in options}
+    result['scores_storage'] = 'dense' if storage == 'memmap' else storage
+    return result
+
+
+class ScoresCache:
+    """Persistent cache of scores matrices, stored in `path`.
+
+    Matrices are addressed by a hash of the spectra they were computed from and of the options used, or by a hash of
+    the keys of two sets of spectra for rectangular blocks of scores between them. When the total size of the cache
+    exceeds `max_size` bytes, least recently used matrices are removed. Matrices larger than `max_size` are not stored.
+    """
+
+    def __init__(self, path=SCORES_CACHE_PATH, max_size=SCORES_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(mzs, spectra, options):
+        """Compute the key of the scores matrix of `spectra`, computed using `options`.
+
+        Only options that change scores are used, see `scores_options`.
+        """
+
+        h = hashlib.sha1()
+        h.update(json.dumps(scores_options(options), sort_keys=True).encode())
+        h.update(np.asarray(mzs, dtype=np.float64).tobytes())
+        peaks, offsets = concatenate_spectra(spectra)
+        peaks = np.ascontiguousarray(peaks[offsets[0]:offsets[-1]])
+        h.update(peaks.dtype.str.encode())
+        h.update(np.diff(offsets).tobytes())
+        h.update(peaks.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def pair_key(first_key, second_key):
+        """Compute the key of the scores between two sets of spectra, given the keys of each set, see `key`."""
+
+        return hashlib.sha1(f'{first_key}:{second_key}'.encode()).hexdigest()
+
+    def _files(self, key):
+        return [os.path.join(self.path, f'{key}{ext}') for ext in ('.npy', '.npz', '.condensed.npy')]
+
+    def get(self, key, mmap=False):
+        """Get a scores matrix from the cache.
+
+        Args:
+            mmap (bool): If True, dense matrices are mapped from the cache file instead of being read in memory.
+
+        Returns:
+            The scores matrix or None if it is not in cache.
+        """
+
+        dense_file, sparse_file, condensed_file = self._files(key)
+        try:
+            if os.path.exists(sparse_file):
+                scores = sp.load_npz(sparse_file).tocsr()
+                filename = sparse_file
+            elif os.path.exists(condensed_file):
+                scores = CondensedScores(np.load(condensed_file, mmap_mode='r' if mmap else None))
+                filename = condensed_file
+            else:
+                scores = np.load(dense_file, mmap_mode='r' if mmap else None)
+                filename = dense_file
+        except (OSError, ValueError):
+            return
+
+        try:
+            os.utime(filename)  # Mark as recently used
+        except OSError:
+            pass
+
+        return scores
+
+    def put(self, key, scores):
+        """Add a scores matrix to the cache and remove least recently used matrices if needed.
+
+        Matrices larger than `max_size` are skipped without being written.
+        """
+
+        if scores_nbytes(scores) > self.max_size:
+            return
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            if sp.issparse(scores):
+                filename = self._files(key)[1]
+                with open(tmp_filename, 'wb') as f:
+                    sp.save_npz(f, scores.tocsr(), compressed=False)
+            elif isinstance(scores, CondensedScores):
+                filename = self._files(key)[2]
+                with open(tmp_filename, 'wb') as f:
+                    np.save(f, scores.data)
+            else:
+                filename = self._files(key)[0]
+                array = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=scores.dtype, shape=scores.shape)
+                for start, block in iter_row_blocks(scores):
+                    array[start:start+block.shape[0]] = block
+                array.flush()
+                del array
+            os.replace(tmp_filename, filename)
+        except OSError:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used matrices until the size of the cache is lower than `max_size`."""
+
+        evict_least_recently_used(os.path.join(self.path, '*.np[yz]'), self.max_size)
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Column of nodes' metadata holding the name of the file each spectrum was read from
+SOURCE_COLUMN = 'Source file'
+
+
+def sources_infos(sources, files, infos=None):
+    """Add a column with the name of the file each node was read from to nodes' metadata, if they were read from
+    several files.
+
+    Returns:
+        A `pandas.DataFrame`, created if `infos` is None, or `infos` itself if there is only one file.
+    """
+
+    if sources is None or files is None or len(files) < 2:
+        return infos
+    if infos is None:
+        infos = pd.DataFrame(index=pd.RangeIndex(len(sources)))
+    infos[SOURCE_COLUMN] = sources_column(sources, files)
+    return infos
+
+
+def sources_column(sources, files):
+    """Get the name of the file each node was read from."""
+
+    names = np.array([os.path.basename(name) for name in files], dtype=object)
+    return names[np.asarray(sources, dtype=int)]
+
+
+def append_sources(sources, files, new_sources, new_files):
+    """Concatenate the sources of appended spectra to the sources of the spectra already in a project.
+
+    Returns:
+        tuple: file ids of all spectra and list of all files, or (None, None) if the files of the spectra already in
+            the project are not known.
+    """
+
+    if sources is None or files is None:
+        return None, None
+    return np.concatenate((sources, np.asarray(new_sources) + len(files))), list(files) + list(new_files)
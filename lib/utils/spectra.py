@@ -0,0 +1,211 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from .cache import evict_least_recently_used
+from ..config import SPECTRA_CACHE_PATH, SPECTRA_CACHE_MAX_SIZE
+
+# Size of the blocks read at the start and at the end of files to hash them
+HASH_BLOCK_SIZE = 1024 ** 2
+
+
+class SpectraStore:
+    """Columnar storage of spectra.
+
+    Peaks of all spectra (m/z and intensity) are stored in a single contiguous `peaks` array, spectrum `i` being
+    `peaks[offsets[i]:offsets[i+1]]`, and parent masses in a parallel `mzs` array. Indexing with an integer returns a
+    view of the peaks of a spectrum, indexing with a slice returns a store sharing memory with this one and indexing
+    with an array of ids or a boolean mask returns a new store.
+    """
+
+    def __init__(self, mzs, peaks, offsets):
+        self.mzs = np.asarray(mzs, dtype=np.float64)
+        self.peaks = peaks
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_spectra(cls, mzs, spectra):
+        """Create a store from parent masses and a sequence of spectra."""
+
+        peaks, offsets = concatenate_spectra(spectra)
+        return cls(mzs, peaks, offsets)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Create a store holding the spectra of all given stores, one after the other."""
+
+        stores = list(stores)
+        mzs = np.concatenate([store.mzs for store in stores])
+        peaks = np.concatenate([store.peaks for store in stores])
+        sizes = np.concatenate([store.sizes for store in stores])
+        offsets = np.zeros(sizes.size + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return cls(mzs, peaks, offsets)
+
+    @property
+    def sizes(self):
+        """Number of peaks of each spectrum."""
+
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __iter__(self):
+        for start, stop in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.peaks[start:stop]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                return SpectraStore(self.mzs[start:stop], self.peaks[self.offsets[start]:self.offsets[stop]],
+                                    self.offsets[start:stop+1] - self.offsets[start])
+            index = np.arange(start, stop, step)
+        elif np.ndim(index) == 0:
+            index = int(index)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('spectrum index out of range')
+            return self.peaks[self.offsets[index]:self.offsets[index+1]]
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = np.where(index < 0, index + len(self), index)
+        starts, sizes = self.offsets[index], self.sizes[index]
+        offsets = np.zeros(index.size + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        peaks_ids = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return SpectraStore(self.mzs[index], self.peaks[peaks_ids], offsets)
+
+
+def concatenate_spectra(spectra):
+    """Get the peaks of all spectra as a single array, with the offsets of each spectrum in it.
+
+    Arrays of a `SpectraStore` are returned without any copy.
+
+    Returns:
+        tuple: peaks array and offsets array, see `SpectraStore`.
+    """
+
+    if isinstance(spectra, SpectraStore):
+        return spectra.peaks, spectra.offsets
+
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in spectra], out=offsets[1:])
+    if offsets[-1] > 0:
+        peaks = np.concatenate([np.asarray(data).reshape(-1, 2) for data in spectra])
+    else:
+        peaks = np.empty((0, 2), dtype=np.float32)
+    return peaks, offsets
+
+
+class SpectraCache:
+    """Persistent cache of parsed and filtered spectra, stored in `path`.
+
+    Each entry is a single binary file holding the three arrays of a `SpectraStore`, one after the other in `.npy`
+    format, so that peaks can be memory-mapped instead of being read, optionally followed by the positions of spectra
+    in the file they were read from. Entries are addressed by the path, size, modification time and first and last
+    blocks of the file spectra were read from and by the filtering options used. When the total size of the cache
+    exceeds `max_size` bytes, least recently used entries are removed.
+    """
+
+    FILTER_OPTIONS = ('min_intensity', 'parent_filter_tolerance', 'matched_peaks_window', 'min_matched_peaks_search')
+
+    def __init__(self, path=SPECTRA_CACHE_PATH, max_size=SPECTRA_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def key(cls, filename, options):
+        """Compute the key of spectra read from `filename` and filtered using `options`."""
+
+        stat = os.stat(filename)
+        h = hashlib.sha1()
+        h.update(json.dumps({k: options[k] for k in cls.FILTER_OPTIONS}, sort_keys=True).encode())
+        h.update(os.path.normcase(os.path.realpath(filename)).encode())
+        h.update(np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64).tobytes())
+        with open(filename, 'rb') as f:
+            h.update(f.read(HASH_BLOCK_SIZE))
+            if stat.st_size > HASH_BLOCK_SIZE:
+                f.seek(max(HASH_BLOCK_SIZE, stat.st_size - HASH_BLOCK_SIZE))
+                h.update(f.read(HASH_BLOCK_SIZE))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.spectra')
+
+    def get(self, key, positions=False):
+        """Get spectra from the cache.
+
+        Args:
+            positions (bool): If True, also get the positions of spectra in the file they were read from, as given to
+                `put`.
+
+        Returns:
+            A `SpectraStore` which peaks are mapped from the cache file, or None if spectra are not in cache. If
+            `positions` is True, a tuple of the store and an array of positions (None if they were not cached) is
+            returned instead.
+        """
+
+        filename = self._file(key)
+        try:
+            arrays = []
+            size = os.path.getsize(filename)
+            with open(filename, 'rb') as f:
+                while f.tell() < size:
+                    if np.lib.format.read_magic(f) == (1, 0):
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                    else:
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                    offset = f.tell()
+                    arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                            order='F' if fortran_order else 'C') if np.prod(shape) > 0
+                                  else np.empty(shape, dtype=dtype))
+                    f.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+            os.utime(filename)  # Mark as recently used
+        except (OSError, ValueError):
+            return (None, None) if positions else None
+
+        if len(arrays) < 3:
+            return (None, None) if positions else None
+
+        mzs, offsets, peaks = arrays[:3]
+        spectra = SpectraStore(np.array(mzs), peaks, np.array(offsets))
+        if positions:
+            return spectra, np.array(arrays[3]) if len(arrays) > 3 else None
+        return spectra
+
+    def put(self, key, spectra, positions=None):
+        """Add a `SpectraStore` to the cache, optionally with the positions of spectra in the file they were read
+        from, and remove least recently used entries if needed."""
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                peaks, offsets = concatenate_spectra(spectra)
+                arrays = [spectra.mzs, offsets - offsets[0], peaks[offsets[0]:offsets[-1]]]
+                if positions is not None:
+                    arrays.append(positions)
+                for array in arrays:
+                    np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp_filename, self._file(key))
+        except OSError:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the size of the cache is lower than `max_size`."""
+
+        evict_least_recently_used(os.path.join(self.path, '*.spectra'), self.max_size)
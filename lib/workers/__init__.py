@@ -5,6 +5,7 @@ from .network import NetworkWorker
 from .network_generation import NetworkVisualizationOptions, GenerateNetworkWorker
 from .cosine import ComputeScoresWorker, CosineComputationOptions
 from .read_mgf import ReadMGFWorker
+from .pipeline import ReadMGFComputeScoresWorker
 from .read_metadata import ReadMetadataOptions, ReadMetadataWorker
 from .read_group_mapping import ReadGroupMappingWorker
 from .project import LoadProjectWorker, SaveProjectWorker
@@ -1,7 +1,15 @@
+import os
+import logging
+
+import numpy as np
+
 from .base import BaseWorker
 from ..utils import AttrDict
 
-from libmetgem.cosine import compute_distance_matrix
+from ..utils.cosine import compute_scores, find_candidate_pairs, BlockScores, PIPELINE_BLOCK_SIZE
+from ..utils.scores import scores_storage, ScoresCache
+from ..utils.lsh import find_approximate_pairs
+from ..utils.spectra import SpectraStore
 
 
 class CosineComputationOptions(AttrDict):
@@ -15,6 +23,28 @@ class CosineComputationOptions(AttrDict):
         min_matched_peaks_search (int): Window rank filter's parameters: for each peak in the spectrum, 
             it is kept only if it is in top `min_matched_peaks_search` in the +/-`matched_peaks_window` window.
         matched_peaks_window (int): in Da.
+        scores_storage (str): How scores are stored. 'dense' keeps the full matrix in memory, 'memmap' keeps the
+            full matrix in a file on disk, 'sparse' only keeps pairs with a score above or equal to
+            `sparse_min_cosine`, 'condensed' keeps only the upper triangle of the matrix in memory, 'top_k' only keeps
+            the `neighbours_top_k` best scores of each spectrum, which is enough to generate the network.
+        sparse_min_cosine (float): Minimum cosine score for a pair to be kept when using sparse or top-K storage.
+            Should be lower than the thresholds used for network and t-SNE generation.
+        neighbours_top_k (int): Number of best scores kept for each spectrum when using top-K storage. Should not be
+            lower than the `top_k` used for network generation.
+        prune_pairs (bool): If True, pairs of spectra that do not have enough peaks in common to get a non-zero
+            score are found using an index of fragments and neutral losses and are not scored.
+        approximate_tables (int): If greater than zero, only pairs of spectra found similar by
+            `find_approximate_pairs` using this number of hash tables are scored, other scores are set to zero.
+            More tables find more of the high-scoring pairs but score more pairs. Intended for large datasets where
+            exact scoring is too slow, `prune_pairs` is ignored in this case.
+        merge_spectra (bool): If True, spectra with parent masses within `mz_tolerance` and a cosine score of at least
+            `merge_min_cosine` are merged into consensus spectra after filtering, before scoring.
+        merge_min_cosine (float): Minimum cosine score for two spectra to be merged.
+        filter_engine (str): How spectra are filtered. 'libmetgem' filters spectra one by one using
+            `libmetgem.filter.filter_data_multi`, 'vectorized' filters all spectra at once using
+            `lib.utils.filtering.filter_peaks`. Both give the same spectra.
+        pipelined (bool): If True, spectra are scored by blocks while the following spectra are still being read and
+            filtered, see `ReadMGFComputeScoresWorker`. Ignored when merging spectra or using approximate search.
 
     """
 
@@ -25,32 +55,169 @@ class CosineComputationOptions(AttrDict):
                          min_matched_peaks=4,
                          min_matched_peaks_search=6,
                          matched_peaks_window=50,
+                         scores_storage='dense',
+                         sparse_min_cosine=0.3,
+                         neighbours_top_k=10,
+                         prune_pairs=True,
+                         approximate_tables=0,
+                         merge_spectra=False,
+                         merge_min_cosine=0.95,
+                         filter_engine='libmetgem',
+                         pipelined=False,
                          **kwargs)
 
 
 class ComputeScoresWorker(BaseWorker):
     """Generate a network from a MGF file.
+
+    If `previous_scores`, the scores matrix of the first spectra, is given, only scores involving spectra appended
+    after them are computed. The resulting matrix uses the same storage as `previous_scores`.
+
+    Spectra are converted to a `SpectraStore` if they are not already stored in one.
+
+    If a `ScoresCache` is given as `cache`, scores are taken from it when the same spectra were already scored with the
+    same options, and are added to it otherwise.
+
+    If spectra were read from several files, `sources` gives the file id of each spectrum. Spectra of each file are
+    then scored by blocks of at most `block_size` spectra using a `BlockScores` and, when `cache` is given, each pair of
+    blocks is cached separately, so that scoring the same files again with an additional one only computes the scores
+    involving the new file. Approximate search does not support this and scores all spectra at once.
     """
 
-    def __init__(self, mzs, spectra, options):
+    def __init__(self, mzs, spectra, options, use_multiprocessing=False, previous_scores=None, cache=None,
+                 sources=None, block_size=PIPELINE_BLOCK_SIZE):
         super().__init__()
-        self._mzs = mzs
+        if not isinstance(spectra, SpectraStore):
+            spectra = SpectraStore.from_spectra(mzs, spectra)
+        self._mzs = spectra.mzs
         self._spectra = spectra
+        self._previous_scores = previous_scores
+        self._cache = cache if previous_scores is None else None
         self.options = options
+        self._processes = os.cpu_count() if use_multiprocessing else 1
         self._num_spectra = len(self._spectra)
-        self.max = self._num_spectra * (self._num_spectra - 1) // 2
+        self._start = previous_scores.shape[0] if previous_scores is not None else 0
+        self.max = self._num_spectra * (self._num_spectra - 1) // 2 - self._start * (self._start - 1) // 2
         self.iterative_update = True
         self.desc = 'Computing scores...'
+        self.pruned_pairs = 0  # Pairs that can not have a non-zero score and were not scored
+        self.approximated_pairs = 0  # Pairs not found similar by approximate search, set to zero without scoring
+        self._blocks = None
+        if sources is not None and previous_scores is None and options.approximate_tables <= 0:
+            self._blocks = self.source_blocks(sources, block_size)
+
+    @staticmethod
+    def source_blocks(sources, block_size=PIPELINE_BLOCK_SIZE):
+        """Split spectra in blocks of consecutive spectra from the same file, with at most `block_size` spectra.
+
+        Returns:
+            list: (start, stop) indices of blocks, or None if all spectra come from the same file.
+        """
+
+        sources = np.asarray(sources)
+        bounds = np.r_[0, np.flatnonzero(np.diff(sources)) + 1, sources.size]
+        if bounds.size <= 2:
+            return
+
+        blocks = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            blocks.extend((int(i), int(min(i + block_size, stop))) for i in range(start, stop, block_size))
+        return blocks
 
     def run(self):
         def callback(value):
             self.updated.emit(value)
             return not self.isStopped()
 
-        scores_matrix = compute_distance_matrix(self._mzs, self._spectra,
-                                                self.options.mz_tolerance, self.options.min_matched_peaks,
-                                                callback=callback)
+        if self._blocks is not None:
+            return self.compute_blocks()
+
+        key = None
+        if self._cache is not None:
+            key = self._cache.key(self._mzs, self._spectra, self.options)
+            scores_matrix = self._cache.get(key, mmap=self.options.scores_storage == 'memmap')
+            if scores_matrix is not None:
+                logging.getLogger().info(f'Scores loaded from cache ({key})')
+                self.updated.emit(self.max)
+                return scores_matrix
+
+        candidates = None
+        if self.options.approximate_tables > 0:
+            candidates = find_approximate_pairs(self._mzs, self._spectra,
+                                                self.options.mz_tolerance, self.options.approximate_tables,
+                                                start=self._start)
+        elif self.options.prune_pairs:
+            candidates = find_candidate_pairs(self._mzs, self._spectra,
+                                              self.options.mz_tolerance, self.options.min_matched_peaks,
+                                              start=self._start)
+
+        if candidates is not None:
+            skipped = self.max - len(candidates[0])
+            if self.options.approximate_tables > 0:
+                self.approximated_pairs = skipped
+                logging.getLogger().info(f'{skipped} of {self.max} pairs of spectra skipped by approximate search')
+                self.desc = f'Computing scores ({skipped} pairs skipped by approximate search)...'
+            else:
+                self.pruned_pairs = skipped
+                logging.getLogger().info(f'{skipped} of {self.max} pairs of spectra pruned before scoring')
+                self.desc = f'Computing scores ({skipped} pairs pruned)...'
+            if not callback(skipped):
+                self.canceled.emit()
+                return
+
+        storage = self.options.scores_storage
+        if self._previous_scores is not None \
+                and (storage, scores_storage(self._previous_scores)) != ('top_k', 'sparse'):
+            storage = scores_storage(self._previous_scores)
+
+        scores_matrix = compute_scores(self._mzs, self._spectra,
+                                       self.options.mz_tolerance, self.options.min_matched_peaks,
+                                       storage=storage, min_cosine=self.options.sparse_min_cosine,
+                                       top_k=self.options.neighbours_top_k,
+                                       processes=self._processes, candidates=candidates,
+                                       previous=self._previous_scores, callback=callback)
         if not self.isStopped():
+            if key is not None:
+                self._cache.put(key, scores_matrix)
             return scores_matrix
         else:
             self.canceled.emit()
+
+    def compute_blocks(self):
+        """Score spectra by blocks, see `BlockScores`."""
+
+        reported = 0
+
+        def report():
+            nonlocal reported
+            self.updated.emit(scorer.scored_pairs - reported)
+            reported = scorer.scored_pairs
+            return not self.isStopped()
+
+        scorer = BlockScores(self.options.mz_tolerance, self.options.min_matched_peaks,
+                             storage=self.options.scores_storage, min_cosine=self.options.sparse_min_cosine,
+                             top_k=self.options.neighbours_top_k, prune_pairs=self.options.prune_pairs,
+                             processes=self._processes, cache=self._cache, options=self.options,
+                             num_spectra=self._num_spectra)
+        try:
+            for start, stop in self._blocks:
+                scorer.add(self._spectra[start:stop])
+                scorer.collect(wait=False)
+                if not report():
+                    self.canceled.emit()
+                    return
+
+            while scorer.pending > 0:
+                scorer.collect(max_pending=scorer.pending - 1)
+                if not report():
+                    self.canceled.emit()
+                    return
+
+            scores_matrix = scorer.result()
+        finally:
+            scorer.close()
+
+        if scorer.cached_pairs > 0:
+            logging.getLogger().info(f'Scores of {scorer.cached_pairs} of {self.max} pairs of spectra '
+                                     'loaded from cache')
+        return scores_matrix
@@ -1,13 +1,16 @@
 from ..base import BaseWorker
 from ...database import DataBaseBuilder
+from ...utils.mgf import is_mgf_file
 
 import os
 
 
 class ConvertDatabasesWorker(BaseWorker):
 
-    def __init__(self, ids: list, output_path: str, input_path: str=None, names: list=None):
+    def __init__(self, ids: list, output_path: str, input_path: str=None, names: list=None,
+                 use_multiprocessing: bool=False):
         super().__init__()
+        self._processes = os.cpu_count() if use_multiprocessing else 1
         self.ids = ids
         self.input_path = input_path if input_path is not None else output_path
         self.output_path = output_path
@@ -21,10 +24,10 @@ class ConvertDatabasesWorker(BaseWorker):
 
         with DataBaseBuilder(os.path.join(self.input_path, 'spectra')) as db:
             for i, (id_, name) in enumerate(zip(self.ids, self.names)):
-                id_ = f'{id_}.mgf' if not id_.endswith('.mgf') else id_
+                id_ = f'{id_}.mgf' if not is_mgf_file(id_) else id_
                 path = os.path.join(self.input_path, id_)
                 if os.path.exists(path):
-                    db.add_bank(path, name=name)
+                    db.add_bank(path, name=name, processes=self._processes)
                 self.updated.emit(i)
                 converted_ids.append(id_)
 
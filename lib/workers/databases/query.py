@@ -2,6 +2,7 @@ from ..base import BaseWorker
 from ..cosine import CosineComputationOptions
 from ...database import SpectraLibrary, Bank
 from ...config import SQL_PATH, get_debug_flag
+from ...utils.spectra import SpectraStore
 
 import operator
 from collections import namedtuple
@@ -32,11 +33,16 @@ class QueryDatabasesOptions(CosineComputationOptions):
 
 
 class QueryDatabasesWorker(BaseWorker):
+    """Query spectral libraries for the spectra at `indices` of a project.
+
+    `spectra` is a `SpectraStore` of these spectra, or a sequence of spectra with their parent masses given as `mzs`.
+    """
 
     def __init__(self, indices, mzs, spectra, options):
         super().__init__()
+        if not isinstance(spectra, SpectraStore):
+            spectra = SpectraStore.from_spectra(mzs, spectra)
         self._indices = list(indices)
-        self._mzs = mzs
         self._spectra = spectra
         self.options = options
         self.max = 0
@@ -55,7 +61,7 @@ class QueryDatabasesWorker(BaseWorker):
 
         # Query database
         analog_mz_tolerance = self.options.analog_mz_tolerance if self.options.analog_search else 0
-        qr = query(SQL_PATH, self._indices, self._mzs, self._spectra, self.options.databases,
+        qr = query(SQL_PATH, self._indices, self._spectra.mzs.tolist(), list(self._spectra), self.options.databases,
                    self.options.mz_tolerance, self.options.min_matched_peaks, self.options.min_intensity,
                    self.options.parent_filter_tolerance, self.options.matched_peaks_window,
                    self.options.min_matched_peaks_search, self.options.min_cosine, analog_mz_tolerance,
@@ -1,9 +1,29 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
 from .base import BaseWorker
 from ..utils import AttrDict
 from ..config import RADIUS
-from libmetgem.network import generate_network
+from ..utils.scores import rows_with_scores_above
 
+import igraph as ig
 import numpy as np
+import scipy.sparse as sp
+
+INTERACTIONS_DTYPE = [('Source', int), ('Target', int), ('Delta MZ', np.float32), ('Cosine', np.float32)]
+
+# Approximate number of scores read at once when gathering candidate edges
+CANDIDATES_BLOCK_ELEMENTS = 4 * 1024 ** 2
+
+# Methods that can be used to split connected components larger than `max_connected_nodes`
+SPLIT_METHODS = ('weakest_edges', 'communities')
+
+# Seed of the random number generator used by community detection, so that splitting is reproducible
+COMMUNITIES_SEED = 0
+
+# Rows having more valid scores than their number of columns divided by this are partitioned before being sorted
+PARTITION_MIN_DENSITY = 16
 
 
 class NetworkVisualizationOptions(AttrDict):
@@ -13,40 +33,365 @@ class NetworkVisualizationOptions(AttrDict):
         top_k (int): Maximum numbers of edges for each nodes in the network. Default value = 10
         pairs_min_cosine (float): Minimum cosine score for network generation. Default value = 0.65
         max_connected_nodes (int): Maximum size of a Network cluster. Default value = 1000
+        split_method (str): How clusters larger than `max_connected_nodes` are split, one of `SPLIT_METHODS`.
+            'weakest_edges' removes edges with the smallest cosine scores, 'communities' removes edges between
+            communities found by modularity optimization. Default value = 'weakest_edges'
 
     """
     
     def __init__(self):
         super().__init__(top_k=10,
                          pairs_min_cosine=0.65,
-                         max_connected_nodes=1000)
+                         max_connected_nodes=1000,
+                         split_method='weakest_edges')
+
+
+def mutual_top_k(interactions, top_k):
+    """Keep only edges between two nodes if and only if each of the node appears in each other's
+    respective `top_k` most similar nodes.
+
+    Args:
+        interactions (numpy structured array): candidate edges, sorted by decreasing cosine score.
+        top_k (int): Maximum numbers of edges for each nodes.
+    """
+
+    num_edges = interactions.shape[0]
+    sources = interactions['Source']
+    targets = interactions['Target']
+
+    # List each edge once for each of its ends (only once for self-loops), then rank edges of each node
+    # following the order of `interactions`
+    not_loop = sources != targets
+    nodes = np.concatenate((sources, targets[not_loop]))
+    edges = np.concatenate((np.arange(num_edges), np.flatnonzero(not_loop)))
+    order = np.lexsort((edges, nodes))
+    nodes, edges = nodes[order], edges[order]
+    starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+    ranks = np.arange(nodes.size) - np.repeat(starts, np.diff(np.r_[starts, nodes.size]))
+
+    mask = np.ones(num_edges, dtype=bool)
+    mask[edges[ranks >= top_k]] = False
+    return interactions[mask]
+
+
+def _row_block_size(num_cols):
+    """Number of rows of a scores matrix processed at once so that a block holds about `CANDIDATES_BLOCK_ELEMENTS`
+    scores."""
+
+    return max(1, CANDIDATES_BLOCK_ELEMENTS // max(1, num_cols))
+
+
+def block_top_k(scores_matrix, ids, threshold, top_k):
+    """Find the `top_k` best scores strictly greater than `threshold` in the upper triangle of some rows of a scores
+    matrix, ties being broken in favour of the highest column.
+
+    Valid scores are gathered as (row, column, value) triplets and sorted. Rows where valid scores are too many to be
+    sorted cheaply first have their k-th best score found with `numpy.partition`, and only scores greater or equal to
+    it are kept.
+
+    Args:
+        ids (numpy.ndarray): sorted indices of the rows.
+
+    Returns:
+        tuple: rows, columns and values of the selected scores, sorted by row, decreasing score and decreasing column.
+    """
+
+    if ids.size > 0 and ids[-1] - ids[0] + 1 == ids.size:
+        block = scores_matrix[ids[0]:ids[-1]+1]  # Contiguous rows can be read without fancy indexing
+    else:
+        block = scores_matrix[ids]
+    block = block.toarray() if sp.issparse(block) else np.asarray(block)
+
+    # Columns before the first row are in the lower triangle for all rows of the block
+    first = int(ids[0]) if ids.size > 0 else 0
+    block = block[:, first:]
+    num_cols = block.shape[1]
+    r, c = np.nonzero(block > threshold)
+    c = c + first
+    upper = c >= ids[r]
+    r, c = r[upper], c[upper]
+    v = block[r, c - first]
+
+    counts = np.bincount(r, minlength=ids.size)
+    crowded = np.flatnonzero(counts > max(top_k, num_cols // PARTITION_MIN_DENSITY))
+    if crowded.size > 0:
+        in_crowded = np.isin(r, crowded)
+        valid = np.full((crowded.size, num_cols), -np.inf, dtype=block.dtype)
+        valid[np.searchsorted(crowded, r[in_crowded]), c[in_crowded] - first] = v[in_crowded]
+        kth = np.full(ids.size, -np.inf, dtype=block.dtype)
+        kth[crowded] = np.partition(valid, num_cols - top_k, axis=1)[:, num_cols - top_k]
+        keep = v >= kth[r]
+        r, c, v = r[keep], c[keep], v[keep]
+
+    order = np.lexsort((-c, -v, r))
+    r, c, v = r[order], c[order], v[order]
+    ranks = np.arange(r.size) - np.searchsorted(r, r)
+    keep = ranks < top_k
+    return ids[r[keep]], c[keep], v[keep]
+
+
+def network_candidates(scores_matrix, mzs, pairs_min_cosine, top_k, rows=None, processes=1, callback=None):
+    """Gather candidate edges of the network, ie. the `top_k` best scores strictly greater than `pairs_min_cosine` in
+    each row of the upper triangle of `scores_matrix`.
+
+    Rows are processed by blocks using `block_top_k`, in `processes` threads if greater than 1, so that only the
+    candidates of each row are kept in memory.
+
+    Args:
+        rows: If not None, indices of the rows to look at. Other rows are not read.
+        callback: Called with the number of rows processed so far after each block. If it returns False, gathering
+            stops and None is returned.
+
+    Returns:
+        numpy structured array: candidate edges, sorted by source, decreasing cosine score and decreasing target, like
+            in `libmetgem.network.generate_network`.
+    """
+
+    num_nodes = min(scores_matrix.shape[0], len(mzs))
+    rows = np.arange(scores_matrix.shape[0]) if rows is None else np.unique(np.asarray(rows, dtype=int))
+    rows = rows[rows < num_nodes]
+    threshold = max(0, pairs_min_cosine)
+
+    block_size = _row_block_size(scores_matrix.shape[1])
+    blocks = [rows[start:start+block_size] for start in range(0, rows.size, block_size)]
+    if top_k <= 0:
+        blocks = []
+
+    def task(ids):
+        return block_top_k(scores_matrix, ids, threshold, top_k)
+
+    sources, targets, values = [np.array([], dtype=int)], [np.array([], dtype=int)], [np.array([], dtype=np.float32)]
+    executor = ThreadPoolExecutor(processes) if processes > 1 and len(blocks) > 1 else None
+    try:
+        results = executor.map(task, blocks) if executor is not None else map(task, blocks)
+        done = 0
+        for ids, (r, c, v) in zip(blocks, results):
+            sources.append(r)
+            targets.append(c)
+            values.append(v)
+            done += ids.size
+            if callback is not None and not callback(done):
+                return
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    sources, targets, values = np.concatenate(sources), np.concatenate(targets), np.concatenate(values)
+    keep = targets < num_nodes
+
+    mzs = np.asarray(mzs)
+    candidates = np.empty(np.count_nonzero(keep), dtype=INTERACTIONS_DTYPE)
+    candidates['Source'] = sources[keep]
+    candidates['Target'] = targets[keep]
+    candidates['Delta MZ'] = mzs[candidates['Source']] - mzs[candidates['Target']]
+    candidates['Cosine'] = values[keep]
+    return candidates[np.lexsort((-candidates['Target'], -candidates['Cosine'], candidates['Source']))]
+
+
+def select_interactions(candidates, top_k):
+    """Sort candidate edges given by `network_candidates` by decreasing cosine score and apply `mutual_top_k`."""
+
+    interactions = candidates[np.argsort(candidates['Cosine'], kind='mergesort')[::-1]]
+    return mutual_top_k(interactions, top_k)
+
+
+class CandidateEdges:
+    """Candidate edges gathered by `network_candidates` with given options, kept to derive the network for stricter
+    options without reading scores again.
+
+    As candidates of each source are sorted by decreasing score, the candidates gathered with a higher threshold or a
+    smaller `top_k` are the ones above this threshold with a rank lower than `top_k` among candidates of their source.
+
+    Attributes:
+        edges (numpy structured array): candidate edges, as returned by `network_candidates`.
+        pairs_min_cosine (float): minimum cosine score used to gather candidates.
+        top_k (int): maximum number of candidates kept for each source.
+        ranks (numpy.ndarray): rank of each candidate among candidates of its source.
+    """
+
+    def __init__(self, edges, pairs_min_cosine, top_k):
+        self.edges = edges
+        self.pairs_min_cosine = max(0, pairs_min_cosine)
+        self.top_k = top_k
+        sources = edges['Source']
+        self.ranks = np.arange(sources.size) - np.searchsorted(sources, sources)
+
+    def __len__(self):
+        return self.edges.size
+
+    def covers(self, pairs_min_cosine, top_k):
+        """Check if candidates for `pairs_min_cosine` and `top_k` can be derived from these candidates."""
+
+        return max(0, pairs_min_cosine) >= self.pairs_min_cosine and top_k <= self.top_k
+
+    def restrict(self, pairs_min_cosine, top_k):
+        """Get the candidate edges that `network_candidates` would return with `pairs_min_cosine` and `top_k`.
+
+        Raises:
+            ValueError: if these options are less strict than the ones used to gather candidates.
+        """
+
+        if not self.covers(pairs_min_cosine, top_k):
+            raise ValueError(f'Candidates were gathered with a minimum cosine of {self.pairs_min_cosine} '
+                             f'and a top-K of {self.top_k}')
+        if max(0, pairs_min_cosine) == self.pairs_min_cosine and top_k == self.top_k:
+            return self.edges
+        return self.edges[(self.edges['Cosine'] > max(0, pairs_min_cosine)) & (self.ranks < top_k)]
+
+
+def split_component(sources, targets, weights, max_size):
+    """Find the edges to remove from a connected component so that none of the resulting components has more than
+    `max_size` nodes.
+
+    The result is the same as removing edges one at a time by increasing weight (ties broken by increasing position)
+    until all components are small enough, but edges are sorted only once: they are added back in the reverse order
+    to a union-find structure tracking the size of components, until an edge would join two components into one
+    larger than `max_size`. This edge and all lighter ones are removed.
+
+    Args:
+        sources, targets (numpy.ndarray): nodes of each edge.
+        weights (numpy.ndarray): weight of each edge.
+
+    Returns:
+        numpy.ndarray: indices of edges to remove.
+    """
+
+    nodes, ends = np.unique(np.concatenate((sources, targets)), return_inverse=True)
+    num_edges = len(sources)
+    sources, targets = ends[:num_edges].tolist(), ends[num_edges:].tolist()
+    parents = list(range(nodes.size))
+    sizes = [1] * nodes.size
+
+    def find(x):
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    order = np.lexsort((np.arange(num_edges), weights))[::-1]
+    for count, e in enumerate(order.tolist()):
+        a, b = find(sources[e]), find(targets[e])
+        if a == b:
+            continue
+        if sizes[a] + sizes[b] > max_size:
+            return order[count:]
+        if sizes[a] < sizes[b]:
+            a, b = b, a
+        parents[b] = a
+        sizes[a] += sizes[b]
+    return order[:0]
+
+
+def split_communities(sources, targets, weights, max_size):
+    """Find the edges to remove from a connected component so that none of the resulting components has more than
+    `max_size` nodes, by removing edges between communities.
+
+    Communities are found with the multilevel (Louvain) modularity optimization of igraph, using weights of edges,
+    which runs in near-linear time even on very large components. Edges between two communities are removed, then
+    communities still larger than `max_size` are split with `split_component`.
+
+    Args:
+        sources, targets (numpy.ndarray): nodes of each edge.
+        weights (numpy.ndarray): weight of each edge.
+
+    Returns:
+        numpy.ndarray: sorted indices of edges to remove.
+    """
+
+    nodes, ends = np.unique(np.concatenate((sources, targets)), return_inverse=True)
+    ends = ends.reshape(2, -1)
+    component = ig.Graph(n=nodes.size, edges=ends.T.tolist())
+
+    # igraph draws random numbers from the `random` module
+    state = random.getstate()
+    random.seed(COMMUNITIES_SEED)
+    try:
+        membership = component.community_multilevel(weights=np.asarray(weights, dtype=float).tolist()).membership
+    finally:
+        random.setstate(state)
+
+    communities = np.asarray(membership)[ends]
+    inner = communities[0] == communities[1]
+    removed = [np.flatnonzero(~inner)]
+    inner = np.flatnonzero(inner)
+    for c in np.flatnonzero(np.bincount(membership) > max_size):
+        ids = inner[communities[0, inner] == c]
+        removed.append(ids[split_component(sources[ids], targets[ids], weights[ids], max_size)])
+    return np.sort(np.concatenate(removed))
 
 
 class GenerateNetworkWorker(BaseWorker):
-    def __init__(self, scores, mzs, graph, options, keep_vertices=False):
+    """Generate edges of the network from a scores matrix.
+
+    Candidate edges are gathered with `network_candidates`, by blocks of rows processed in parallel threads if
+    `use_multiprocessing` is True, and are available in the worker's `candidates` attribute as `CandidateEdges`. If
+    `candidates` from a previous run are given and were gathered with options at most as strict as the current ones,
+    edges are derived from them without reading scores. If `first_appended`, the index of the first node appended to
+    the scores matrix since then, is also given, only rows having scores with appended nodes are read again.
+    """
+
+    def __init__(self, scores, mzs, graph, options, keep_vertices=False, candidates=None, first_appended=None,
+                 use_multiprocessing=False):
         super().__init__()
+        self._processes = os.cpu_count() if use_multiprocessing else 1
         self._scores = scores
         self._mzs = mzs
         self._graph = graph
         self._keep_vertices = keep_vertices
+        self._candidates = candidates
+        self._first_appended = first_appended
+        self.candidates = None
         self.options = options
         self.max = len(mzs)
         self.iterative_update = False
         self.desc = 'Generating Network...'
 
+    def update_candidates(self, callback=None):
+        """Gather candidate edges, reusing `candidates` if they cover the current options.
+
+        Reused candidates keep the options they were gathered with, so that going back to less strict options does
+        not need to read scores again either.
+
+        Returns:
+            CandidateEdges: candidate edges, or None if `callback` returned False.
+        """
+
+        cached = self._candidates
+        if cached is not None and not cached.covers(self.options.pairs_min_cosine, self.options.top_k):
+            cached = None
+        if cached is not None and self._first_appended is None:
+            return cached
+
+        pairs_min_cosine, top_k = self.options.pairs_min_cosine, self.options.top_k
+        rows = None
+        if cached is not None:
+            pairs_min_cosine, top_k = cached.pairs_min_cosine, cached.top_k
+            rows = rows_with_scores_above(self._scores, pairs_min_cosine, slice(self._first_appended, None))
+            rows = np.union1d(rows, np.arange(self._first_appended, self._scores.shape[0]))
+
+        edges = network_candidates(self._scores, self._mzs, pairs_min_cosine, top_k, rows=rows,
+                                   processes=self._processes, callback=callback)
+        if edges is None:
+            return
+        if rows is not None:
+            kept = cached.edges[~np.isin(cached.edges['Source'], rows)]
+            edges = np.concatenate((kept, edges))
+            edges = edges[np.lexsort((-edges['Target'], -edges['Cosine'], edges['Source']))]
+
+        return CandidateEdges(edges, pairs_min_cosine, top_k)
+
     def run(self):
         def callback(value):
-            if value < 0:
-                 self.max += -value
-            else:
-                self.updated.emit(value)
+            self.updated.emit(value)
             return not self.isStopped()
 
         # Create edges table (filter score below a threshold and apply TopK algorithm
-        interactions = generate_network(self._scores, self._mzs,
-                                        self.options.pairs_min_cosine,
-                                        self.options.top_k,
-                                        callback=callback)
+        self.candidates = self.update_candidates(callback=callback)
+        if self.candidates is None or not callback(len(self._mzs)):
+            self.canceled.emit()
+            return
+        candidates = self.candidates.restrict(self.options.pairs_min_cosine, self.options.top_k)
+        interactions = select_interactions(candidates, self.options.top_k)
 
         # Recreate graph deleting all previously created edges and eventually nodes
         graph = self._graph
@@ -55,6 +400,8 @@ class GenerateNetworkWorker(BaseWorker):
             graph.delete_vertices(graph.vs)
             nodes_idx = np.arange(self._scores.shape[0])
             graph.add_vertices(nodes_idx.tolist())
+        elif graph.vcount() < self._scores.shape[0]:
+            graph.add_vertices(np.arange(graph.vcount(), self._scores.shape[0]).tolist())
 
         # Add edges from edges table
         graph.add_edges(zip(interactions['Source'], interactions['Target']))
@@ -69,36 +416,33 @@ class GenerateNetworkWorker(BaseWorker):
             widths = RADIUS
         graph.es['__width'] = widths
 
-        # Max Connected Components option: split large clusters by removing edges with smaller weights until
-        # cluster size is lower than the desired value
-        graph.es['__index'] = graph.es.indices
+        # Max Connected Components option: split large clusters by removing edges with smaller weights, or edges
+        # between communities, until cluster size is lower than the desired value
         max_connected_nodes = self.options.max_connected_nodes
         if max_connected_nodes > 0:  # 0 means no limit
-            clusters = [c for c in graph.clusters() if len(c) > max_connected_nodes]
+            split = split_communities if self.options.split_method == 'communities' else split_component
+            membership = np.array(graph.clusters().membership)
+            counts = np.bincount(membership)
+            clusters = np.flatnonzero(counts > max_connected_nodes)
+            progress = self.max
             self.max += len(clusters)
 
-            edges_indices_to_remove = set()  # store indices in the full graph that we will need to remove
-            for ids in clusters:
-                if self.isStopped():
-                    self.canceled.emit()
-                    return
-                self.updated.emit(1)
-
-                vcount = len(ids)
-                # Clusters
-                if vcount <= max_connected_nodes:
-                    break
-
-                subgraph = graph.subgraph(ids)
-                while vcount > max_connected_nodes:
-                    e = min(subgraph.es, key=lambda x: x['__weight'])
-                    edges_indices_to_remove.add(e['__index'])
-                    subgraph.delete_edges(e.index)
-                    c = subgraph.clusters()
-                    if len(c) > 1:
-                        vcount = max(len(l) for l in c)
-            graph.delete_edges(edges_indices_to_remove)
-        del graph.es['__index']
+            if len(clusters) > 0:
+                edges = np.array(graph.get_edgelist(), dtype=int).reshape(-1, 2)
+                weights = np.array(graph.es['__weight'])
+                edges_membership = membership[edges[:, 0]]
+                edges_indices_to_remove = []  # store indices in the full graph that we will need to remove
+                for c in clusters:
+                    if self.isStopped():
+                        self.canceled.emit()
+                        return
+
+                    ids = np.flatnonzero(edges_membership == c)
+                    removed = split(edges[ids, 0], edges[ids, 1], weights[ids], max_connected_nodes)
+                    edges_indices_to_remove.append(ids[removed])
+                    progress += 1
+                    self.updated.emit(progress)
+                graph.delete_edges(np.concatenate(edges_indices_to_remove).tolist())
 
         if not self.isStopped():
             return interactions, graph
@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+
+import numpy as np
+
+from .read_mgf import ReadMGFWorker
+
+from ..utils.cosine import BlockScores, PIPELINE_BLOCK_SIZE
+from ..utils.memory import available_memory, format_size, scores_memory, MEMORY_HEADROOM
+from ..utils.raw_spectra import RawSpectraIndex
+from ..utils.spectra import SpectraStore
+
+
+def _format_rate(count, seconds):
+    """Format a throughput with a metric prefix, eg. '12.3k'."""
+
+    rate = count / seconds if seconds > 0 else 0.
+    for prefix in ('', 'k', 'M', 'G'):
+        if rate < 1000:
+            break
+        rate /= 1000
+    return f'{rate:.1f}{prefix}'
+
+
+class ReadMGFComputeScoresWorker(ReadMGFWorker):
+    """Read, filter and score spectra from a MGF, mzML or mzXML file as a pipeline.
+
+    Spectra are parsed and filtered by blocks of `block_size` spectra. Each block is given to a `BlockScores` as soon
+    as it is filtered, so that it is scored against previous blocks by worker processes while the next blocks are
+    read. Reading is paused when scoring lags too far behind.
+
+    Progress is reported in thousandths of the estimated number of pairs to score: if a fraction `f` of the file was
+    read, about `f²` of all pairs were submitted for scoring. The description shows the throughput of each stage.
+
+    Returns parent masses, spectra as a `SpectraStore` and scores matrix. Only a single file can be read.
+
+    See `ReadMGFWorker` for `cache`. If a `ScoresCache` is given as `scores_cache`, scores are taken from it when
+    spectra were found in `cache` and were already scored with the same options, and are added to it otherwise.
+
+    As the number of spectra in the file is not known in advance, it is extrapolated from the part of the file already
+    read each time a block is added. If the scores of that many spectra may not fit in available memory, see
+    `scores_memory`, a `MemoryError` is emitted through `error`, so that spectra can be read before being scored.
+    """
+
+    def __init__(self, filename, options, use_multiprocessing=False, cache=None, scores_cache=None,
+                 block_size=PIPELINE_BLOCK_SIZE):
+        super().__init__(filename, options, use_multiprocessing=use_multiprocessing, cache=cache)
+        self._scores_cache = scores_cache
+        self._block_size = block_size
+        try:
+            self._file_size = os.path.getsize(self.filename)
+        except OSError:
+            self._file_size = 0
+        self._progress = 0
+        self.iterative_update = False
+        self.max = 1000
+        self.desc = 'Reading and computing scores...'
+
+    @staticmethod
+    def supports(options):
+        """Check if spectra can be scored while being read with `options`.
+
+        Merging spectra and approximate search need all spectra before scoring can start. Memory-mapped and condensed
+        storages need the number of spectra to be known before scores can be written to them, see `BlockScores`.
+        """
+
+        return (not options.merge_spectra and options.approximate_tables <= 0
+                and options.scores_storage not in ('memmap', 'condensed'))
+
+    def run(self):
+        spectra_key = None
+        spectra = positions = None
+        if self._cache is not None:
+            try:
+                spectra_key = self._cache.key(self.filename, self.options)
+            except OSError:
+                pass
+            else:
+                spectra, positions = self._cache.get(spectra_key, positions=True)
+                if spectra is not None:
+                    logging.getLogger().info(f'Spectra loaded from cache ({spectra_key})')
+
+        if spectra is not None and self._scores_cache is not None:
+            scores_key = self._scores_cache.key(spectra.mzs, spectra, self.options)
+            scores = self._scores_cache.get(scores_key, mmap=self.options.scores_storage == 'memmap')
+            if scores is not None:
+                logging.getLogger().info(f'Scores loaded from cache ({scores_key})')
+                self.updated.emit(self.max)
+                self.sources = np.zeros(len(spectra), dtype=int)
+                self.raw_index = RawSpectraIndex.from_positions([positions], [len(spectra)])
+                return spectra.mzs, spectra, scores
+
+        scorer = BlockScores(self.options.mz_tolerance, self.options.min_matched_peaks,
+                             storage=self.options.scores_storage, min_cosine=self.options.sparse_min_cosine,
+                             top_k=self.options.neighbours_top_k, prune_pairs=self.options.prune_pairs,
+                             processes=self._processes, num_spectra=len(spectra) if spectra is not None else None)
+        cached = spectra is not None
+        try:
+            result = self.run_pipeline(scorer, spectra)
+        except (KeyError, OSError, ValueError, MemoryError) as e:
+            self.error.emit(e)
+            return
+        finally:
+            scorer.close()
+
+        if result is None:
+            self.canceled.emit()
+            return
+
+        spectra, scores = result
+        if not cached:
+            positions = np.concatenate(self._positions) if self._positions else None
+            if spectra_key is not None:
+                self._cache.put(spectra_key, spectra, positions)
+        if self._scores_cache is not None:
+            self._scores_cache.put(self._scores_cache.key(spectra.mzs, spectra, self.options), scores)
+        self.sources = np.zeros(len(spectra), dtype=int)
+        self.raw_index = RawSpectraIndex.from_positions([positions], [len(spectra)])
+        return spectra.mzs, spectra, scores
+
+    def run_pipeline(self, scorer, spectra=None):
+        """Read, filter and score spectra.
+
+        Args:
+            scorer (BlockScores): Used to score blocks of spectra.
+            spectra (SpectraStore): Already filtered spectra, used instead of reading the file.
+
+        Returns:
+            tuple: spectra as a `SpectraStore` and scores matrix, or None if the worker was stopped.
+        """
+
+        read = 0
+
+        def callback(value):
+            nonlocal read
+            read = value
+
+        if spectra is not None:
+            blocks = (spectra[i:i+self._block_size] for i in range(0, len(spectra), self._block_size))
+        else:
+            blocks = self.iter_spectra(block_size=self._block_size, callback=callback)
+
+        stores = []
+        read_time = filter_time = 0.
+        start_time = None
+        available = available_memory() if spectra is None else None
+        while True:
+            t0 = time.perf_counter()
+            block = next(blocks, None)
+            t1 = time.perf_counter()
+            if block is None:
+                break
+            if not isinstance(block, SpectraStore):
+                block = self.filter_spectra(*block)
+            t2 = time.perf_counter()
+            read_time += t1 - t0
+            filter_time += t2 - t1
+
+            stores.append(block)
+            if start_time is None:
+                start_time = t2
+            scorer.add(block)
+            scorer.collect(max_pending=2 * self._processes)  # Do not read too far ahead of scoring
+            if self.isStopped():
+                return
+
+            if spectra is not None:
+                fraction = scorer.num_spectra / len(spectra)
+            else:
+                fraction = min(1., read / self._file_size) if self._file_size > 0 else 0.
+                if available is not None and fraction > 0:
+                    self._check_memory(int(scorer.num_spectra / fraction), available)
+            self._report(scorer, fraction, read_time, filter_time, start_time)
+
+        if self.isStopped():
+            return
+
+        while scorer.pending > 0:
+            scorer.collect(max_pending=scorer.pending - 1)
+            if self.isStopped():
+                return
+            self._report(scorer, 1., read_time, filter_time, start_time)
+
+        scores = scorer.result()
+        logging.getLogger().info(f'{scorer.num_spectra} spectra read in {read_time:.1f}s, '
+                                 f'filtered in {filter_time:.1f}s and scored in '
+                                 f'{time.perf_counter() - start_time if start_time is not None else 0.:.1f}s')
+        self.updated.emit(self.max)
+
+        if not stores:
+            return SpectraStore.from_spectra([], []), scores
+        return (SpectraStore.concatenate(stores) if len(stores) > 1 else stores[0]), scores
+
+    def _check_memory(self, num_spectra, available):
+        """Raise a `MemoryError` if the scores of `num_spectra` spectra may not fit in `available` bytes of memory."""
+
+        needed = scores_memory(num_spectra, self.options.scores_storage, self.options.neighbours_top_k,
+                               pipelined=True)[0]
+        if needed is not None and needed > MEMORY_HEADROOM * available:
+            raise MemoryError(f'Scoring about {num_spectra} spectra while reading them may need up to '
+                              f'{format_size(needed)} of memory but only {format_size(available)} are available.')
+
+    def _report(self, scorer, fraction, read_time, filter_time, start_time):
+        """Update progress, `fraction` being the part of the spectra already read, and show the throughput of each
+        stage in the description."""
+
+        num_spectra = scorer.num_spectra
+        progress = fraction ** 2 * scorer.scored_pairs / max(1, scorer.submitted_pairs)
+        self._progress = max(self._progress, min(self.max - 1, int(self.max * progress)))
+        self.desc = (f'Reading {_format_rate(num_spectra, read_time)} spectra/s, '
+                     f'filtering {_format_rate(num_spectra, filter_time)} spectra/s, '
+                     f'scoring {_format_rate(scorer.scored_pairs, time.perf_counter() - start_time)} pairs/s...')
+        self.updated.emit(self._progress)
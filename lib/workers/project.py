@@ -6,29 +6,15 @@ from .base import BaseWorker
 from ..save import MnzFile, savez
 from ..utils import AttrDict
 from ..utils.network import Network
+from ..utils.scores import mapped_filename
+from ..utils.raw_spectra import RawSpectraIndex
+from ..utils.spectra import SpectraStore
 from ..workers import NetworkVisualizationOptions, TSNEVisualizationOptions, CosineComputationOptions
 from ..graphml import GraphMLParser, GraphMLWriter
 from ..errors import UnsupportedVersionError
 from ..workers.databases import StandardsResult
 
-CURRENT_FORMAT_VERSION = 3
-
-
-class SpectraList(list):
-
-    def __init__(self, filename):
-        self._file = MnzFile(filename, 'r')
-
-    def __getitem__(self, index):
-        data = super().__getitem__(index)
-        if isinstance(data, str):
-            data = self._file[data]
-            super().__setitem__(index, data)
-
-        return data
-
-    def __del__(self):
-        self._file.close()
+CURRENT_FORMAT_VERSION = 4
 
 
 class LoadProjectWorker(BaseWorker):
@@ -54,13 +40,15 @@ class LoadProjectWorker(BaseWorker):
                                                   + "This file format is not supported anymore.\n"
                                                   + "Please generate networks from raw data again")
 
-                elif version in (2, CURRENT_FORMAT_VERSION):
+                elif version in (2, 3, CURRENT_FORMAT_VERSION):
                     # Create network object
                     network = Network()
-                    network.lazyloaded = True
 
-                    # Load scores matrix
-                    network.scores = fid['0/scores']
+                    # Load scores matrix, mapping it from the project file if it has been stored uncompressed
+                    try:
+                        network.scores = fid.memmap('0/scores')
+                    except (KeyError, ValueError):
+                        network.scores = fid['0/scores']
 
                     if self.isStopped():
                         self.canceled.emit()
@@ -93,17 +81,48 @@ class LoadProjectWorker(BaseWorker):
                         self.canceled.emit()
                         return
 
-                    # Load table of spectra
-                    spec_infos = fid['0/spectra/index.json']
-                    network.mzs = []
-                    network.spectra = SpectraList(self.filename)
-                    for s in spec_infos:
-                        if self.isStopped():
-                            self.canceled.emit()
-                            return
+                    # Load ids of scans merged in each spectrum
+                    try:
+                        network.members = [np.array(ids) for ids in fid['0/members.json']]
+                    except KeyError:
+                        network.members = None
+
+                    # Load files spectra were read from
+                    try:
+                        sources = fid['0/sources.json']
+                        network.sources = np.array(sources['ids'], dtype=int)
+                        network.source_files = sources['files']
+                    except KeyError:
+                        network.sources = network.source_files = None
+
+                    # Load positions of raw spectra in files
+                    try:
+                        network.raw_index = RawSpectraIndex(fid['0/raw_index/sources'], fid['0/raw_index/offsets'],
+                                                            fid['0/raw_index/lengths'])
+                    except KeyError:
+                        network.raw_index = None
+
+                    if self.isStopped():
+                        self.canceled.emit()
+                        return
 
-                        network.mzs.append(s['mz_parent'])
-                        network.spectra.append(f'0/spectra/{s["id"]}')
+                    # Load spectra
+                    if version < 4:
+                        # Prior to version 4, each spectrum was stored in its own file
+                        spec_infos = fid['0/spectra/index.json']
+                        mzs, spectra = [], []
+                        for s in spec_infos:
+                            if self.isStopped():
+                                self.canceled.emit()
+                                return
+
+                            mzs.append(s['mz_parent'])
+                            spectra.append(fid[f'0/spectra/{s["id"]}'])
+                        network.spectra = SpectraStore.from_spectra(mzs, spectra)
+                    else:
+                        network.spectra = SpectraStore(fid['0/spectra/mzs'], fid['0/spectra/peaks'],
+                                                       fid['0/spectra/offsets'])
+                    network.mzs = network.spectra.mzs
 
                     if self.isStopped():
                         self.canceled.emit()
@@ -176,13 +195,16 @@ class LoadProjectWorker(BaseWorker):
 
 
 class SaveProjectWorker(BaseWorker):
-    """Save current project to a file for future access"""
+    """Save current project to a file for future access
 
-    def __init__(self, filename, graph, network, options, original_fname=None):
+    The project is written to a temporary file, which replaces the project file when `install` is called from the
+    thread owning `network`, once the worker has finished.
+    """
+
+    def __init__(self, filename, graph, network, options):
         super().__init__()
 
         self.filename = filename
-        self.original_fname = original_fname
         path, fname = os.path.split(filename)
         self.tmp_filename = os.path.join(path, f".tmp-{fname}")
         self.graph = graph
@@ -213,34 +235,75 @@ class SaveProjectWorker(BaseWorker):
         if mappings is not None:
             d['0/mappings.json'] = mappings
 
-        if self.network.lazyloaded and os.path.exists(self.original_fname):
-            # create a temp copy of the archive without filename
-            with zipfile.ZipFile(self.original_fname, 'r') as zin:
-                with zipfile.ZipFile(self.tmp_filename, 'w') as zout:
-                    zout.comment = zin.comment  # preserve the comment
-                    for item in zin.infolist():
-                        if item.filename.startswith('0/spectra/'):
-                            zout.writestr(item, zin.read(item.filename))
-        else:
-            # Convert lists of parent mass and spectrum data to something that be can be saved
-            mzs = getattr(self.network, 'mzs', [])
-            spectra = getattr(self.network, 'spectra', [])
-            d['0/spectra/index.json'] = [{'id': i, 'mz_parent': mz_parent} for i, mz_parent in enumerate(mzs)]
-            d.update({'0/spectra/{}'.format(i): data for i, data in enumerate(spectra)})
+        members = getattr(self.network, 'members', None)
+        if members is not None:
+            d['0/members.json'] = [[int(i) for i in ids] for ids in members]
+
+        sources = getattr(self.network, 'sources', None)
+        if sources is not None:
+            d['0/sources.json'] = {'ids': [int(i) for i in sources], 'files': list(self.network.source_files)}
+
+        raw_index = getattr(self.network, 'raw_index', None)
+        if raw_index is not None:
+            d['0/raw_index/sources'] = raw_index.sources
+            d['0/raw_index/offsets'] = raw_index.offsets
+            d['0/raw_index/lengths'] = raw_index.lengths
+
+        # Spectra are saved as the three arrays of their columnar storage
+        spectra = getattr(self.network, 'spectra', None)
+        if spectra is not None:
+            if not isinstance(spectra, SpectraStore):
+                spectra = SpectraStore.from_spectra(self.network.mzs, spectra)
+            d['0/spectra/mzs'] = spectra.mzs
+            d['0/spectra/peaks'] = spectra.peaks
+            d['0/spectra/offsets'] = spectra.offsets
 
         try:
             savez(self.tmp_filename, version=CURRENT_FORMAT_VERSION, **d)
-        except PermissionError as e:
-            try:
-                os.remove(self.tmp_filename)
-            except OSError:
-                pass
+        except Exception as e:
+            self._remove_tmp_file()
+            if not isinstance(e, PermissionError):
+                raise
             self.error.emit(e)
         else:
-            try:
-                os.remove(self.filename)
-                os.rename(self.tmp_filename, self.filename)
-            except OSError as e:
-                self.error.emit(e)
-            else:
-                return True
+            return True
+
+    def _remove_tmp_file(self):
+        try:
+            os.remove(self.tmp_filename)
+        except OSError:
+            pass
+
+    def install(self):
+        """Replace the project file by the saved one.
+
+        Scores mapped from the previous project file are released first, so that the file can be replaced on all
+        platforms. Scores mapped from a file are then mapped from the saved file.
+
+        Raises:
+            OSError: if the project file could not be replaced. Released scores are mapped again from the previous
+                project file.
+        """
+
+        filename = mapped_filename(getattr(self.network, 'scores', None))
+        try:
+            # Scores computed with memmap storage are mapped from a scratch file that may already be unlinked
+            released = filename is not None and os.path.samefile(filename, self.filename)
+        except OSError:
+            released = False
+        if released:
+            self.network.scores = None
+
+        try:
+            os.replace(self.tmp_filename, self.filename)
+        except OSError:
+            self._remove_tmp_file()
+            if released:
+                with MnzFile(self.filename) as fid:
+                    self.network.scores = fid.memmap('0/scores')
+            raise
+
+        # Scores matrix stored on disk now has to be read from the saved file
+        if filename is not None:
+            with MnzFile(self.filename) as fid:
+                self.network.scores = fid.memmap('0/scores')
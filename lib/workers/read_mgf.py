@@ -1,43 +1,243 @@
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+
 from .base import BaseWorker
 
-from libmetgem.mgf import read as read_mgf
-from libmetgem.filter import filter_data_multi
+from ..utils.consensus import merge_spectra
+from ..utils.filtering import filter_spectra
+from ..utils.mgf import read_mgf
+from ..utils.mzml import read_mzml, is_mzml_file
+from ..utils.raw_spectra import RawSpectraIndex
+from ..utils.spectra import SpectraStore
+
+
+def open_spectra_file(filename, processes=1, callback=None, index=None):
+    """Read spectra from a MGF file using `read_mgf`, or from a mzML or mzXML file using `read_mzml`.
+
+    Spectra of mzML and mzXML files are not indexed.
+    """
+
+    if is_mzml_file(filename):
+        return read_mzml(filename, callback=callback)
+    return read_mgf(filename, ignore_unknown=True, processes=processes, callback=callback, index=index)
+
+
+def _join_positions(index):
+    """Concatenate positions of spectra filled by `read_mgf`, or return None if the file was not indexed."""
+
+    return np.concatenate(index) if index else None
+
+
+def _read_file_task(task):
+    """Parse and filter all spectra of a file in a worker process, see `ReadMGFWorker.read_files`."""
+
+    file_id, filename, options = task
+    mzs, spectra, index = [], [], []
+    for params, data in open_spectra_file(filename, index=index):
+        mzs.append(params['pepmass'])
+        spectra.append(data)
+    return file_id, filter_spectra(mzs, spectra, options['min_intensity'], options['parent_filter_tolerance'],
+                                   options['matched_peaks_window'], options['min_matched_peaks_search'],
+                                   engine=options['filter_engine']), _join_positions(index)
 
 
 class ReadMGFWorker(BaseWorker):
+    """Read and filter spectra from a MGF file, or MS/MS spectra from a mzML or mzXML file.
+
+    Returns parent masses and spectra, as a `SpectraStore`.
+
+    If `use_multiprocessing` is True, large files are parsed by several processes. Progress is reported in kilobytes
+    of the file parsed.
+
+    `filename` may also be a list of files, to merge several samples. Spectra of all files are returned one file
+    after the other and `sources` holds the id of the file each returned spectrum was read from, as an index in
+    `filenames`. If `use_multiprocessing` is True, files are parsed concurrently, one by process.
+
+    If a `SpectraCache` is given as `cache`, parsed and filtered spectra are taken from it when the same file was
+    already read with the same filtering options, and are added to it otherwise.
+
+    While MGF files are parsed, the position of each scan in its file is recorded in `raw_index`, a
+    `RawSpectraIndex`, so that raw spectra can be read again later. Positions are kept in the cache with spectra.
+
+    If `options.merge_spectra` is set, near-identical spectra are merged into consensus spectra and `members` holds,
+    for each returned spectrum, the array of ids of the scans merged into it. A consensus spectrum is considered to
+    come from the file of its first member.
+    """
     
-    def __init__(self, filename, options):
+    def __init__(self, filename, options, use_multiprocessing=False, cache=None):
         super().__init__()
-        self.filename = filename
+        self.filenames = [filename] if isinstance(filename, str) else list(filename)
+        self.filename = self.filenames[0]
         self.options = options
+        self._processes = os.cpu_count() if use_multiprocessing else 1
+        self._cache = cache
         self.iterative_update = True
-        self.max = 0
-        self.desc = 'Reading MGF...'
+        self._sizes = []
+        for name in self.filenames:
+            try:
+                self._sizes.append(os.path.getsize(name) // 1024)
+            except OSError:
+                self._sizes.append(0)
+        self.max = sum(self._sizes)
+        self.desc = 'Reading mzML...' if all(is_mzml_file(name) for name in self.filenames) else 'Reading MGF...'
+        self.members = None
+        self.sources = None
+        self.raw_index = None
+        self._positions = []
 
     def run(self):
-        mzs = []
-        spectra = []
+        keys = [None] * len(self.filenames)
+        stores = [None] * len(self.filenames)
+        positions = [None] * len(self.filenames)
+        if self._cache is not None:
+            for i, name in enumerate(self.filenames):
+                try:
+                    keys[i] = self._cache.key(name, self.options)
+                except OSError:
+                    continue
+                stores[i], positions[i] = self._cache.get(keys[i], positions=True)
+                if stores[i] is not None:
+                    logging.getLogger().info(f'Spectra loaded from cache ({keys[i]})')
+                    self.updated.emit(self._sizes[i])
 
-        min_intensity = self.options.min_intensity
-        parent_filter_tolerance = self.options.parent_filter_tolerance
-        matched_peaks_window = self.options.matched_peaks_window
-        min_matched_peaks_search = self.options.min_matched_peaks_search
+        missing = [i for i, store in enumerate(stores) if store is None]
+        if len(self.filenames) == 1 and missing:
+            stores = [self.read_spectra()]
+            if stores[0] is None:
+                return
+            positions = [_join_positions(self._positions)]
+        elif missing:
+            result = self.read_files(missing)
+            if result is None:
+                return
+            for i, (store, pos) in zip(missing, result):
+                stores[i], positions[i] = store, pos
 
-        for params, data in read_mgf(self.filename, ignore_unknown=True):
-            if self.isStopped():
+        for i in missing:
+            if keys[i] is not None:
+                self._cache.put(keys[i], stores[i], positions[i])
+
+        spectra = stores[0] if len(stores) == 1 else SpectraStore.concatenate(stores)
+        self.sources = np.repeat(np.arange(len(stores)), [len(store) for store in stores])
+        self.raw_index = RawSpectraIndex.from_positions(positions, [len(store) for store in stores])
+
+        if self.options.merge_spectra:
+            self.desc = 'Merging spectra...'
+            result = merge_spectra(spectra.mzs, spectra, self.options.mz_tolerance, self.options.min_matched_peaks,
+                                   self.options.merge_min_cosine, callback=lambda value: not self.isStopped())
+            if result is None:
                 self.canceled.emit()
                 return
+            mzs, spectra, self.members = result
+            spectra = SpectraStore.from_spectra(mzs, spectra)
+            self.sources = self.sources[[ids[0] for ids in self.members]]
 
-            try:
-                mz_parent = params['pepmass']
-            except KeyError as e:
-                self.error.emit(e)
+        return spectra.mzs, spectra
+
+    def read_files(self, ids):
+        """Parse and filter spectra from several files, concurrently if multiprocessing is enabled.
+
+        Args:
+            ids (list of int): indices of the files to read in `filenames`.
+
+        Returns:
+            list: a `SpectraStore` and the positions of its spectra for each file, or None if reading was canceled or
+                failed.
+        """
+
+        tasks = [(i, self.filenames[i], dict(self.options)) for i in ids]
+        processes = min(self._processes, len(tasks))
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        results = pool.imap_unordered(_read_file_task, tasks) if pool is not None else map(_read_file_task, tasks)
+
+        files = {}
+        try:
+            for i, store, positions in results:
+                files[i] = store, positions
+                self.updated.emit(self._sizes[i])
+                if self.isStopped():
+                    self.canceled.emit()
+                    return
+        except (KeyError, OSError, ValueError) as e:
+            self.error.emit(e)
+            return
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return [files[i] for i in ids]
+
+    def read_spectra(self):
+        """Parse and filter spectra from the MGF, mzML or mzXML file, or from the first file if there are several.
+
+        Returns:
+            A `SpectraStore`, or None if reading was canceled or failed.
+        """
+
+        read = 0
+
+        def callback(value):
+            nonlocal read
+            self.updated.emit(value // 1024 - read // 1024)
+            read = value
+
+        try:
+            result = next(self.iter_spectra(callback=callback), None)
+        except (KeyError, OSError, ValueError) as e:
+            self.error.emit(e)
+            return
+
+        if result is None or self.isStopped():
+            self.canceled.emit()
+            return
+
+        return self.filter_spectra(*result)
+
+    def iter_spectra(self, block_size=None, callback=None):
+        """Parse spectra from the file, without filtering them.
+
+        Parsing stops early if the worker is stopped. Positions of spectra in the file are gathered in `_positions`.
+
+        Args:
+            block_size (int): Number of spectra in each yielded block. If None, all spectra are yielded at once.
+            callback: Called with the number of bytes of the file parsed so far, see `read_mgf`.
+
+        Yields:
+            tuple: list of parent masses and list of spectra.
+
+        Raises:
+            KeyError: if a spectrum has no parent mass.
+        """
+
+        self._positions = []
+        reader = open_spectra_file(self.filename, processes=self._processes, callback=callback,
+                                   index=self._positions)
+
+        mzs = []
+        spectra = []
+        for params, data in reader:
+            if self.isStopped():
                 return
 
+            mzs.append(params['pepmass'])
             spectra.append(data)
-            mzs.append(mz_parent)
+            if block_size is not None and len(mzs) >= block_size:
+                yield mzs, spectra
+                mzs, spectra = [], []
+
+        if mzs or block_size is None:
+            yield mzs, spectra
+
+    def filter_spectra(self, mzs, spectra):
+        """Filter spectra using the worker's options, with the engine given by `options.filter_engine`.
+
+        Returns:
+            A `SpectraStore`.
+        """
 
-        spectra = filter_data_multi(mzs, spectra, min_intensity, parent_filter_tolerance,
-                                    matched_peaks_window, min_matched_peaks_search,)
-            
-        return mzs, spectra
+        return filter_spectra(mzs, spectra, self.options.min_intensity, self.options.parent_filter_tolerance,
+                              self.options.matched_peaks_window, self.options.min_matched_peaks_search,
+                              engine=self.options.filter_engine)
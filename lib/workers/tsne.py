@@ -7,6 +7,7 @@ from sklearn.manifold import TSNE
 
 from .base import BaseWorker
 from ..utils import AttrDict, BoundingBox
+from ..utils.scores import count_scores_above, dense_submatrix
 from ..errors import UserRequestedStopError
 from ..config import RADIUS
 
@@ -72,11 +73,11 @@ class TSNEWorker(BaseWorker):
         sys.stdout = ProgressStringIO(self)
 
         # Compute layout
-        mask = (self._scores >= self.options.min_score).sum(axis=0) > self.options.min_scores_above_threshold
+        mask = count_scores_above(self._scores, self.options.min_score) > self.options.min_scores_above_threshold
         layout = np.zeros((self._scores.shape[0], 2))
         if np.any(mask):
             try:
-                layout[mask] = self._tsne.fit_transform(1 - self._scores[mask][:, mask])
+                layout[mask] = self._tsne.fit_transform(1 - dense_submatrix(self._scores, mask))
             except UserRequestedStopError:
                 sys.stdout = sys.__stdout__
                 self.canceled.emit()
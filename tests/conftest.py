@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+@pytest.fixture(params=['Codiaeum.mgf', 'Stillingia SFE.mgf'])
+def mgf_file(request):
+    """Path of a sample MGF file."""
+
+    return os.path.join(EXAMPLES_PATH, request.param)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('libmetgem')
+
+from lib.utils.filtering import filter_spectra
+from lib.utils.mgf import parse_mgf
+
+# min_intensity, parent_filter_tolerance, matched_peaks_window, min_matched_peaks_search
+OPTIONS = [(0, 17, 50, 6), (5, 17, 25, 3), (10, 0, 0, 0), (0, 17, 50, 1)]
+
+
+def read_spectra(filename):
+    with open(filename, 'rb') as f:
+        params_list, peaks, counts = parse_mgf(f.read())
+    offsets = np.r_[0, np.cumsum(counts)]
+    mzs = [params['pepmass'] for params in params_list]
+    return mzs, [peaks[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def assert_same_stores(store, expected):
+    np.testing.assert_array_equal(store.offsets, expected.offsets)
+    np.testing.assert_array_equal(store.peaks[:, 0], expected.peaks[:, 0])
+    np.testing.assert_allclose(store.peaks[:, 1], expected.peaks[:, 1], rtol=1e-5)
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+@pytest.mark.parametrize('normalize', [True, False])
+def test_engines_give_same_spectra(mgf_file, options, normalize):
+    mzs, spectra = read_spectra(mgf_file)
+
+    assert_same_stores(filter_spectra(mzs, spectra, *options, engine='vectorized', normalize=normalize),
+                       filter_spectra(mzs, spectra, *options, engine='libmetgem', normalize=normalize))
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+def test_engines_break_ties_the_same_way(options):
+    # Peaks with the same intensity, some of them in the same window rank filter window
+    rng = np.random.default_rng(0)
+    mzs = rng.uniform(200, 800, 50)
+    spectra = []
+    for mz in mzs:
+        peaks = np.column_stack((np.sort(rng.choice(np.arange(50, mz, 0.5), 40, replace=False)),
+                                 rng.choice([10, 20, 50, 100], 40))).astype(np.float32)
+        spectra.append(peaks)
+
+    assert_same_stores(filter_spectra(mzs, spectra, *options, engine='vectorized'),
+                       filter_spectra(mzs, spectra, *options, engine='libmetgem'))
@@ -0,0 +1,73 @@
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+
+pytest.importorskip('libmetgem')
+
+from libmetgem.mgf import read as libmetgem_read_mgf
+
+import lib.utils.mgf
+from lib.utils.mgf import index_mgf, parse_mgf, read_mgf, read_mgf_spectrum
+
+
+def assert_same_spectra(spectra, expected):
+    assert len(spectra) == len(expected)
+    for (params, data), (expected_params, expected_data) in zip(spectra, expected):
+        assert params.keys() == expected_params.keys()
+        for key, value in expected_params.items():
+            if isinstance(value, float):
+                assert params[key] == pytest.approx(value)
+            else:
+                assert params[key] == value
+        np.testing.assert_allclose(np.asarray(data, dtype=np.float32).reshape(-1, 2),
+                                   np.asarray(expected_data, dtype=np.float32).reshape(-1, 2), rtol=1e-6)
+
+
+@pytest.mark.parametrize('ignore_unknown', [False, True])
+def test_parse_mgf_matches_libmetgem(mgf_file, ignore_unknown):
+    with open(mgf_file, 'rb') as f:
+        params_list, peaks, counts = parse_mgf(f.read(), ignore_unknown=ignore_unknown)
+    offsets = np.r_[0, np.cumsum(counts)]
+    spectra = [(params, peaks[start:stop]) for params, start, stop in zip(params_list, offsets[:-1], offsets[1:])]
+
+    assert_same_spectra(spectra, list(libmetgem_read_mgf(mgf_file, ignore_unknown=ignore_unknown)))
+
+
+def test_read_mgf_in_ranges_matches_libmetgem(mgf_file, monkeypatch):
+    monkeypatch.setattr(lib.utils.mgf, 'PARALLEL_MIN_SIZE', 0)
+    monkeypatch.setattr(lib.utils.mgf, 'CHUNK_SIZE', 64 * 1024)
+    index = []
+    spectra = list(read_mgf(mgf_file, ignore_unknown=True, processes=2, index=index))
+
+    assert_same_spectra(spectra, list(libmetgem_read_mgf(mgf_file, ignore_unknown=True)))
+    assert len(np.concatenate(index)) == len(spectra)
+
+
+def test_read_compressed_mgf_matches_libmetgem(mgf_file, tmp_path):
+    filename = str(tmp_path / 'spectra.mgf.gz')
+    with open(mgf_file, 'rb') as f, gzip.open(filename, 'wb') as g:
+        shutil.copyfileobj(f, g)
+
+    assert_same_spectra(list(read_mgf(filename, ignore_unknown=True)),
+                        list(libmetgem_read_mgf(mgf_file, ignore_unknown=True)))
+
+
+def test_index_mgf_matches_parse_mgf(mgf_file):
+    with open(mgf_file, 'rb') as f:
+        data = f.read()
+
+    np.testing.assert_array_equal(index_mgf(data), parse_mgf(data, positions=True)[3])
+
+
+def test_read_mgf_indexes_spectra(mgf_file):
+    index = []
+    spectra = list(read_mgf(mgf_file, index=index))
+    positions = np.concatenate(index)
+
+    assert len(positions) == len(spectra)
+    for (params, data), (offset, length) in zip(spectra, positions):
+        spectrum_params, spectrum_data = read_mgf_spectrum(mgf_file, offset, length)
+        assert spectrum_params['pepmass'] == pytest.approx(params['pepmass'])
+        np.testing.assert_allclose(spectrum_data, data, rtol=1e-6)